@@ -1,83 +1,323 @@
-import socket, json, sys, select, os
-from time import time, sleep
-from base64 import b64encode
+import socket, json, sys, select, os, asyncio, random, collections, copy, threading
+from time import time, sleep, monotonic
+from base64 import b64encode, b64decode
 from datetime import datetime
 import logging
 
 max_delta_seconds=120
+default_timeout=10
+recv_size=65536
+stream_limit=16*1024*1024
+sync_id_max=2**31-1
+default_chunk_size=1024*1024
+default_window=4
+exec_poll_min=0.01
+exec_poll_max=1
+boot_id_path="/proc/sys/kernel/random/boot_id"
+# Seconds replies stay in a FactCache. Only commands without arguments.
+default_fact_ttls={
+    "guest-info": 3600,
+    "guest-get-osinfo": 3600,
+    "guest-get-host-name": 300,
+    "guest-get-timezone": 300,
+    "guest-get-disks": 60,
+}
+default_cache_entries=4096
 log = logging.getLogger(__name__)
 
 logging.basicConfig(stream=sys.stderr)
 
+class FactCache:
+    # Replies to rarely changing commands, shared by any number of QemuAgent
+    # connections and kept per socket path. A guest's entries are dropped
+    # when its connection fails or its boot id changes. The boot id is read
+    # before a fetch and before serving an entry, at most every boot_check
+    # seconds, which defaults to the shortest TTL.
+    def __init__(self, ttls=default_fact_ttls, max_entries=default_cache_entries, boot_check=None):
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self.boot_check = min(self.ttls.values()) if boot_check is None else boot_check
+        self.entries = collections.OrderedDict()
+        self.boots = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, message):
+        return message.get("execute") in self.ttls and not message.get("arguments")
+
+    def get(self, agent, command, fetch):
+        key = (agent._sockpath, command)
+        with self.lock:
+            entry = self.entries.get(key)
+            fresh = entry is not None and entry[0] > monotonic()
+        if fresh and self.check_boot(agent):
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(entry[1])
+        elif not fresh:
+            # The baseline is taken before the fetch, so a reboot in between
+            # shows up as a new boot id at the next check.
+            self.check_boot(agent)
+        with self.lock:
+            self.misses += 1
+        value = fetch()
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttls[command], copy.deepcopy(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def check_boot(self, agent):
+        # Whether the guest's entries can still be served.
+        sockpath = agent._sockpath
+        with self.lock:
+            boot = self.boots.get(sockpath)
+            if boot is not None and monotonic() - boot[1] < self.boot_check:
+                return True
+        try:
+            boot_id = agent.boot_id()
+        except Exception as e:
+            # Guests without the file only get the TTLs.
+            log.debug("No boot id from %s: %s", sockpath, e)
+            boot_id = None
+        with self.lock:
+            self.boots[sockpath] = (boot_id, monotonic())
+            if boot is None or boot[0] != boot_id:
+                log.debug("%s: new boot id, dropping cached facts", sockpath)
+                self._invalidate(sockpath, boots=False)
+                return False
+        return True
+
+    def invalidate(self, sockpath=None, command=None):
+        with self.lock:
+            self._invalidate(sockpath, command)
+
+    def _invalidate(self, sockpath=None, command=None, boots=True):
+        for key in list(self.entries):
+            if (sockpath is None or key[0] == sockpath) and (command is None or key[1] == command):
+                del self.entries[key]
+        if command is None and boots:
+            for path in list(self.boots):
+                if sockpath is None or path == sockpath:
+                    del self.boots[path]
+
 class QemuAgent:
-    def __init__(self, sockpath, debug=False):
+    def __init__(self, sockpath, debug=False, timeout=default_timeout, cache=None):
         if not os.path.exists(sockpath):
             raise TypeError(f"Socket path {sockpath} doesn't exist")
+        if cache is not None and not isinstance(cache, FactCache):
+            raise TypeError("cache must be FactCache")
         self._sockpath = sockpath
+        self.timeout = timeout
+        self.cache = cache
+        self._buffer = b""
+        self._stale = False
         if debug:
             log.setLevel("DEBUG")
 
     def __enter__(self):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(self._sockpath)
+        try:
+            self.sock.connect(self._sockpath)
+        except Exception:
+            self.sock.close()
+            self._reset()
+            raise
+        self._buffer = b""
+        self._stale = False
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.sock:
             self.sock.close()
 
-    def send(self, message):
+    def recv_message(self, timeout=None):
+        # Replies are newline delimited JSON documents. Anything received
+        # after the first complete reply stays buffered for the next call.
+        if timeout is None:
+            timeout = self.timeout
+        deadline = monotonic() + timeout
+        while True:
+            line, sep, rest = self._buffer.partition(b"\n")
+            if sep:
+                self._buffer = rest
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                log.debug("\"%s\"", line.decode('utf-8', errors='replace'))
+                return json.loads(line)
+            try:
+                self._fill(deadline)
+            except TimeoutError:
+                # The late reply would be taken for the answer to the next
+                # command, so the stream is resynced before that is sent.
+                self._buffer = b""
+                self._stale = True
+                raise
+
+    def _resync(self):
+        if self._stale:
+            log.debug("Resyncing with %s after a timeout", self._sockpath)
+            self.guest_sync_delimited()
+
+    def send(self, message, timeout=None):
         if not isinstance(message, dict):
             raise TypeError("Message must be a dictionary")
+        if self.cache is not None and self.cache.cacheable(message):
+            return self.cache.get(self, message["execute"], lambda: self._send(message, timeout))
+        return self._send(message, timeout)
+
+    def _send(self, message, timeout=None):
         msg = json.dumps(message)
         log.debug(msg)
-        self.sock.send((msg + '\r\n').encode('ascii'))
-        data = ""
+        try:
+            self._resync()
+            self.sock.sendall((msg + '\r\n').encode('ascii'))
+            out = self.recv_message(timeout)
+        except Exception:
+            self._reset()
+            raise
+        return parse_reply(out)
+
+    def _reset(self):
+        # A failed connection may mean a restarted agent or guest.
+        if self.cache is not None:
+            self.cache.invalidate(self._sockpath)
+
+    def boot_id(self):
+        handle = self.guest_file_open(boot_id_path, "r")
+        # The read and the close share a round trip.
+        ret, _ = self.pipeline([
+            { "execute": "guest-file-read", "arguments": { "handle": handle } },
+            { "execute": "guest-file-close", "arguments": { "handle": handle } },
+        ])
+        return b64decode(ret.get("buf-b64", "")).decode('ascii').strip()
+
+    def pipeline(self, messages, window=default_window):
+        # Keeps up to window commands in flight. The agent answers in order,
+        # so replies are yielded in the same order as the messages. Messages
+        # are pulled lazily, and every command that was sent is answered
+        # before an error is raised, which keeps the stream in sync.
+        inflight = 0
+        error = None
+        messages = iter(messages)
+        done = False
+        self._resync()
         while True:
-            outs, _, _ = select.select([self.sock], [], [], 1)
-            if len(outs) == 0:
+            while not done and inflight < window:
+                message = next(messages, None)
+                if message is None:
+                    done = True
+                    break
+                self.sock.sendall((json.dumps(message) + '\r\n').encode('ascii'))
+                inflight += 1
+            if inflight == 0:
                 break
-            temp = self.sock.recv(1024).decode('ascii')
-            data += temp
-        log.debug("\"%s\"", data)
-        if data is None or len(data) == 0:
+            out = self.recv_message()
+            inflight -= 1
+            if error is not None:
+                continue
+            try:
+                ret = parse_reply(out)
+            except Exception as e:
+                error = e
+                done = True
+                continue
+            try:
+                yield ret
+            except GeneratorExit:
+                for _ in range(inflight):
+                    self.recv_message()
+                raise
+        if error is not None:
+            raise error
+
+    def upload(self, local, remote, chunk_size=default_chunk_size, window=default_window):
+        if not isinstance(local, str):
+            raise TypeError("local must be str")
+        if not isinstance(remote, str):
+            raise TypeError("remote must be str")
+        handle = self.guest_file_open(remote, "wb")
+        total = 0
+        try:
+            with open(local, "rb") as f:
+                def writes():
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if len(chunk) == 0:
+                            return
+                        yield {
+                            "execute": "guest-file-write",
+                            "arguments": {
+                                "handle": handle,
+                                "buf-b64": b64encode(chunk).decode('ascii')
+                            }
+                        }
+                for ret in self.pipeline(writes(), window):
+                    if not isinstance(ret, dict):
+                        raise Exception("Invalid message from guest: %s" % ret)
+                    total += ret.get("count", 0)
+        finally:
+            self.guest_file_close(handle)
+        log.debug("Uploaded %d bytes from %s to %s", total, local, remote)
+        return total
+
+    def download(self, remote, local, chunk_size=default_chunk_size, window=default_window):
+        if not isinstance(remote, str):
+            raise TypeError("remote must be str")
+        if not isinstance(local, str):
+            raise TypeError("local must be str")
+        handle = self.guest_file_open(remote, "rb")
+        total = 0
+        read = {
+            "execute": "guest-file-read",
+            "arguments": {
+                "handle": handle,
+                "count": chunk_size
+            }
+        }
+        eof = False
+        def reads():
+            while not eof:
+                yield read
+        try:
+            with open(local, "wb") as f:
+                for ret in self.pipeline(reads(), window):
+                    if not isinstance(ret, dict):
+                        raise Exception("Invalid message from guest: %s" % ret)
+                    if eof:
+                        continue
+                    buf = b64decode(ret.get("buf-b64", ""))
+                    f.write(buf)
+                    total += len(buf)
+                    eof = ret.get("eof", False) or len(buf) == 0
+        finally:
+            self.guest_file_close(handle)
+        log.debug("Downloaded %d bytes from %s to %s", total, remote, local)
+        return total
+
+    def _fill(self, deadline):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError("No reply from guest agent")
+        outs, _, _ = select.select([self.sock], [], [], remaining)
+        if len(outs) == 0:
+            return
+        data = self.sock.recv(recv_size)
+        if len(data) == 0:
             raise Exception("Host Disconnected")
-
-        out = json.loads(data)
-        if "error" in out:
-            e = out['error']
-            raise Exception("%s: %s" % 
-                (e.get("class", "UnknownClass"), e.get("desc", "No Description")))
-        if "return" in out:
-            return out['return']
-        raise Exception("Invalid output: %s", out)
+        self._buffer += data
 
     def guest_exec(self, path, arg=[], env=[], input_data=None, capture_output=None):
-        if not isinstance(path, str):
-            raise TypeError("path must be str")
-        if not isinstance(arg, list):
-            raise TypeError("arg must be list")
-        if not isinstance(env, list):
-            raise TypeError("env must be list")
-        if input_data is not None and not isinstance(input_data, bytes):
-            raise TypeError("input_data must be bytes")
-        if capture_output is not None and not isinstance(capture_output, bool):
-            raise TypeError("capture_output must be bool")
-
         message = {
             "execute": "guest-exec",
-            "arguments": {
-                "path": path
-            }
+            "arguments": exec_arguments(path, arg, env, input_data, capture_output)
         }
-        if len(arg) > 0:
-            message["arguments"]["arg"] = arg
-        if len(env) > 0:
-            message["arguments"]["env"] = env
-        if input_data is not None:
-            message["arguments"]["input-data"] = b64encode(input_data)
-        if capture_output is not None:
-            message["arguments"]["capture-output"] = capture_output
         return self.send(message)
 
     def guest_exec_status(self, pid):
@@ -92,6 +332,12 @@ class QemuAgent:
             raise Exception("Invalid message from guest: %s" % ret)
         return ret
 
+    def exec_stream(self, path, arg=[], env=[], input_data=None, timeout=None):
+        ret = self.guest_exec(path, arg, env, input_data, capture_output=True)
+        if not isinstance(ret, dict) or "pid" not in ret:
+            raise Exception("Invalid message from guest: %s" % ret)
+        return GuestProcess(self, ret["pid"], timeout=timeout)
+
     def guest_file_close(self, handle):
         if not isinstance(handle, int):
             raise TypeError("handle must be int")
@@ -110,7 +356,7 @@ class QemuAgent:
         if not isinstance(handle, int):
             raise TypeError("handle must be int")
         message = {
-            "execute": "guest-file-read",
+            "execute": "guest-file-flush",
             "arguments": {
                 "handle": handle
             }
@@ -149,7 +395,7 @@ class QemuAgent:
             }
         }
         if count is not None:
-            message['count'] = count
+            message['arguments']['count'] = count
         ret = self.send(message)
         if not isinstance(ret, dict):
             raise Exception("Invalid message from guest: %s" % ret)
@@ -195,7 +441,7 @@ class QemuAgent:
             }
         }
         if count is not None:
-            message['count'] = count
+            message['arguments']['count'] = count
         ret = self.send(message)
         if not isinstance(ret, dict):
             raise Exception("Invalid message from guest: %s" % ret)
@@ -426,46 +672,337 @@ class QemuAgent:
         pass
     def guest_suspend_ram(self):
         pass
-    def guest_sync(self):
-        pass
-    def guest_sync_delimited(self):
-        pass
+    def guest_sync(self, id=None):
+        if id is None:
+            id = random.randint(1, sync_id_max)
+        if not isinstance(id, int):
+            raise TypeError("id must be int")
+        message = {
+            "execute": "guest-sync",
+            "arguments": {
+                "id": id
+            }
+        }
+        self._resync()
+        self.sock.sendall((json.dumps(message) + '\r\n').encode('ascii'))
+        # Replies to earlier, abandoned commands may still be queued.
+        while True:
+            ret = parse_reply(self.recv_message())
+            if ret == id:
+                return ret
+
+    def guest_sync_delimited(self, id=None, timeout=None):
+        if id is None:
+            id = random.randint(1, sync_id_max)
+        if not isinstance(id, int):
+            raise TypeError("id must be int")
+        if timeout is None:
+            timeout = self.timeout
+        message = {
+            "execute": "guest-sync-delimited",
+            "arguments": {
+                "id": id
+            }
+        }
+        # A leading 0xFF resets the agent's parser, and the agent prefixes
+        # its reply with 0xFF, so everything before it can be thrown away.
+        self._stale = True
+        self.sock.sendall(b"\xff" + (json.dumps(message) + '\r\n').encode('ascii'))
+        deadline = monotonic() + timeout
+        while True:
+            idx = self._buffer.find(b"\xff")
+            if idx >= 0:
+                self._buffer = self._buffer[idx + 1:]
+                break
+            self._buffer = b""
+            self._fill(deadline)
+        while True:
+            ret = parse_reply(self.recv_message(deadline - monotonic()))
+            if ret == id:
+                self._stale = False
+                return ret
+
+class AsyncQemuAgent:
+    def __init__(self, sockpath, timeout=default_timeout):
+        self._sockpath = sockpath
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self._pending = {}
+        self._next_id = 0
+        self._reader_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
-def flush(s, seconds):
-    _c_read, _, _ = select.select([s], [], [], seconds)
-    if len(_c_read) > 0:
-        _ = _c_read[0].recv(1024)
-
-
-def get_time_seconds(s):
-    flush(s, 1)
-    get_time = { "execute": "guest-get-time" }
-    s.send((json.dumps(get_time) + '\r\n').encode('ascii'))
-    data = s.recv(1024).decode('ascii')
-    t = json.loads(data)
-    return t.get('return', 0) / 1000000000
-
-def set_time_seconds(s, t):
-    flush(s, 1)
-    t = time()
-    set_time = {
-        "execute": "guest-set-time", 
-        "arguments": { 
-            "time":  int(t * 1000000000)
+    async def connect(self):
+        if not os.path.exists(self._sockpath):
+            raise TypeError(f"Socket path {self._sockpath} doesn't exist")
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self._sockpath, limit=stream_limit)
+        try:
+            await asyncio.wait_for(self.resync(), self.timeout)
+        except BaseException:
+            self.writer.close()
+            self.writer = None
+            raise
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+        self._fail_pending(Exception("Connection closed"))
+
+    @property
+    def connected(self):
+        return self._reader_task is not None and not self._reader_task.done()
+
+    async def resync(self):
+        id = random.randint(1, sync_id_max)
+        message = {
+            "execute": "guest-sync-delimited",
+            "arguments": {
+                "id": id
+            }
         }
-    }
-    s.send((json.dumps(set_time) + '\r\n').encode('ascii'))
-    data = s.recv(1024).decode('ascii')
-    return data
+        self.writer.write(b"\xff" + (json.dumps(message) + '\r\n').encode('ascii'))
+        await self.writer.drain()
+        await self.reader.readuntil(b"\xff")
+        while True:
+            line = await self.reader.readline()
+            if len(line) == 0:
+                raise Exception("Host Disconnected")
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if parse_reply(json.loads(line)) == id:
+                return id
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if len(line) == 0:
+                    raise Exception("Host Disconnected")
+                line = line.strip(b"\xff\r\n ")
+                if len(line) == 0:
+                    continue
+                log.debug("\"%s\"", line.decode('utf-8', errors='replace'))
+                self._dispatch(json.loads(line))
+        except Exception as e:
+            log.debug("Agent %s reader stopped: %s", self._sockpath, e)
+            self._fail_pending(e)
+
+    def _dispatch(self, out):
+        # The agent answers in order and echoes "id", so fall back to the
+        # oldest outstanding request if a reply comes back without one.
+        id = out.get("id")
+        if id in self._pending:
+            fut = self._pending.pop(id)
+        elif id is None and len(self._pending) > 0:
+            fut = self._pending.pop(next(iter(self._pending)))
+        else:
+            log.debug("Unsolicited message: %s", out)
+            return
+        if not fut.done():
+            fut.set_result(out)
+
+    def _fail_pending(self, exc):
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    async def wait_closed(self):
+        if self._reader_task is not None:
+            await asyncio.shield(self._reader_task)
+
+    async def execute(self, command, arguments=None, timeout=None):
+        return parse_reply(await self.request(command, arguments, timeout))
+
+    async def request(self, command, arguments=None, timeout=None):
+        if not self.connected:
+            raise Exception("Not connected")
+        if timeout is None:
+            timeout = self.timeout
+        self._next_id += 1
+        id = self._next_id
+        message = {
+            "execute": command,
+            "id": id
+        }
+        if arguments is not None:
+            message["arguments"] = arguments
+        msg = json.dumps(message)
+        log.debug(msg)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[id] = fut
+        self.writer.write((msg + '\r\n').encode('ascii'))
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            # A late reply carries the id and is dropped as unsolicited.
+            self._pending.pop(id, None)
+
+    async def guest_ping(self):
+        try:
+            ret = await self.execute("guest-ping")
+            if not isinstance(ret, dict):
+                raise Exception("Invalid message from guest: %s" % ret)
+        except Exception:
+            return False
+        return True
 
-def sync_time(s):
-    vmtime = get_time_seconds(s)
-    curtime = time()
-    delta = (curtime - vmtime)
-    if delta > max_delta_seconds:
-        _ = set_time_seconds(s, curtime)
+    async def guest_info(self):
+        ret = await self.execute("guest-info")
+        if not isinstance(ret, dict):
+            raise Exception("Invalid message from guest: %s" % ret)
+        return ret
+
+    async def guest_get_time(self):
+        ret = await self.execute("guest-get-time")
+        if not isinstance(ret, int):
+            raise Exception("Invalid message from guest: %s" % ret)
+        return datetime.fromtimestamp(ret / 1000000000)
+
+    async def guest_set_time(self, t):
+        if not isinstance(t, datetime):
+            raise TypeError("time must be datetime")
+        ret = await self.execute("guest-set-time", {
+            "time": int(t.timestamp() * 1000000000)
+        })
+        if not isinstance(ret, dict):
+            raise Exception("Invalid message from guest: %s" % ret)
+        return ret
+
+    async def guest_exec(self, path, arg=[], env=[], input_data=None, capture_output=None):
+        return await self.execute("guest-exec",
+            exec_arguments(path, arg, env, input_data, capture_output))
+
+    async def guest_exec_status(self, pid):
+        ret = await self.execute("guest-exec-status", {"pid": pid})
+        if not isinstance(ret, dict):
+            raise Exception("Invalid message from guest: %s" % ret)
+        return ret
+
+    async def exec_stream(self, path, arg=[], env=[], input_data=None, timeout=None):
+        ret = await self.guest_exec(path, arg, env, input_data, capture_output=True)
+        if not isinstance(ret, dict) or "pid" not in ret:
+            raise Exception("Invalid message from guest: %s" % ret)
+        return GuestProcess(self, ret["pid"], timeout=timeout)
+
+class GuestProcess:
+    # Output of a guest-exec process as ("out" | "err", bytes) chunks. Use
+    # plain iteration with QemuAgent and async iteration with AsyncQemuAgent.
+    # The poll interval starts at poll_min, doubles while the process is
+    # quiet up to poll_max and drops back as soon as output shows up.
+    def __init__(self, agent, pid, poll_min=exec_poll_min, poll_max=exec_poll_max, timeout=None):
+        self.agent = agent
+        self.pid = pid
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self.exited = False
+        self.exitcode = None
+        self.signal = None
+
+    def _update(self, ret):
+        chunks = []
+        for key, name in [ ("out-data", "out"), ("err-data", "err") ]:
+            data = ret.get(key)
+            if data:
+                chunks.append((name, b64decode(data)))
+        if ret.get("exited"):
+            self.exited = True
+            self.exitcode = ret.get("exitcode")
+            self.signal = ret.get("signal")
+        return chunks
+
+    def _next_delay(self, delay, chunks, deadline):
+        if deadline is not None and monotonic() > deadline:
+            raise TimeoutError("Guest process %s still running after %ss" % (self.pid, self.timeout))
+        if len(chunks) > 0:
+            return self.poll_min
+        return min(delay * 2, self.poll_max)
+
+    def __iter__(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        delay = self.poll_min / 2
+        while not self.exited:
+            chunks = self._update(self.agent.guest_exec_status(self.pid))
+            yield from chunks
+            if self.exited:
+                break
+            delay = self._next_delay(delay, chunks, deadline)
+            sleep(delay)
+
+    async def __aiter__(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        delay = self.poll_min / 2
+        while not self.exited:
+            chunks = self._update(await self.agent.guest_exec_status(self.pid))
+            for chunk in chunks:
+                yield chunk
+            if self.exited:
+                break
+            delay = self._next_delay(delay, chunks, deadline)
+            await asyncio.sleep(delay)
+
+def parse_reply(out):
+    if "error" in out:
+        e = out['error']
+        raise Exception("%s: %s" % 
+            (e.get("class", "UnknownClass"), e.get("desc", "No Description")))
+    if "return" in out:
+        return out['return']
+    raise Exception("Invalid output: %s" % out)
+
+def exec_arguments(path, arg=[], env=[], input_data=None, capture_output=None):
+    if not isinstance(path, str):
+        raise TypeError("path must be str")
+    if not isinstance(arg, list):
+        raise TypeError("arg must be list")
+    if not isinstance(env, list):
+        raise TypeError("env must be list")
+    if input_data is not None and not isinstance(input_data, bytes):
+        raise TypeError("input_data must be bytes")
+    if capture_output is not None and not isinstance(capture_output, bool):
+        raise TypeError("capture_output must be bool")
+
+    arguments = {
+        "path": path
+    }
+    if len(arg) > 0:
+        arguments["arg"] = arg
+    if len(env) > 0:
+        arguments["env"] = env
+    if input_data is not None:
+        arguments["input-data"] = b64encode(input_data).decode('ascii')
+    if capture_output is not None:
+        arguments["capture-output"] = capture_output
+    return arguments
 
 def main(sockpath):
+    # Kept for scripts that start one sync daemon per VM. The syncing is
+    # timesync's, which logs failures and reconnects instead of dying.
+    import timesync
     try:
         pid = os.fork()
         if pid > 0:
@@ -473,21 +1010,7 @@ def main(sockpath):
     except OSError as e:
         print("fork failed %d (%s)" % (e.errno, e.strerror))
         sys.exit(1)
-
-    while True:
-        if os.path.exists(sockpath):
-            break
-        sleep(10)
-
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    s.connect(sockpath)
-
-    try:
-        while True:
-            sync_time(s)
-            flush(s, 60)
-    except:
-        pass
+    timesync.main([ "timesync", os.path.dirname(os.path.abspath(sockpath)) ])
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
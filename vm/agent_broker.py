@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# Holds one persistent connection to every VM's guest agent and shares it
+# between any number of local clients. For each <name>.agent socket the
+# broker listens on <name>.agent.mux, which speaks the same protocol, so
+# QemuAgent, agent_shell and fleet can be pointed at it unchanged.
+import asyncio
+import agent
+import fleet
+import json
+import logging
+import os
+import signal
+import sys
+
+log = logging.getLogger("agent_broker")
+logging.basicConfig(stream=sys.stderr)
+
+default_timeout=60
+rescan_seconds=10
+reconnect_min=0.1
+reconnect_max=10
+
+class AgentConnection:
+	def __init__(self, name, sockpath, timeout=default_timeout):
+		self.name = name
+		self.sockpath = sockpath
+		self.mux_path = sockpath + fleet.mux_suffix
+		self.timeout = timeout
+		self.agent = None
+		self.ready = asyncio.Event()
+		self.server = None
+		self.task = None
+
+	async def start(self):
+		if os.path.exists(self.mux_path):
+			os.remove(self.mux_path)
+		self.server = await asyncio.start_unix_server(self.handle_client, path=self.mux_path)
+		self.task = asyncio.create_task(self.run())
+		log.debug("%s: listening on %s", self.name, self.mux_path)
+
+	async def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+		if self.server is not None:
+			self.server.close()
+			await self.server.wait_closed()
+		if os.path.exists(self.mux_path):
+			os.remove(self.mux_path)
+
+	async def run(self):
+		delay = reconnect_min
+		while True:
+			q = agent.AsyncQemuAgent(self.sockpath, self.timeout)
+			try:
+				await q.connect()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				log.debug("%s: connect failed: %s", self.name, e)
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, reconnect_max)
+				continue
+			log.info("%s: connected", self.name)
+			delay = reconnect_min
+			self.agent = q
+			self.ready.set()
+			try:
+				await q.wait_closed()
+			finally:
+				self.ready.clear()
+				self.agent = None
+				await q.close()
+			log.info("%s: disconnected", self.name)
+
+	async def forward(self, message):
+		command = message.get("execute")
+		arguments = message.get("arguments")
+		# The broker keeps its own connection in sync, so sync requests are
+		# answered locally and never reach the guest.
+		if command == "guest-sync":
+			return {"return": (arguments or {}).get("id")}
+		if command == "guest-sync-delimited":
+			return (b"\xff", {"return": (arguments or {}).get("id")})
+		try:
+			await asyncio.wait_for(self.ready.wait(), self.timeout)
+			return await self.agent.request(command, arguments, self.timeout)
+		except asyncio.TimeoutError:
+			return {"error": {"class": "GenericError", "desc": "Guest agent timed out"}}
+		except Exception as e:
+			return {"error": {"class": "GenericError", "desc": str(e)}}
+
+	async def handle(self, message):
+		out = await self.forward(message)
+		prefix = b""
+		if isinstance(out, tuple):
+			prefix, out = out
+		out = dict(out)
+		out.pop("id", None)
+		if "id" in message:
+			out["id"] = message["id"]
+		return prefix + (json.dumps(out) + "\r\n").encode('ascii')
+
+	async def handle_client(self, reader, writer):
+		# Requests from one client are forwarded as they arrive, replies are
+		# written back in the order the requests were received.
+		replies = asyncio.Queue()
+		sender = asyncio.create_task(self.send_replies(replies, writer))
+		try:
+			while True:
+				line = await reader.readline()
+				if len(line) == 0:
+					break
+				line = line.rsplit(b"\xff", 1)[-1].strip()
+				if len(line) == 0:
+					continue
+				try:
+					message = json.loads(line)
+					if not isinstance(message, dict):
+						raise ValueError("message must be an object")
+				except ValueError as e:
+					fut = asyncio.get_running_loop().create_future()
+					fut.set_result(json.dumps({"error": {"class": "GenericError", "desc": str(e)}}).encode('ascii') + b"\r\n")
+					await replies.put(fut)
+					continue
+				await replies.put(asyncio.ensure_future(self.handle(message)))
+		except ConnectionError:
+			pass
+		finally:
+			await replies.put(None)
+			await sender
+
+	async def send_replies(self, replies, writer):
+		try:
+			while True:
+				fut = await replies.get()
+				if fut is None:
+					break
+				writer.write(await fut)
+				await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+class AgentBroker:
+	def __init__(self, vm_dirs, timeout=default_timeout):
+		self.vm_dirs = vm_dirs
+		self.timeout = timeout
+		self.connections = {}
+
+	async def rescan(self):
+		sockets = fleet.discover(self.vm_dirs)
+		for name in list(self.connections):
+			if sockets.get(name) != self.connections[name].sockpath:
+				log.info("%s: gone", name)
+				await self.connections.pop(name).stop()
+		for name, sockpath in sockets.items():
+			if name in self.connections:
+				continue
+			conn = AgentConnection(name, sockpath, self.timeout)
+			await conn.start()
+			self.connections[name] = conn
+
+	async def stop(self):
+		for conn in self.connections.values():
+			await conn.stop()
+		self.connections = {}
+
+	async def run(self):
+		try:
+			while True:
+				await self.rescan()
+				await asyncio.sleep(rescan_seconds)
+		finally:
+			await self.stop()
+
+async def serve(broker):
+	# SIGTERM also removes the .mux sockets, or clients would keep trying them.
+	asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+	await broker.run()
+
+def main(argv):
+	if len(argv) < 2:
+		raise TypeError("must define at least one VM directory")
+	if os.getenv('AGENT_DEBUG') == '1':
+		log.setLevel('DEBUG')
+	else:
+		log.setLevel('INFO')
+	try:
+		asyncio.run(serve(AgentBroker(argv[1:])))
+	except (KeyboardInterrupt, asyncio.CancelledError):
+		pass
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -1,7 +1,5 @@
 #!/usr/bin/python3
-import base64
 import agent
-import time
 import logging
 import sys
 import os
@@ -22,23 +20,15 @@ def agent_execute(agent_path):
 				continue
 			log.debug(f"command={cmd}")
 			try:
-				pid = q.guest_exec(cmd[0], arg=cmd[1:], capture_output=True).get('pid')
+				proc = q.exec_stream(cmd[0], arg=cmd[1:])
+				for name, data in proc:
+					out = sys.stdout if name == "out" else sys.stderr
+					out.buffer.write(data)
+					out.flush()
 			except Exception as e:
 				print(e)
 				continue
-			if pid is None:
-				return
-			while True:
-				ret = q.guest_exec_status(pid)
-				encoded_ret = ret.get('out-data')
-				status = ret.get('exitcode')
-				text_ret = base64
-				log.debug(f"(status: {status}, Exited: {ret.get('exited')})")
-				if encoded_ret is not None:
-					print(base64.b64decode(encoded_ret).decode('ascii', errors='ignore'))
-				if ret.get('exited'):
-					break
-				time.sleep(1)
+			log.debug(f"(status: {proc.exitcode}, signal: {proc.signal})")
 
 if __name__ == "__main__":
 	if os.getenv('AGENT_DEBUG') == '1':
@@ -0,0 +1,231 @@
+# Host specific parts of the qemu command line. A backend turns the machine,
+# drive and NIC specs into arguments for one kind of host, hvf on macOS or
+# KVM on Linux. "backend" in specs.json picks one, otherwise the platform
+# decides. Backends only build argument lists, so they can be checked
+# without running qemu.
+import sys
+
+# Name of the virtio serial port of the bulk data channel in the guest.
+bulk_port="vm.bulk.0"
+
+def ram_size(specs):
+	# -m takes plain numbers as megabytes, memory backends as bytes.
+	ram = specs.get("ram", "1G")
+	return ram + "M" if ram.replace(".", "", 1).isdigit() else ram
+
+class HvfBackend:
+	name = "hvf"
+	qemu_path = "/opt/homebrew/bin"
+	default_netdev = "vmnet-host"
+	default_devtype = "e1000"
+	default_share = "9p"
+
+	def machine(self, specs):
+		if specs.get('arch') == "qemu-system-aarch64":
+			return [
+				"-machine", "virt,highmem=on",
+				"-accel", "hvf",
+				"-cpu", "host",
+				"-bios", specs.get("firmware", "QEMU_EFI.fd"),
+				#"-drive", "file=/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-aarch64-code.fd,if=pflash,format=raw"
+				#"-serial", "chardev:console1"
+			]
+		elif specs.get('arch') == "qemu-system-x86_64":
+			return [
+				"-machine", "q35",
+				#"-device", "isa-serial,chardev=console1",
+			]
+		return []
+
+	def uefi(self, specs):
+		return [
+			#"-pflash", "/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-x86_64-code.fd",
+			"-drive", "file=/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-x86_64-code.fd,if=pflash,format=raw"
+		]
+
+	def display(self, specs):
+		if "video" not in specs:
+			return [
+				"-nographic",
+				"-vga", "none",
+			]
+		return [
+			"-display", specs.get("display", "cocoa"),
+			"-device", specs["video"]
+		]
+
+	def drive(self, hd):
+		drivedata = []
+		if hd.bustype == 'scsi-hd':
+			drivedata += ["-device", "virtio-scsi-pci"]
+		if hd.bustype == 'ide-hd':
+			drivedata += [
+				#"-device", "piix3-ide",
+				"-drive",  f"file={hd.file},if=ide,id={hd.id},cache=writeback",
+				#"-device", f"{hd.bustype},drive={hd.id},bootindex={hd.index},bus=ide.0"
+			]
+			return drivedata
+
+		drivedata += [
+			"-drive",  f"file={hd.file},if=none,id={hd.id},cache=writeback",
+			"-device", f"{hd.bustype},drive={hd.id},bootindex={hd.index}"
+		]
+		return drivedata
+
+	def nic(self, nic):
+		return [
+			"-netdev", nic.param_netdev(),
+			"-device", nic.param_device()
+		]
+
+	def share(self, share):
+		if share.type != "9p":
+			raise TypeError(f"{share.type} shares aren't supported on {self.name}")
+		fsdev = f"local,id={share.id},path={share.source},security_model=none"
+		if share.readonly:
+			fsdev += ",readonly=on"
+		return [
+			"-fsdev", fsdev,
+			"-device", f"virtio-9p-pci,fsdev={share.id},mount_tag={share.tag}"
+		]
+
+	def shared_memory(self, specs):
+		# Guest RAM other processes can map, for vhost-user devices.
+		return [
+			"-object", f"memory-backend-memfd,id=mem0,size={ram_size(specs)},share=on",
+			"-numa", "node,nodeid=0,memdev=mem0"
+		]
+
+	def channel(self, spec, path):
+		if spec.get("type", "virtserial") != "virtserial":
+			raise TypeError(f"{spec['type']} channels aren't supported on {self.name}")
+		return [
+			"-chardev", f"socket,path={path},server=on,wait=off,id=bulk0",
+			"-device", f"virtserialport,chardev=bulk0,name={bulk_port}"
+		]
+
+class KvmBackend(HvfBackend):
+	# Drives default to O_DIRECT with Linux native AIO in a dedicated
+	# iothread. "cache", "aio" ("native", "io_uring" or "threads") and
+	# "queues" in a drive spec override that. NICs are "user", "tap" (with
+	# vhost and "queues" for multiqueue) or "bridge".
+	name = "kvm"
+	qemu_path = "/usr/bin"
+	default_netdev = "user"
+	default_devtype = "virtio-net-pci"
+	default_share = "virtiofs"
+	default_cache = "none"
+	default_aio = "native"
+	firmware = {
+		"qemu-system-aarch64": "/usr/share/qemu-efi-aarch64/QEMU_EFI.fd",
+		"qemu-system-x86_64": "/usr/share/OVMF/OVMF_CODE.fd",
+	}
+
+	def machine(self, specs):
+		arch = specs.get('arch')
+		if arch == "qemu-system-aarch64":
+			return [
+				"-machine", "virt,gic-version=host",
+				"-accel", "kvm",
+				"-cpu", "host",
+				"-bios", specs.get("firmware", self.firmware[arch]),
+			]
+		elif arch == "qemu-system-x86_64":
+			return [
+				"-machine", "q35",
+				"-accel", "kvm",
+				"-cpu", "host",
+			]
+		return [ "-accel", "kvm" ]
+
+	def uefi(self, specs):
+		firmware = specs.get("firmware", self.firmware["qemu-system-x86_64"])
+		return [ "-drive", f"file={firmware},if=pflash,format=raw,readonly=on" ]
+
+	def display(self, specs):
+		if "video" not in specs:
+			return [
+				"-nographic",
+				"-vga", "none",
+			]
+		return [
+			"-display", specs.get("display", "gtk"),
+			"-device", specs["video"]
+		]
+
+	def drive(self, hd):
+		cache = hd.spec.get("cache", self.default_cache)
+		aio = hd.spec.get("aio", self.default_aio)
+		if aio == "native" and cache not in ("none", "directsync"):
+			# Native AIO needs O_DIRECT.
+			aio = "threads"
+		options = f"file={hd.file},if=none,id={hd.id},cache={cache},aio={aio},discard=unmap,detect-zeroes=unmap"
+		if hd.bustype == 'ide-hd':
+			return [ "-drive", options.replace("if=none", "if=ide") ]
+		iothread = f"io-{hd.id}"
+		drivedata = [ "-object", f"iothread,id={iothread}" ]
+		if hd.bustype == 'scsi-hd':
+			drivedata += [
+				"-device", f"virtio-scsi-pci,id=scsi-{hd.id},iothread={iothread}",
+				"-drive", options,
+				"-device", f"scsi-hd,drive={hd.id},bus=scsi-{hd.id}.0,bootindex={hd.index}"
+			]
+			return drivedata
+		device = f"{hd.bustype},drive={hd.id},bootindex={hd.index},iothread={iothread}"
+		if hd.spec.get("queues") is not None:
+			device += f",num-queues={hd.spec['queues']}"
+		drivedata += [
+			"-drive", options,
+			"-device", device
+		]
+		return drivedata
+
+	def nic(self, nic):
+		# Templates written for macOS keep working: vmnet-shared and
+		# vmnet-host become user networking, vmnet-bridged a bridge.
+		kind = { "vmnet-shared": "user", "vmnet-host": "user", "vmnet-bridged": "bridge" }.get(nic.type, nic.type)
+		netdev = [ kind, f"id={nic.id}" ]
+		if nic.type == "tap":
+			if nic.ifname is not None:
+				netdev.append(f"ifname={nic.ifname}")
+			netdev += [ "script=no", "downscript=no", "vhost=on" ]
+			if nic.queues is not None:
+				netdev.append(f"queues={nic.queues}")
+		elif kind == "bridge":
+			netdev.append(f"br={nic.bridge or nic.ifname or 'br0'}")
+		elif kind != "user":
+			raise TypeError(f"Unsupported netdev type {nic.type} on {self.name}")
+		device = nic.param_device()
+		if nic.queues is not None and kind == "tap":
+			device += f",mq=on,vectors={2 * int(nic.queues) + 2}"
+		return [
+			"-netdev", ",".join(netdev),
+			"-device", device
+		]
+
+	def share(self, share):
+		if share.type == "virtiofs":
+			return [
+				"-chardev", f"socket,id={share.id},path={share.socket_path}",
+				"-device", f"vhost-user-fs-pci,chardev={share.id},tag={share.tag},queue-size=1024"
+			]
+		return super().share(share)
+
+	def channel(self, spec, path):
+		if spec.get("type") == "vsock":
+			if "cid" not in spec:
+				raise TypeError("A vsock channel needs a cid")
+			return [ "-device", f"vhost-vsock-pci,guest-cid={spec['cid']}" ]
+		return super().channel(spec, path)
+
+classes = {
+	"hvf": HvfBackend,
+	"kvm": KvmBackend,
+}
+
+def get(name=None):
+	if name is None:
+		name = "hvf" if sys.platform == "darwin" else "kvm"
+	if name not in classes:
+		raise TypeError(f"Unknown backend {name}")
+	return classes[name]()
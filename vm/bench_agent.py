@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# Microbenchmarks for the guest agent clients, run against fake_agent, and
+# for the bulk data channel.
+import asyncio
+import json
+import socket
+import tempfile
+import threading
+import time
+import os
+import sys
+import agent
+import bulk
+import bulk_guest
+from fake_agent import FakeAgent
+
+def bench_ping(sockpath, count):
+	with agent.QemuAgent(sockpath) as q:
+		start = time.perf_counter()
+		for _ in range(count):
+			q.guest_ping()
+		elapsed = time.perf_counter() - start
+	print("guest-ping: %d calls in %.3fs (%.3f ms/call)" % (count, elapsed, elapsed * 1000 / count))
+
+def bench_facts(sockpath, count):
+	facts = ("guest_info", "guest_get_osinfo", "guest_get_host_name", "guest_get_timezone", "guest_get_disks")
+	for cache in (None, agent.FactCache()):
+		with agent.QemuAgent(sockpath, cache=cache) as q:
+			start = time.perf_counter()
+			for _ in range(count):
+				for fact in facts:
+					getattr(q, fact)()
+			elapsed = time.perf_counter() - start
+		print("facts %s: %d calls in %.3fs (%.3f ms/call)" % ("cached" if cache else "uncached",
+			count * len(facts), elapsed, elapsed * 1000 / (count * len(facts))))
+
+async def bench_async_ping(sockpaths, count):
+	agents = [ agent.AsyncQemuAgent(sockpath) for sockpath in sockpaths ]
+	await asyncio.gather(*[ a.connect() for a in agents ])
+	start = time.perf_counter()
+	await asyncio.gather(*[ a.guest_ping() for a in agents for _ in range(count) ])
+	elapsed = time.perf_counter() - start
+	await asyncio.gather(*[ a.close() for a in agents ])
+	total = count * len(agents)
+	print("async guest-ping: %d calls over %d agents in %.3fs (%.0f calls/s)" %
+		(total, len(agents), elapsed, total / elapsed))
+
+def bench_file_transfer(sockpath, tmp, size, chunk_size):
+	local = os.path.join(tmp, "upload.bin")
+	remote = os.path.join(tmp, "guest.bin")
+	back = os.path.join(tmp, "download.bin")
+	with open(local, "wb") as f:
+		for _ in range(size // chunk_size):
+			f.write(os.urandom(chunk_size))
+	with agent.QemuAgent(sockpath) as q:
+		start = time.perf_counter()
+		q.upload(local, remote, chunk_size=chunk_size)
+		up = time.perf_counter() - start
+		start = time.perf_counter()
+		q.download(remote, back, chunk_size=chunk_size)
+		down = time.perf_counter() - start
+	mb = size / (1024 * 1024)
+	print("upload: %.0f MB in %.3fs (%.1f MB/s)" % (mb, up, mb / up))
+	print("download: %.0f MB in %.3fs (%.1f MB/s)" % (mb, down, mb / down))
+	for path in [ local, remote, back ]:
+		os.remove(path)
+
+def bench_bulk(tmp, size):
+	# Same transfer as bench_file_transfer, over the bulk channel with the
+	# guest receiver running in a thread.
+	vm_dir = os.path.join(tmp, "bulkvm")
+	os.makedirs(vm_dir)
+	with open(os.path.join(vm_dir, "specs.json"), "w") as f:
+		json.dump({ "channel": { "type": "virtserial" } }, f)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(os.path.join(vm_dir, "bulkvm.bulk"))
+	server.listen(1)
+	threading.Thread(target=bulk_guest.serve_socket, args=(server,), daemon=True).start()
+	local = os.path.join(tmp, "upload.bin")
+	remote = os.path.join(tmp, "guest.bin")
+	back = os.path.join(tmp, "download.bin")
+	with open(local, "wb") as f:
+		for _ in range(size // bulk_guest.chunk_size):
+			f.write(os.urandom(bulk_guest.chunk_size))
+	with bulk.BulkChannel(vm_dir) as channel:
+		start = time.perf_counter()
+		channel.put(local, remote)
+		up = time.perf_counter() - start
+		start = time.perf_counter()
+		channel.get(remote, back)
+		down = time.perf_counter() - start
+	mb = size / (1024 * 1024)
+	print("bulk put: %.0f MB in %.3fs (%.1f MB/s)" % (mb, up, mb / up))
+	print("bulk get: %.0f MB in %.3fs (%.1f MB/s)" % (mb, down, mb / down))
+	for path in [ local, remote, back ]:
+		os.remove(path)
+
+def main(argv):
+	count = int(argv[1]) if len(argv) > 1 else 1000
+	nagents = int(argv[2]) if len(argv) > 2 else 50
+	with tempfile.TemporaryDirectory() as tmp:
+		sockpath = os.path.join(tmp, "bench.agent")
+		with FakeAgent(sockpath):
+			bench_ping(sockpath, count)
+			bench_facts(sockpath, count // 10)
+			bench_file_transfer(sockpath, tmp, 64 * 1024 * 1024, agent.default_chunk_size)
+		bench_bulk(tmp, 64 * 1024 * 1024)
+		fakes = [ FakeAgent(os.path.join(tmp, f"vm{i}.agent")) for i in range(nagents) ]
+		for fake in fakes:
+			fake.start()
+		try:
+			asyncio.run(bench_async_ping([ f.sockpath for f in fakes ], count // 10))
+		finally:
+			for fake in fakes:
+				fake.stop()
+
+if __name__ == "__main__":
+	main(sys.argv)
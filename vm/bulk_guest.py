@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+# Guest side of the bulk data channel. Runs in the guest with nothing but
+# the standard library and serves one host at a time on the "vm.bulk.0"
+# virtio serial port, or on a vsock port with --vsock.
+#
+# Requests and replies are guest agent style JSON lines with an "id":
+#   {"execute": "hello", "id": 1}
+#   {"execute": "put", "arguments": {"path": ..., "mode": 420}, "id": 2}
+#   {"execute": "get", "arguments": {"path": ...}, "id": 3}
+#   {"execute": "untar", "arguments": {"dir": ...}, "id": 4}
+#   {"execute": "tar", "arguments": {"dir": ...}, "id": 5}
+# put and untar are accepted with a reply, then the host sends a data
+# stream and gets a second reply once it has been written. get and tar are
+# answered with a reply followed by a data stream from the guest.
+#
+# A data stream is raw binary frames, a 4 byte big endian length and that
+# many bytes, ended by an empty frame and a {"size": ..., "sha256": ...}
+# line. The sender may have at most window bytes unacknowledged, and the
+# receiver hands out more with {"credit": bytes} lines as it writes the
+# data away, so a slow disk holds up the sender instead of filling qemu's
+# buffers. Both sides also skip stray credit lines between requests.
+import hashlib
+import io
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import tarfile
+import time
+
+protocol_version=1
+default_port="/dev/virtio-ports/vm.bulk.0"
+default_vsock_port=9999
+chunk_size=256*1024
+window=4*1024*1024
+read_buffer=1024*1024
+line_limit=65536
+reopen_delay=0.5
+frame_header=struct.Struct("!I")
+
+class Stream:
+	# timeout limits how long a read waits for the peer, None waits forever.
+	def __init__(self, fd, window=window, chunk_size=chunk_size, timeout=None):
+		self.fd = fd
+		self.timeout = timeout
+		self.buffer = bytearray()
+		self.window = window
+		self.chunk_size = chunk_size
+
+	def write(self, data):
+		view = memoryview(data)
+		while len(view) > 0:
+			n = os.write(self.fd, view)
+			view = view[n:]
+
+	def fill(self):
+		if self.timeout is not None and len(select.select([self.fd], [], [], self.timeout)[0]) == 0:
+			raise TimeoutError("No reply on the bulk channel")
+		data = os.read(self.fd, read_buffer)
+		if len(data) == 0:
+			raise EOFError("Peer disconnected")
+		self.buffer += data
+
+	def read(self, count):
+		while len(self.buffer) < count:
+			self.fill()
+		data = bytes(self.buffer[:count])
+		del self.buffer[:count]
+		return data
+
+	def send_json(self, message):
+		self.write((json.dumps(message) + "\n").encode("utf-8"))
+
+	def recv_json(self, credits=False):
+		# Credit lines are only returned when asked for, elsewhere they are
+		# leftovers of an earlier transfer.
+		while True:
+			end = self.buffer.find(b"\n")
+			if end < 0:
+				if len(self.buffer) > line_limit:
+					raise Exception("Line too long on the bulk channel")
+				self.fill()
+				continue
+			line = bytes(self.buffer[:end]).strip()
+			del self.buffer[:end + 1]
+			if len(line) == 0:
+				continue
+			message = json.loads(line)
+			if "credit" in message and not credits:
+				continue
+			return message
+
+	def send_data(self, chunks):
+		# Sends an iterable of bytes as a data stream. Returns the size and
+		# digest, the receiver checks them against what it got.
+		digest = hashlib.sha256()
+		size = 0
+		credit = self.window
+		chunks = iter(chunks)
+		while True:
+			try:
+				chunk = next(chunks, None)
+			except Exception as e:
+				# Ends the stream cleanly, the receiver raises the error.
+				self.write(frame_header.pack(0))
+				self.send_json({ "error": str(e) or e.__class__.__name__ })
+				raise
+			if chunk is None:
+				break
+			for start in range(0, len(chunk), self.chunk_size):
+				piece = chunk[start:start + self.chunk_size]
+				while credit < len(piece):
+					message = self.recv_json(credits=True)
+					if "credit" not in message:
+						raise Exception(f"Unexpected message during transfer: {message}")
+					credit += message["credit"]
+				self.write(frame_header.pack(len(piece)))
+				self.write(piece)
+				digest.update(piece)
+				size += len(piece)
+				credit -= len(piece)
+		self.write(frame_header.pack(0))
+		self.send_json({ "size": size, "sha256": digest.hexdigest() })
+		return size, digest.hexdigest()
+
+	def recv_data(self, sink):
+		# Feeds a data stream to sink. An error in sink doesn't stop the
+		# stream, the rest is read and dropped so both sides stay in sync,
+		# and the error is raised at the end.
+		digest = hashlib.sha256()
+		size = 0
+		unacked = 0
+		error = None
+		while True:
+			length = frame_header.unpack(self.read(frame_header.size))[0]
+			if length == 0:
+				break
+			data = self.read(length)
+			digest.update(data)
+			size += len(data)
+			if error is None:
+				try:
+					sink(data)
+				except Exception as e:
+					error = e
+			unacked += len(data)
+			if unacked >= self.window // 4:
+				self.send_json({ "credit": unacked })
+				unacked = 0
+		trailer = self.recv_json()
+		if error is not None:
+			raise error
+		check_trailer(trailer, size, digest)
+		return size, digest.hexdigest()
+
+def check_trailer(trailer, size, digest):
+	if "error" in trailer:
+		raise Exception(f"Sender failed: {trailer['error']}")
+	if trailer.get("size") != size or trailer.get("sha256") != digest.hexdigest():
+		raise Exception(f"Checksum mismatch: got {size} bytes {digest.hexdigest()}, sent {trailer}")
+
+class StreamReader:
+	# File-like view of an incoming data stream, for tarfile.
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffer = b""
+		self.pos = 0
+		self.digest = hashlib.sha256()
+		self.size = 0
+		self.unacked = 0
+		self.eof = False
+
+	def fill(self):
+		length = frame_header.unpack(self.stream.read(frame_header.size))[0]
+		if length == 0:
+			self.eof = True
+			return
+		data = self.stream.read(length)
+		self.digest.update(data)
+		self.size += len(data)
+		self.unacked += len(data)
+		if self.unacked >= self.stream.window // 4:
+			self.stream.send_json({ "credit": self.unacked })
+			self.unacked = 0
+		self.buffer = self.buffer[self.pos:] + data
+		self.pos = 0
+
+	def read(self, count=-1):
+		while not self.eof and (count < 0 or len(self.buffer) - self.pos < count):
+			self.fill()
+		if count < 0:
+			count = len(self.buffer) - self.pos
+		data = self.buffer[self.pos:self.pos + count]
+		self.pos += len(data)
+		return data
+
+	def finish(self):
+		# tarfile stops at the end of archive marker, the rest is padding.
+		while not self.eof:
+			self.fill()
+		self.buffer = b""
+		self.pos = 0
+		check_trailer(self.stream.recv_json(), self.size, self.digest)
+		return self.size, self.digest.hexdigest()
+
+def read_file(path, size=None):
+	# Yields size bytes of path, padded with zeros if it shrank meanwhile.
+	with open(path, "rb") as f:
+		left = size
+		while left is None or left > 0:
+			chunk = f.read(chunk_size if left is None else min(chunk_size, left))
+			if len(chunk) == 0:
+				break
+			if left is not None:
+				left -= len(chunk)
+			yield chunk
+	if left:
+		yield bytes(left)
+
+def tar_chunks(path):
+	# Builds the archive lazily, file contents go out chunk by chunk so
+	# neither the tar nor a whole file is ever held in memory.
+	tar = tarfile.open(fileobj=io.BytesIO(), mode="w|")
+	def entry(name):
+		info = tar.gettarinfo(name, os.path.relpath(name, path))
+		if info is None:
+			# Sockets and the like can't be archived.
+			return
+		yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+		if info.isreg():
+			yield from read_file(name, info.size)
+			if info.size % tarfile.BLOCKSIZE != 0:
+				yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		yield from entry(root)
+		for name in sorted(files):
+			yield from entry(os.path.join(root, name))
+		for name in dirs:
+			if os.path.islink(os.path.join(root, name)):
+				yield from entry(os.path.join(root, name))
+	yield bytes(2 * tarfile.BLOCKSIZE)
+
+def extract(reader, dest):
+	os.makedirs(dest, exist_ok=True)
+	with tarfile.open(fileobj=reader, mode="r|", bufsize=chunk_size) as tar:
+		if hasattr(tarfile, "data_filter"):
+			tar.extractall(dest, filter="data")
+		else:
+			tar.extractall(dest)
+
+def handle_put(stream, arguments):
+	path = arguments["path"]
+	tmp = f"{path}.bulk-tmp"
+	f = open(tmp, "wb")
+	yield {}
+	try:
+		try:
+			size, digest = stream.recv_data(f.write)
+		finally:
+			f.close()
+		if "mode" in arguments:
+			os.chmod(tmp, arguments["mode"])
+		os.replace(tmp, path)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	yield { "size": size, "sha256": digest }
+
+def handle_get(stream, arguments):
+	path = arguments["path"]
+	st = os.stat(path)
+	chunks = read_file(path)
+	yield { "size": st.st_size, "mode": st.st_mode & 0o7777 }
+	stream.send_data(chunks)
+
+def handle_untar(stream, arguments):
+	reader = StreamReader(stream)
+	yield {}
+	error = None
+	try:
+		extract(reader, arguments["dir"])
+	except Exception as e:
+		error = e
+	size, digest = reader.finish()
+	if error is not None:
+		raise error
+	yield { "size": size, "sha256": digest }
+
+def handle_tar(stream, arguments):
+	if not os.path.isdir(arguments["dir"]):
+		raise Exception(f"{arguments['dir']} is not a directory")
+	yield {}
+	stream.send_data(tar_chunks(arguments["dir"]))
+
+def handle_hello(stream, arguments):
+	yield { "version": protocol_version, "window": stream.window, "chunk": stream.chunk_size }
+
+handlers = {
+	"hello": handle_hello,
+	"put": handle_put,
+	"get": handle_get,
+	"untar": handle_untar,
+	"tar": handle_tar,
+}
+
+def error_reply(e, id):
+	return { "error": { "class": "GenericError", "desc": str(e) or e.__class__.__name__ }, "id": id }
+
+def serve(stream):
+	# Serves requests until the host goes away.
+	while True:
+		request = stream.recv_json()
+		id = request.get("id")
+		handler = handlers.get(request.get("execute"))
+		if handler is None:
+			stream.send_json(error_reply(Exception(f"Unknown command {request.get('execute')}"), id))
+			continue
+		replies = handler(stream, request.get("arguments", {}))
+		try:
+			for reply in replies:
+				stream.send_json({ "return": reply, "id": id })
+		except (EOFError, ConnectionError):
+			raise
+		except Exception as e:
+			stream.send_json(error_reply(e, id))
+
+def serve_port(path):
+	# The port reads as EOF while nothing is connected on the host side.
+	while True:
+		fd = os.open(path, os.O_RDWR)
+		try:
+			serve(Stream(fd))
+		except (EOFError, ConnectionError):
+			pass
+		finally:
+			os.close(fd)
+		time.sleep(reopen_delay)
+
+def serve_socket(sock):
+	while True:
+		conn, _ = sock.accept()
+		try:
+			serve(Stream(conn.fileno()))
+		except (EOFError, ConnectionError):
+			pass
+		finally:
+			conn.close()
+
+def main(argv):
+	if len(argv) > 1 and argv[1] == "--vsock":
+		sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+		sock.bind((socket.VMADDR_CID_ANY, int(argv[2]) if len(argv) > 2 else default_vsock_port))
+		sock.listen(1)
+		serve_socket(sock)
+	elif len(argv) > 2 and argv[1] == "--unix":
+		# For testing on the host.
+		if os.path.exists(argv[2]):
+			os.remove(argv[2])
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(argv[2])
+		sock.listen(1)
+		serve_socket(sock)
+	else:
+		serve_port(argv[1] if len(argv) > 1 else default_port)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
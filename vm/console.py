@@ -0,0 +1,215 @@
+# Console capture for qemu's stdio. Output is read in bulk as it arrives,
+# kept in a bounded ring buffer for tailing, appended to a size rotated log
+# file and handed to any number of subscribers.
+import collections
+import os
+import selectors
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+read_size=65536
+ring_bytes=1024*1024
+log_max_bytes=16*1024*1024
+log_backups=3
+log_buffer=65536
+subscriber_bytes=1024*1024
+flush_interval=1
+
+class RingBuffer:
+	def __init__(self, max_bytes=ring_bytes):
+		self.max_bytes = max_bytes
+		self.chunks = collections.deque()
+		self.size = 0
+
+	def append(self, data):
+		if len(data) >= self.max_bytes:
+			dropped = self.size + len(data) - self.max_bytes
+			self.chunks.clear()
+			self.chunks.append(bytes(data[-self.max_bytes:]))
+			self.size = self.max_bytes
+			return dropped
+		self.chunks.append(data)
+		self.size += len(data)
+		dropped = 0
+		while self.size > self.max_bytes:
+			excess = self.size - self.max_bytes
+			if len(self.chunks[0]) <= excess:
+				chunk = self.chunks.popleft()
+			else:
+				chunk = self.chunks[0][:excess]
+				self.chunks[0] = self.chunks[0][excess:]
+			self.size -= len(chunk)
+			dropped += len(chunk)
+		return dropped
+
+	def clear(self):
+		self.chunks.clear()
+		self.size = 0
+
+	def tail(self, count=None):
+		data = b"".join(self.chunks)
+		if count is not None:
+			data = data[-count:]
+		return data
+
+class RotatingLog:
+	def __init__(self, path, max_bytes=log_max_bytes, backups=log_backups):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.file = None
+		self.size = 0
+
+	def open(self):
+		self.file = open(self.path, "ab", buffering=log_buffer)
+		self.size = self.file.tell()
+
+	def rotate(self):
+		self.close()
+		for i in range(self.backups - 1, 0, -1):
+			src = f"{self.path}.{i}"
+			if os.path.exists(src):
+				os.replace(src, f"{self.path}.{i + 1}")
+		if self.backups > 0:
+			os.replace(self.path, f"{self.path}.1")
+		else:
+			os.remove(self.path)
+		self.open()
+
+	def write(self, data):
+		if self.file is None:
+			self.open()
+		if self.size > 0 and self.size + len(data) > self.max_bytes:
+			self.rotate()
+		self.file.write(data)
+		self.size += len(data)
+
+	def flush(self):
+		if self.file is not None:
+			self.file.flush()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+class Subscription:
+	# Either calls callback with every chunk, or queues chunks for get() and
+	# iteration. A reader that falls more than max_bytes behind loses the
+	# oldest chunks instead of holding up the console.
+	def __init__(self, console, callback=None, max_bytes=subscriber_bytes):
+		self.console = console
+		self.callback = callback
+		self.queue = RingBuffer(max_bytes)
+		self.cond = threading.Condition()
+		self.dropped = 0
+		self.closed = False
+
+	def put(self, data):
+		if self.callback is not None:
+			self.callback(data)
+			return
+		with self.cond:
+			self.dropped += self.queue.append(data)
+			self.cond.notify_all()
+
+	def get(self, timeout=None):
+		# Returns whatever is queued, or b"" once the console has closed.
+		with self.cond:
+			self.cond.wait_for(lambda: self.queue.size > 0 or self.closed, timeout)
+			data = self.queue.tail()
+			self.queue.clear()
+			return data
+
+	def __iter__(self):
+		while True:
+			data = self.get()
+			if len(data) == 0:
+				return
+			yield data
+
+	def close(self):
+		self.console.unsubscribe(self)
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+class Console:
+	def __init__(self, name, log_path=None, max_bytes=ring_bytes, log_max_bytes=log_max_bytes, backups=log_backups):
+		self.name = name
+		self.ring = RingBuffer(max_bytes)
+		self.log = RotatingLog(log_path, log_max_bytes, backups) if log_path is not None else None
+		self.subscribers = []
+		self.lock = threading.RLock()
+		self.dirty = False
+
+	def feed(self, data):
+		with self.lock:
+			self.ring.append(data)
+			subscribers = list(self.subscribers)
+		if self.log is not None:
+			self.log.write(data)
+			self.dirty = True
+		for subscriber in subscribers:
+			try:
+				subscriber.put(data)
+			except Exception as e:
+				log.warning("%s: dropping console subscriber: %s", self.name, e)
+				self.unsubscribe(subscriber)
+
+	def tail(self, count=None):
+		with self.lock:
+			return self.ring.tail(count)
+
+	def subscribe(self, callback=None, backlog=False, max_bytes=subscriber_bytes):
+		subscription = Subscription(self, callback, max_bytes)
+		with self.lock:
+			if backlog and self.ring.size > 0:
+				subscription.put(self.ring.tail())
+			self.subscribers.append(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription):
+		with self.lock:
+			if subscription in self.subscribers:
+				self.subscribers.remove(subscription)
+
+	def flush(self):
+		if self.log is not None and self.dirty:
+			self.log.flush()
+			self.dirty = False
+
+	def close(self):
+		for subscription in list(self.subscribers):
+			subscription.close()
+		if self.log is not None:
+			self.log.close()
+
+	def capture(self, proc):
+		# Blocks until qemu closes its stdout and stderr, then reaps it.
+		selector = selectors.DefaultSelector()
+		for pipe in (proc.stdout, proc.stderr):
+			if pipe is not None:
+				os.set_blocking(pipe.fileno(), False)
+				selector.register(pipe.fileno(), selectors.EVENT_READ)
+		try:
+			while len(selector.get_map()) > 0:
+				events = selector.select(flush_interval)
+				if len(events) == 0:
+					self.flush()
+					continue
+				for key, _ in events:
+					try:
+						data = os.read(key.fd, read_size)
+					except BlockingIOError:
+						continue
+					if len(data) == 0:
+						selector.unregister(key.fd)
+						continue
+					self.feed(data)
+		finally:
+			selector.close()
+			self.flush()
+		return proc.wait()
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# Stand-in for qemu-guest-agent listening on a UNIX socket. It speaks enough
+# of the QGA protocol to exercise the clients in this directory without a VM.
+import socketserver
+import threading
+import json
+import time
+import os
+import sys
+import logging
+import base64
+import subprocess
+import uuid
+import io
+
+log = logging.getLogger("fake_agent")
+logging.basicConfig(stream=sys.stderr)
+
+class FakeAgentHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		while True:
+			line = self.rfile.readline()
+			if len(line) == 0:
+				break
+			# 0xFF from the client resets the parser, as in qemu-ga.
+			line = line.rsplit(b"\xff", 1)[-1].strip()
+			if len(line) == 0:
+				continue
+			try:
+				message = json.loads(line)
+			except ValueError:
+				self.reply({"error": {"class": "GenericError", "desc": "Invalid JSON"}})
+				continue
+			if self.server.latency > 0:
+				time.sleep(self.server.latency)
+			out = self.server.agent.dispatch(message)
+			if isinstance(out, dict) and "id" in message:
+				out["id"] = message["id"]
+			self.reply(out)
+
+	def reply(self, out):
+		if out is None:
+			return
+		if isinstance(out, tuple):
+			prefix, out = out
+			self.wfile.write(prefix)
+		self.wfile.write((json.dumps(out) + "\r\n").encode('ascii'))
+		self.wfile.flush()
+
+class FakeAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class FakeAgent:
+	def __init__(self, sockpath, latency=0):
+		self.sockpath = sockpath
+		self.latency = latency
+		self.time_offset = 0
+		self.shutdown_mode = None
+		self.hostname = os.path.basename(sockpath).split('.')[0]
+		self.server = None
+		self.thread = None
+		self.files = {}
+		self.processes = {}
+		self.next_handle = 1000
+		self.boot_id = str(uuid.uuid4())
+		self.calls = {}
+		self.address = "10.0.2.15"
+		self.disk_total = 10 * 1024 * 1024 * 1024
+		self.disk_used = self.disk_total // 2
+		self.users = ["root"]
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+	def start(self):
+		if os.path.exists(self.sockpath):
+			os.remove(self.sockpath)
+		self.server = FakeAgentServer(self.sockpath, FakeAgentHandler)
+		self.server.agent = self
+		self.server.latency = self.latency
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		if self.server is None:
+			return
+		self.server.shutdown()
+		self.server.server_close()
+		self.server = None
+		if os.path.exists(self.sockpath):
+			os.remove(self.sockpath)
+
+	def reboot(self):
+		self.boot_id = str(uuid.uuid4())
+
+	def dispatch(self, message):
+		command = message.get("execute", "")
+		self.calls[command] = self.calls.get(command, 0) + 1
+		arguments = message.get("arguments", {})
+		handler = getattr(self, "cmd_" + command.replace("-", "_"), None)
+		if handler is None:
+			return {"error": {"class": "CommandNotFound", "desc": f"The command {command} has not been found"}}
+		try:
+			return handler(**arguments)
+		except Exception as e:
+			return {"error": {"class": "GenericError", "desc": str(e)}}
+
+	def cmd_guest_ping(self):
+		return {"return": {}}
+
+	def cmd_guest_info(self):
+		return {"return": {"version": "fake", "supported_commands": []}}
+
+	def cmd_guest_sync(self, id):
+		return {"return": id}
+
+	def cmd_guest_sync_delimited(self, id):
+		return (b"\xff", {"return": id})
+
+	def cmd_guest_get_time(self):
+		return {"return": int((time.time() + self.time_offset) * 1000000000)}
+
+	def cmd_guest_set_time(self, **arguments):
+		t = arguments.get("time")
+		if t is not None:
+			self.time_offset = t / 1000000000 - time.time()
+		return {"return": {}}
+
+	def cmd_guest_exec(self, path, arg=[], env=[], capture_output=False, **arguments):
+		pipe = subprocess.PIPE if capture_output or arguments.get("capture-output") else None
+		input_data = arguments.get("input-data")
+		proc = subprocess.Popen([ path ] + arg, env=dict(os.environ, **dict(e.split("=", 1) for e in env)),
+			stdin=subprocess.PIPE if input_data else subprocess.DEVNULL, stdout=pipe, stderr=pipe)
+		if input_data:
+			proc.stdin.write(base64.b64decode(input_data))
+			proc.stdin.close()
+		# Unlike qemu-ga, output is handed out as it arrives so that clients
+		# can be exercised against a process that streams.
+		state = {"proc": proc, "out": [], "err": [], "readers": []}
+		for name, pipe in [ ("out", proc.stdout), ("err", proc.stderr) ]:
+			if pipe is None:
+				continue
+			t = threading.Thread(target=self._drain, args=(pipe, state[name]), daemon=True)
+			t.start()
+			state["readers"].append(t)
+		self.processes[proc.pid] = state
+		return {"return": {"pid": proc.pid}}
+
+	def _drain(self, pipe, chunks):
+		while True:
+			data = os.read(pipe.fileno(), 65536)
+			if len(data) == 0:
+				break
+			chunks.append(data)
+
+	def cmd_guest_exec_status(self, pid):
+		state = self.processes[pid]
+		proc = state["proc"]
+		exited = proc.poll() is not None and not any(t.is_alive() for t in state["readers"])
+		ret = {"exited": exited}
+		for name in [ "out", "err" ]:
+			chunks = state[name]
+			n = len(chunks)
+			if n > 0:
+				data = b"".join(chunks[:n])
+				del chunks[:n]
+				ret[name + "-data"] = base64.b64encode(data).decode('ascii')
+		if exited:
+			ret["exitcode"] = proc.returncode
+			del self.processes[pid]
+		return {"return": ret}
+
+	def cmd_guest_file_open(self, path, mode="r"):
+		handle = self.next_handle
+		self.next_handle += 1
+		if path == "/proc/sys/kernel/random/boot_id":
+			self.files[handle] = io.BytesIO((self.boot_id + "\n").encode('ascii'))
+		else:
+			self.files[handle] = open(path, mode if "b" in mode else mode + "b")
+		return {"return": handle}
+
+	def cmd_guest_file_close(self, handle):
+		self.files.pop(handle).close()
+		return {"return": {}}
+
+	def cmd_guest_file_flush(self, handle):
+		self.files[handle].flush()
+		return {"return": {}}
+
+	def cmd_guest_file_read(self, handle, count=4096):
+		buf = self.files[handle].read(count)
+		return {"return": {
+			"count": len(buf),
+			"buf-b64": base64.b64encode(buf).decode('ascii'),
+			"eof": len(buf) < count
+		}}
+
+	def cmd_guest_file_write(self, handle, count=None, **arguments):
+		buf = base64.b64decode(arguments["buf-b64"])
+		if count is not None:
+			buf = buf[:count]
+		self.files[handle].write(buf)
+		return {"return": {"count": len(buf), "eof": False}}
+
+	def cmd_guest_file_seek(self, handle, offset, whence):
+		f = self.files[handle]
+		f.seek(offset, {"set": 0, "cur": 1, "end": 2}.get(whence, whence))
+		return {"return": {"position": f.tell(), "eof": False}}
+
+	def cmd_guest_shutdown(self, mode="powerdown"):
+		# Like qemu-ga, there is no reply when the shutdown goes ahead.
+		self.shutdown_mode = mode
+		return None
+
+	def cmd_guest_get_host_name(self):
+		return {"return": {"host-name": self.hostname}}
+
+	def cmd_guest_get_osinfo(self):
+		return {"return": {"id": "ubuntu", "name": "Ubuntu", "version-id": "24.04",
+			"kernel-release": os.uname().release, "machine": os.uname().machine}}
+
+	def cmd_guest_get_timezone(self):
+		return {"return": {"zone": time.tzname[0], "offset": -time.timezone}}
+
+	def cmd_guest_get_disks(self):
+		return {"return": [{"name": "/dev/vda", "partition": False, "address": {"bus-type": "virtio"}}]}
+
+	def cmd_guest_get_fsinfo(self):
+		return {"return": [{"name": "vda1", "mountpoint": "/", "type": "ext4",
+			"total-bytes": self.disk_total, "used-bytes": self.disk_used,
+			"disk": [{"dev": "/dev/vda1", "bus-type": "virtio"}]}]}
+
+	def cmd_guest_network_get_interfaces(self):
+		return {"return": [
+			{"name": "lo", "hardware-address": "00:00:00:00:00:00", "ip-addresses": [
+				{"ip-address-type": "ipv4", "ip-address": "127.0.0.1", "prefix": 8}]},
+			{"name": "eth0", "hardware-address": "52:54:00:12:34:56", "ip-addresses": [
+				{"ip-address-type": "ipv4", "ip-address": self.address, "prefix": 24}]}]}
+
+	def cmd_guest_get_users(self):
+		return {"return": [{"user": user, "login-time": time.time()} for user in self.users]}
+
+	def cmd_guest_get_vcpus(self):
+		return {"return": [{"logical-id": i, "online": True, "can-offline": i > 0} for i in range(2)]}
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		raise TypeError("must define socket path")
+	with FakeAgent(sys.argv[1]) as fake:
+		try:
+			fake.thread.join()
+		except KeyboardInterrupt:
+			pass
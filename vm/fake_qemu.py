@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# Stand-in for qemu-system-*. Symlink it as <qemu_path>/qemu-system-aarch64
+# to run VMs without qemu. It serves fake_agent and fake_qmp on the socket
+# chardevs of the command line, one client per QMP socket as qemu does,
+# prints a boot banner on stdout and exits when the guest is shut down or
+# quit. FAKE_QEMU_BOOT delays the agent by that many seconds,
+# FAKE_QEMU_CRASH makes it exit with 1 after that many.
+import fake_agent
+import fake_qmp
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+class FakeGuestQMP(fake_qmp.FakeQMP):
+	def cmd_system_powerdown(self):
+		super().cmd_system_powerdown()
+		self.status = "shutdown"
+		return {}
+
+def sockets(argv):
+	paths = {}
+	for arg in argv:
+		m = re.match(r"socket,path=([^,]+),.*id=(\w+)", arg)
+		if m is not None:
+			paths[m.group(2)] = m.group(1)
+	return paths
+
+def main(argv):
+	paths = sockets(argv)
+	boot = float(os.getenv("FAKE_QEMU_BOOT", "0.5"))
+	crash = os.getenv("FAKE_QEMU_CRASH")
+	deadline = None if crash is None else time.monotonic() + float(crash)
+	stopped = []
+	signal.signal(signal.SIGTERM, lambda *args: stopped.append(True))
+
+	qmp = FakeGuestQMP(paths["mon0"], exclusive=True) if "mon0" in paths else None
+	if qmp is not None:
+		qmp.start()
+		for id in sorted(paths):
+			if id != "mon0" and re.fullmatch(r"mon\d+", id):
+				qmp.listen(paths[id])
+	if "-incoming" in argv:
+		uri = argv[argv.index("-incoming") + 1]
+		if uri.startswith("exec:"):
+			subprocess.run(uri[len("exec:"):], shell=True, stdout=subprocess.DEVNULL)
+		print("Resumed from incoming migration", flush=True)
+		boot = 0
+	else:
+		print("Booting fake guest", flush=True)
+	ready = time.monotonic() + boot
+	agent = None
+	code = 0
+	try:
+		while len(stopped) == 0:
+			if agent is None and time.monotonic() >= ready and "agent0" in paths:
+				agent = fake_agent.FakeAgent(paths["agent0"])
+				agent.start()
+				print("Fake guest ready", flush=True)
+			if qmp is not None and qmp.status == "shutdown":
+				break
+			if agent is not None and agent.shutdown_mode is not None:
+				break
+			if deadline is not None and time.monotonic() > deadline:
+				print("Fake guest crashed", flush=True)
+				code = 1
+				break
+			time.sleep(0.05)
+	finally:
+		if agent is not None:
+			agent.stop()
+		if qmp is not None:
+			qmp.stop()
+	return code
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# Stand-in for a QEMU monitor (QMP) listening on a UNIX socket, enough to
+# exercise monitor.py and friends without running a VM.
+import socketserver
+import subprocess
+import threading
+import json
+import time
+import os
+import sys
+import logging
+
+log = logging.getLogger("fake_qmp")
+logging.basicConfig(stream=sys.stderr)
+
+greeting = {
+	"QMP": {
+		"version": {"qemu": {"micro": 0, "minor": 0, "major": 8}, "package": "fake"},
+		"capabilities": ["oob"]
+	}
+}
+
+class FakeQMPHandler(socketserver.StreamRequestHandler):
+	def setup(self):
+		super().setup()
+		self.lock = threading.Lock()
+		self.negotiated = False
+		if self.server.qmp.exclusive:
+			# Like a qemu chardev, later clients wait for the greeting until
+			# the current one goes away.
+			self.server.busy.acquire()
+		self.write(greeting)
+		self.server.qmp.clients.append(self)
+
+	def finish(self):
+		if self in self.server.qmp.clients:
+			self.server.qmp.clients.remove(self)
+		if self.server.qmp.exclusive:
+			self.server.busy.release()
+		super().finish()
+
+	def write(self, out):
+		with self.lock:
+			self.wfile.write((json.dumps(out) + "\r\n").encode('ascii'))
+			self.wfile.flush()
+
+	def handle(self):
+		# QMP is a stream of JSON objects, clients don't have to send newlines.
+		decoder = json.JSONDecoder()
+		buf = ""
+		while True:
+			data = self.request.recv(65536)
+			if len(data) == 0:
+				break
+			buf += data.decode('utf-8')
+			while True:
+				buf = buf.lstrip()
+				if len(buf) == 0:
+					break
+				try:
+					message, end = decoder.raw_decode(buf)
+				except ValueError:
+					break
+				buf = buf[end:]
+				self.process(message)
+
+	def process(self, message):
+		if message.get("execute") == "qmp_capabilities":
+			self.negotiated = True
+			out = {"return": {}}
+		else:
+			out = self.server.qmp.dispatch(message)
+		if "id" in message:
+			out["id"] = message["id"]
+		self.write(out)
+
+class FakeQMPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class FakeQMP:
+	# With exclusive set, each socket serves one client at a time as qemu
+	# does. Other sockets sharing the state can be added with listen().
+	def __init__(self, sockpath, exclusive=False):
+		self.sockpath = sockpath
+		self.exclusive = exclusive
+		self.servers = []
+		self.status = "running"
+		self.migration = None
+		self.started = time.monotonic()
+		self.clients = []
+		self.server = None
+		self.thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+	def start(self):
+		self.server = self.listen(self.sockpath)
+		self.thread = self.server.thread
+
+	def listen(self, sockpath):
+		if os.path.exists(sockpath):
+			os.remove(sockpath)
+		server = FakeQMPServer(sockpath, FakeQMPHandler)
+		server.qmp = self
+		server.busy = threading.Lock()
+		server.thread = threading.Thread(target=server.serve_forever, daemon=True)
+		server.thread.start()
+		self.servers.append(server)
+		return server
+
+	def stop(self):
+		if self.server is None:
+			return
+		for client in list(self.clients):
+			try:
+				client.request.shutdown(2)
+			except OSError:
+				pass
+		for server in self.servers:
+			server.shutdown()
+			server.server_close()
+			if os.path.exists(server.server_address):
+				os.remove(server.server_address)
+		self.servers = []
+		self.server = None
+
+	def emit(self, event, data=None):
+		now = time.time()
+		message = {
+			"event": event,
+			"data": data or {},
+			"timestamp": {"seconds": int(now), "microseconds": int(now * 1000000) % 1000000}
+		}
+		for client in list(self.clients):
+			if client.negotiated:
+				try:
+					client.write(message)
+				except OSError:
+					pass
+
+	def dispatch(self, message):
+		command = message.get("execute", "")
+		arguments = message.get("arguments", {})
+		handler = getattr(self, "cmd_" + command.replace("-", "_"), None)
+		if handler is None:
+			return {"error": {"class": "CommandNotFound", "desc": f"The command {command} has not been found"}}
+		try:
+			return {"return": handler(**arguments)}
+		except Exception as e:
+			return {"error": {"class": "GenericError", "desc": str(e)}}
+
+	def cmd_query_status(self):
+		return {"status": self.status, "singlestep": False, "running": self.status == "running"}
+
+	def cmd_query_blockstats(self):
+		# Counters grow steadily, at 100 reads and 50 writes of 4k a second.
+		t = time.monotonic() - self.started
+		return [{
+			"device": "d0",
+			"qdev": "/machine/peripheral-anon/device[0]/virtio-backend",
+			"stats": {
+				"rd_bytes": int(t * 409600),
+				"wr_bytes": int(t * 204800),
+				"rd_operations": int(t * 100),
+				"wr_operations": int(t * 50),
+				"flush_operations": int(t * 5),
+				"rd_total_time_ns": int(t * 100) * 200000,
+				"wr_total_time_ns": int(t * 50) * 500000,
+				"flush_total_time_ns": int(t * 5) * 1000000,
+			}
+		}]
+
+	def cmd_query_cpus_fast(self):
+		return [{
+			"cpu-index": 0,
+			"thread-id": self.thread.native_id,
+			"qom-path": "/machine/unattached/device[0]",
+			"target": "aarch64"
+		}]
+
+	def cmd_query_balloon(self):
+		return {"actual": 2 * 1024 * 1024 * 1024}
+
+	def cmd_query_stats(self, target, **arguments):
+		return [{
+			"provider": "kvm",
+			"stats": [
+				{"name": "remote_tlb_flush", "value": int(time.monotonic() - self.started)},
+				{"name": "max_mmu_page_hash_collisions", "value": 0}
+			]
+		}]
+
+	def cmd_stop(self):
+		self.status = "paused"
+		self.emit("STOP")
+		return {}
+
+	def cmd_cont(self):
+		self.status = "running"
+		self.emit("RESUME")
+		return {}
+
+	def cmd_system_reset(self):
+		self.emit("RESET", {"guest": False, "reason": "host-qmp-system-reset"})
+		return {}
+
+	def cmd_system_powerdown(self):
+		self.emit("POWERDOWN")
+		return {}
+
+	def cmd_migrate(self, uri, **arguments):
+		# Only exec: URIs, the state is a small JSON document.
+		if not uri.startswith("exec:"):
+			raise Exception(f"Unsupported migration URI {uri}")
+		self.migration = "active"
+		self.emit("MIGRATION", {"status": "active"})
+		state = json.dumps({"status": self.status, "time": time.time()}).encode('ascii')
+		def migrate():
+			res = subprocess.run(uri[len("exec:"):], shell=True, input=state)
+			self.migration = "completed" if res.returncode == 0 else "failed"
+			if self.migration == "completed":
+				self.status = "postmigrate"
+			self.emit("MIGRATION", {"status": self.migration})
+		threading.Thread(target=migrate, daemon=True).start()
+		return {}
+
+	def cmd_query_migrate(self):
+		if self.migration is None:
+			return {}
+		return {"status": self.migration}
+
+	def cmd_quit(self):
+		self.status = "shutdown"
+		self.emit("SHUTDOWN", {"guest": False, "reason": "host-qmp-quit"})
+		return {}
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		raise TypeError("must define socket path")
+	with FakeQMP(sys.argv[1]) as fake:
+		try:
+			fake.thread.join()
+		except KeyboardInterrupt:
+			pass
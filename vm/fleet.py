@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+import asyncio
+import agent
+import argparse
+import glob
+import logging
+import os
+import socket
+import sys
+
+log = logging.getLogger("fleet")
+logging.basicConfig(stream=sys.stderr)
+
+default_concurrency=32
+default_timeout=60
+mux_suffix=".mux"
+probe_timeout=1
+
+def listening(sockpath):
+	# A socket file left behind by a killed server refuses connections.
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.settimeout(probe_timeout)
+	try:
+		s.connect(sockpath)
+		return True
+	except OSError:
+		return False
+	finally:
+		s.close()
+
+def discover(vm_dirs, prefer_mux=False, suffix=".agent"):
+	sockets = {}
+	for vm_dir in vm_dirs:
+		vm_dir = os.path.abspath(vm_dir)
+		name = os.path.basename(vm_dir)
+		sockpath = os.path.join(vm_dir, f"{name}{suffix}")
+		if os.path.exists(sockpath):
+			sockets[name] = sockpath
+			continue
+		# Not a VM directory itself, look for VMs one level down.
+		for sockpath in sorted(glob.glob(os.path.join(vm_dir, "*", f"*{suffix}"))):
+			name = os.path.basename(os.path.dirname(sockpath))
+			if os.path.basename(sockpath) == f"{name}{suffix}":
+				sockets[name] = sockpath
+	if prefer_mux:
+		# Go through agent_broker when it is running for that VM.
+		for name, sockpath in sockets.items():
+			if os.path.exists(sockpath + mux_suffix) and listening(sockpath + mux_suffix):
+				sockets[name] = sockpath + mux_suffix
+	return sockets
+
+class HostResult:
+	def __init__(self, name):
+		self.name = name
+		self.exitcode = None
+		self.signal = None
+		self.stdout = b""
+		self.stderr = b""
+		self.error = None
+
+	def status(self):
+		if self.error is not None:
+			return "error"
+		if self.signal is not None:
+			return f"signal {self.signal}"
+		return f"exit {self.exitcode}"
+
+class FleetExecutor:
+	def __init__(self, sockets, concurrency=default_concurrency, timeout=default_timeout):
+		if not isinstance(sockets, dict):
+			raise TypeError("sockets must be a dictionary of name to socket path")
+		self.sockets = sockets
+		self.concurrency = concurrency
+		self.timeout = timeout
+
+	async def run_one(self, semaphore, name, path, arg, env, input_data):
+		result = HostResult(name)
+		async with semaphore:
+			try:
+				await asyncio.wait_for(
+					self._exec(result, self.sockets[name], path, arg, env, input_data),
+					self.timeout)
+			except asyncio.TimeoutError:
+				result.error = f"timed out after {self.timeout}s"
+			except Exception as e:
+				result.error = str(e) or e.__class__.__name__
+		log.debug("%s: %s", name, result.status())
+		return result
+
+	async def _exec(self, result, sockpath, path, arg, env, input_data):
+		out = []
+		err = []
+		async with agent.AsyncQemuAgent(sockpath) as q:
+			proc = await q.exec_stream(path, arg, env, input_data)
+			async for stream, data in proc:
+				(out if stream == "out" else err).append(data)
+		result.stdout = b"".join(out)
+		result.stderr = b"".join(err)
+		result.exitcode = proc.exitcode
+		result.signal = proc.signal
+
+	async def run(self, path, arg=[], env=[], input_data=None):
+		semaphore = asyncio.Semaphore(self.concurrency)
+		results = await asyncio.gather(*[
+			self.run_one(semaphore, name, path, arg, env, input_data)
+			for name in sorted(self.sockets)
+		])
+		return results
+
+def aggregate(results):
+	groups = {}
+	for result in results:
+		groups.setdefault(result.status(), []).append(result)
+	return groups
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Run a command on many VMs through their guest agents.")
+	parser.add_argument("-d", "--vm", action="append", required=True,
+		help="VM directory, or a directory holding VM directories. Can be repeated.")
+	parser.add_argument("-j", "--concurrency", type=int, default=default_concurrency)
+	parser.add_argument("-t", "--timeout", type=float, default=default_timeout,
+		help="Per host timeout in seconds.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Print the output of every host.")
+	parser.add_argument("command", nargs=argparse.REMAINDER)
+	args = parser.parse_args(argv[1:])
+	if len(args.command) > 0 and args.command[0] == "--":
+		args.command = args.command[1:]
+	if len(args.command) == 0:
+		parser.error("Missing command")
+	if os.getenv('AGENT_DEBUG') == '1':
+		log.setLevel('DEBUG')
+
+	sockets = discover(args.vm, prefer_mux=True)
+	if len(sockets) == 0:
+		log.error("No guest agent sockets found.")
+		return 1
+	executor = FleetExecutor(sockets, args.concurrency, args.timeout)
+	results = asyncio.run(executor.run(args.command[0], args.command[1:]))
+
+	groups = aggregate(results)
+	for status in sorted(groups):
+		hosts = groups[status]
+		print(f"{status}: {len(hosts)} host(s): {' '.join(r.name for r in hosts)}")
+		for r in hosts:
+			if r.error is not None:
+				print(f"  {r.name}: {r.error}")
+			elif args.verbose:
+				for line in (r.stdout + r.stderr).decode('utf-8', errors='replace').splitlines():
+					print(f"  {r.name}: {line}")
+	failed = [ r for r in results if r.error is not None or r.exitcode != 0 ]
+	return 1 if len(failed) > 0 else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
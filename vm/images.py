@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# Registry of the base images and intermediate overlay layers in images/.
+# A layer is a read-only qcow2 overlay on top of another registered image,
+# e.g. a cloud image with packages already installed, that VM drives can
+# use as "baseimage" so every clone starts from the warmed state.
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import time
+from subprocess import Popen, PIPE
+
+log = logging.getLogger("images")
+logging.basicConfig(stream=sys.stderr)
+
+registry_file="registry.json"
+hash_chunk=4*1024*1024
+
+def qemu_img(args):
+	cmd = [ "qemu-img" ] + args
+	log.debug("Command: %s", str(cmd))
+	res = Popen(cmd, stdout=PIPE, stderr=PIPE)
+	stdout, stderr = res.communicate()
+	if res.returncode != 0:
+		raise Exception("Error(%s) running qemu-img %s: %s" %
+			(res.returncode, args[0], stderr.decode('utf-8', errors='replace').rstrip()))
+	return stdout.decode('utf-8')
+
+def backing_chain(path):
+	# [ path, backing, backing of backing, ... ] as absolute paths.
+	info = json.loads(qemu_img([ "info", "--output=json", "--backing-chain", "-U", path ]))
+	return [ os.path.abspath(i["filename"]) for i in info ]
+
+def sha256_file(path):
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(hash_chunk)
+			if len(chunk) == 0:
+				break
+			h.update(chunk)
+	return h.hexdigest()
+
+def open_files():
+	# Files open by any process we can see, from /proc. Running qemus hold
+	# their whole backing chain open.
+	opened = set()
+	if not os.path.isdir("/proc/self/fd"):
+		return opened
+	for pid in os.listdir("/proc"):
+		if not pid.isdigit():
+			continue
+		try:
+			fds = os.listdir(f"/proc/{pid}/fd")
+		except OSError:
+			continue
+		for fd in fds:
+			try:
+				opened.add(os.readlink(f"/proc/{pid}/fd/{fd}"))
+			except OSError:
+				pass
+	return opened
+
+class Registry:
+	def __init__(self, path):
+		self.path = os.path.abspath(path)
+		self.file = os.path.join(self.path, registry_file)
+		self.layers = {}
+		if os.path.isfile(self.file):
+			with open(self.file, "r") as f:
+				self.layers = json.load(f).get("layers", {})
+
+	def save(self):
+		tmp = self.file + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump({"layers": self.layers}, f, indent=2, sort_keys=True)
+		os.replace(tmp, self.file)
+
+	def filename(self, name):
+		return os.path.join(self.path, self.layers[name]["file"])
+
+	def resolve(self, name):
+		# A registered layer name, or a file name relative to images/.
+		if name in self.layers:
+			return self.filename(name)
+		return os.path.abspath(os.path.join(self.path, name))
+
+	def name_of(self, path):
+		path = os.path.abspath(path)
+		for name in self.layers:
+			if self.filename(name) == path:
+				return name
+		return None
+
+	def checksum(self, name, force=False):
+		# Hashing multi-GB images is slow, so reuse the stored digest while
+		# size and mtime are unchanged.
+		layer = self.layers[name]
+		st = os.stat(self.filename(name))
+		if not force and layer.get("sha256") and layer.get("size") == st.st_size and layer.get("mtime") == st.st_mtime:
+			return layer["sha256"]
+		layer["sha256"] = sha256_file(self.filename(name))
+		layer["size"] = st.st_size
+		layer["mtime"] = st.st_mtime
+		return layer["sha256"]
+
+	def register(self, name, file, description=None):
+		path = os.path.abspath(os.path.join(self.path, file))
+		if not os.path.isfile(path):
+			raise TypeError(f"Image {path} doesn't exist")
+		if os.path.dirname(path) != self.path:
+			raise TypeError(f"Image {path} must live in {self.path}")
+		chain = backing_chain(path)
+		parent = None
+		if len(chain) > 1:
+			parent = self.name_of(chain[1])
+			if parent is None:
+				raise Exception(f"Backing file {chain[1]} of {file} isn't registered")
+		self.layers[name] = {
+			"file": os.path.basename(path),
+			"parent": parent,
+			"description": description,
+			"created": time.time(),
+		}
+		self.checksum(name)
+		self.save()
+		log.info("Registered %s (%s)", name, os.path.basename(path))
+		return self.layers[name]
+
+	def read_only(self, name):
+		# Layers are shared by every clone and must never change.
+		path = self.filename(name)
+		os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+	def freeze(self, name):
+		# Makes a customized layer read-only and records its new checksum.
+		if name not in self.layers:
+			raise TypeError(f"Layer {name} isn't registered")
+		self.read_only(name)
+		self.checksum(name, force=True)
+		self.save()
+		log.info("Froze %s", name)
+		return self.layers[name]
+
+	def create_layer(self, name, parent, description=None):
+		# An empty overlay to be customized, then frozen with freeze().
+		if name in self.layers:
+			raise TypeError(f"Layer {name} already exists")
+		if parent not in self.layers:
+			raise TypeError(f"Parent {parent} isn't registered")
+		file = f"{name}.qcow2"
+		qemu_img([ "create", "-f", "qcow2", "-b", self.filename(parent), "-F", "qcow2",
+			os.path.join(self.path, file) ])
+		return self.register(name, file, description)
+
+	def promote(self, name, drive, description=None):
+		# Turns the overlay drive of a provisioned, shut down VM into a layer.
+		if name in self.layers:
+			raise TypeError(f"Layer {name} already exists")
+		chain = backing_chain(drive)
+		if len(chain) < 2 or self.name_of(chain[1]) is None:
+			raise Exception(f"{drive} isn't backed by a registered image")
+		file = f"{name}.qcow2"
+		dest = os.path.join(self.path, file)
+		shutil.copyfile(drive, dest)
+		# Point the copy at its parent by absolute path, as HardDrive does.
+		qemu_img([ "rebase", "-u", "-f", "qcow2", "-b", chain[1], "-F", "qcow2", dest ])
+		layer = self.register(name, file, description)
+		self.read_only(name)
+		return layer
+
+	def verify(self):
+		bad = []
+		for name in sorted(self.layers):
+			path = self.filename(name)
+			if not os.path.isfile(path):
+				bad.append((name, "missing"))
+				continue
+			if sha256_file(path) != self.layers[name].get("sha256"):
+				bad.append((name, "checksum mismatch"))
+		return bad
+
+	def in_use(self, vm_dirs):
+		used = set()
+		for vm_dir in vm_dirs:
+			for root, _, files in os.walk(vm_dir):
+				for f in files:
+					if not f.endswith((".img", ".qcow2")):
+						continue
+					path = os.path.join(root, f)
+					try:
+						chain = backing_chain(path)
+					except Exception:
+						continue
+					for p in chain[1:]:
+						name = self.name_of(p)
+						if name is not None:
+							used.add(name)
+		return used
+
+	def gc(self, vm_dirs, dry_run=False):
+		# Removes derived layers that neither VM drives nor other layers use.
+		# vm_dirs must hold every VM, layers some process has open are kept
+		# anyway. Base images (no parent) are never collected.
+		used = self.in_use(vm_dirs)
+		opened = open_files()
+		for name in self.layers:
+			if self.filename(name) in opened and name not in used:
+				log.warning("Keeping %s, it is open by a running process", name)
+				used.add(name)
+		layers = dict(self.layers)
+		removed = []
+		while True:
+			orphans = [ n for n, layer in layers.items() if layer.get("parent") is not None
+				and n not in used and not any(l.get("parent") == n for l in layers.values()) ]
+			if len(orphans) == 0:
+				break
+			for name in orphans:
+				log.info("Removing orphaned layer %s", name)
+				if not dry_run:
+					path = self.filename(name)
+					if os.path.isfile(path):
+						os.remove(path)
+				del layers[name]
+				removed.append(name)
+		if not dry_run:
+			self.layers = layers
+			self.save()
+		return removed
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Manage base images and overlay layers.")
+	parser.add_argument("-d", "--images", default=os.path.abspath("images"), help="Images directory.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	sub.add_parser("list")
+	p = sub.add_parser("register", help="Register an image file in the images directory.")
+	p.add_argument("name")
+	p.add_argument("file")
+	p.add_argument("-m", "--description")
+	p = sub.add_parser("layer", help="Create an empty overlay layer on top of a registered image.")
+	p.add_argument("name")
+	p.add_argument("parent")
+	p.add_argument("-m", "--description")
+	p = sub.add_parser("freeze", help="Make a customized layer read-only and update its checksum.")
+	p.add_argument("name")
+	p = sub.add_parser("promote", help="Turn a VM's overlay drive into a read-only layer.")
+	p.add_argument("name")
+	p.add_argument("drive")
+	p.add_argument("-m", "--description")
+	sub.add_parser("verify", help="Check the checksums of all registered images.")
+	p = sub.add_parser("gc", help="Remove layers no VM or other layer uses.")
+	p.add_argument("--all-vms", action="append", required=True, metavar="DIR",
+		help="Directory holding VM drives, can be repeated. Together they must hold every VM, "
+		"layers used by the ones left out are removed.")
+	p.add_argument("-n", "--dry-run", action="store_true")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+
+	registry = Registry(args.images)
+	if args.command == "list":
+		for name in sorted(registry.layers):
+			layer = registry.layers[name]
+			print("%-24s %-32s parent=%s sha256=%s" % (name, layer["file"], layer.get("parent"),
+				(layer.get("sha256") or "")[:12]))
+	elif args.command == "register":
+		registry.register(args.name, args.file, args.description)
+	elif args.command == "layer":
+		registry.create_layer(args.name, args.parent, args.description)
+	elif args.command == "freeze":
+		registry.freeze(args.name)
+	elif args.command == "promote":
+		registry.promote(args.name, args.drive, args.description)
+	elif args.command == "verify":
+		bad = registry.verify()
+		for name, problem in bad:
+			print(f"{name}: {problem}")
+		return 1 if len(bad) > 0 else 0
+	elif args.command == "gc":
+		for name in registry.gc(args.all_vms, args.dry_run):
+			print(name)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# Index of what the guest agents report about every VM: filesystems,
+# addresses, OS, users and vCPUs, kept in SQLite so questions about the
+# whole fleet are answered without talking to any guest. A refresh only
+# polls VMs whose entry is older than max_age, failed last time, or whose
+# agent socket was recreated since, which qemu does on every start.
+import agent
+import argparse
+import asyncio
+import fleet
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+log = logging.getLogger("inventory")
+logging.basicConfig(stream=sys.stderr)
+
+default_db="inventory.db"
+default_max_age=300
+default_concurrency=32
+default_timeout=10
+schema_version=1
+commands = [
+	"guest-get-fsinfo",
+	"guest-network-get-interfaces",
+	"guest-get-osinfo",
+	"guest-get-users",
+	"guest-get-vcpus",
+]
+
+schema = """
+CREATE TABLE IF NOT EXISTS vms (
+	name TEXT PRIMARY KEY,
+	sockpath TEXT NOT NULL,
+	signature TEXT,
+	polled_at REAL,
+	attempted_at REAL,
+	error TEXT,
+	hostname TEXT,
+	os_id TEXT,
+	os_name TEXT,
+	os_version TEXT,
+	kernel TEXT,
+	machine TEXT,
+	vcpus INTEGER,
+	vcpus_online INTEGER,
+	facts TEXT
+);
+CREATE TABLE IF NOT EXISTS filesystems (
+	vm TEXT NOT NULL,
+	mountpoint TEXT NOT NULL,
+	device TEXT,
+	type TEXT,
+	total_bytes INTEGER,
+	used_bytes INTEGER,
+	free_percent REAL
+);
+CREATE INDEX IF NOT EXISTS filesystems_vm ON filesystems (vm);
+CREATE INDEX IF NOT EXISTS filesystems_free ON filesystems (mountpoint, free_percent);
+CREATE TABLE IF NOT EXISTS addresses (
+	vm TEXT NOT NULL,
+	interface TEXT NOT NULL,
+	mac TEXT,
+	address TEXT,
+	prefix INTEGER,
+	family TEXT
+);
+CREATE INDEX IF NOT EXISTS addresses_vm ON addresses (vm);
+CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address);
+CREATE INDEX IF NOT EXISTS addresses_mac ON addresses (mac);
+CREATE TABLE IF NOT EXISTS users (
+	vm TEXT NOT NULL,
+	user TEXT NOT NULL,
+	domain TEXT,
+	login_time REAL
+);
+CREATE INDEX IF NOT EXISTS users_vm ON users (vm);
+CREATE INDEX IF NOT EXISTS users_user ON users (user);
+"""
+detail_tables = [ "filesystems", "addresses", "users" ]
+
+def signature(sockpath):
+	# Of qemu's own agent socket, which it recreates on every start. A
+	# broker's .mux socket outlives restarts.
+	if sockpath.endswith(fleet.mux_suffix):
+		sockpath = sockpath[:-len(fleet.mux_suffix)]
+	try:
+		st = os.stat(sockpath)
+	except OSError:
+		return None
+	return f"{st.st_dev}:{st.st_ino}:{st.st_mtime_ns}"
+
+def open_db(path):
+	db = sqlite3.connect(path)
+	db.row_factory = sqlite3.Row
+	version = db.execute("PRAGMA user_version").fetchone()[0]
+	if version not in (0, schema_version):
+		# Only a cache, so it is simply rebuilt.
+		log.debug("Dropping inventory schema version %d", version)
+		for table in [ "vms" ] + detail_tables:
+			db.execute(f"DROP TABLE IF EXISTS {table}")
+	db.executescript(schema)
+	db.execute(f"PRAGMA user_version = {schema_version}")
+	db.commit()
+	return db
+
+class Inventory:
+	def __init__(self, path=default_db, max_age=default_max_age,
+			concurrency=default_concurrency, timeout=default_timeout):
+		self.db = open_db(path)
+		self.max_age = max_age
+		self.concurrency = concurrency
+		self.timeout = timeout
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def close(self):
+		self.db.close()
+
+	def stale(self, sockets, force=False, now=None):
+		# Names of the VMs of sockets that need polling.
+		if force:
+			return sorted(sockets)
+		now = time.time() if now is None else now
+		known = { row["name"]: row for row in self.db.execute(
+			"SELECT name, sockpath, signature, polled_at, error FROM vms") }
+		out = []
+		for name in sorted(sockets):
+			row = known.get(name)
+			if (row is None or row["error"] is not None or row["polled_at"] is None
+				or now - row["polled_at"] > self.max_age
+				or row["sockpath"] != sockets[name]
+				or row["signature"] != signature(sockets[name])):
+				out.append(name)
+		return out
+
+	async def poll_one(self, semaphore, name, sockpath):
+		# Commands the agent doesn't have are left out, anything else
+		# failing is an error for the whole VM.
+		facts = {}
+		errors = []
+		sig = signature(sockpath)
+		async with semaphore:
+			try:
+				async with agent.AsyncQemuAgent(sockpath, self.timeout) as q:
+					replies = await asyncio.gather(*[ q.request(c) for c in commands ])
+				for command, out in zip(commands, replies):
+					if "error" in out:
+						errors.append(f"{command}: {out['error'].get('desc')}")
+						if out["error"].get("class") != "CommandNotFound":
+							facts = None
+					elif facts is not None:
+						facts[command] = out.get("return")
+			except asyncio.TimeoutError:
+				facts = None
+				errors.append(f"timed out after {self.timeout}s")
+			except Exception as e:
+				facts = None
+				errors.append(str(e) or e.__class__.__name__)
+		log.debug("%s: %s", name, "; ".join(errors) or "ok")
+		return name, sockpath, sig, facts, "; ".join(errors) or None
+
+	async def poll(self, sockets, names):
+		semaphore = asyncio.Semaphore(self.concurrency)
+		return await asyncio.gather(*[ self.poll_one(semaphore, name, sockets[name]) for name in names ])
+
+	def refresh(self, sockets, force=False):
+		# Polls what is stale and forgets VMs that are gone. Returns the
+		# names polled and the names that failed.
+		names = self.stale(sockets, force)
+		results = asyncio.run(self.poll(sockets, names)) if len(names) > 0 else []
+		now = time.time()
+		failed = []
+		with self.db:
+			for name in [ row[0] for row in self.db.execute("SELECT name FROM vms") ]:
+				if name not in sockets:
+					self.forget(name)
+			for name, sockpath, sig, facts, error in results:
+				if facts is None:
+					failed.append(name)
+					# Keeps what was known, polled again next time.
+					self.db.execute("INSERT INTO vms (name, sockpath, attempted_at, error) VALUES (?, ?, ?, ?) "
+						"ON CONFLICT (name) DO UPDATE SET sockpath = excluded.sockpath, "
+						"attempted_at = excluded.attempted_at, error = excluded.error",
+						(name, sockpath, now, error))
+				else:
+					self.store(name, sockpath, sig, facts, now)
+		return names, failed
+
+	def forget(self, name):
+		for table in detail_tables:
+			self.db.execute(f"DELETE FROM {table} WHERE vm = ?", (name,))
+		self.db.execute("DELETE FROM vms WHERE name = ?", (name,))
+
+	def store(self, name, sockpath, sig, facts, now):
+		self.forget(name)
+		osinfo = facts.get("guest-get-osinfo") or {}
+		vcpus = facts.get("guest-get-vcpus")
+		self.db.execute("INSERT INTO vms (name, sockpath, signature, polled_at, attempted_at, "
+			"os_id, os_name, os_version, kernel, machine, vcpus, vcpus_online, facts) "
+			"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(name, sockpath, sig, now, now, osinfo.get("id"), osinfo.get("pretty-name", osinfo.get("name")),
+			osinfo.get("version-id"), osinfo.get("kernel-release"), osinfo.get("machine"),
+			None if vcpus is None else len(vcpus),
+			None if vcpus is None else sum(1 for cpu in vcpus if cpu.get("online")),
+			json.dumps(facts)))
+		for fs in facts.get("guest-get-fsinfo") or []:
+			total = fs.get("total-bytes")
+			used = fs.get("used-bytes")
+			free = None
+			if total and used is not None:
+				free = 100.0 * (total - used) / total
+			self.db.execute("INSERT INTO filesystems VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(name, fs.get("mountpoint"), fs.get("name"), fs.get("type"), total, used, free))
+		for nic in facts.get("guest-network-get-interfaces") or []:
+			for ip in nic.get("ip-addresses", []):
+				self.db.execute("INSERT INTO addresses VALUES (?, ?, ?, ?, ?, ?)",
+					(name, nic.get("name"), nic.get("hardware-address"), ip.get("ip-address"),
+					ip.get("prefix"), ip.get("ip-address-type")))
+		for user in facts.get("guest-get-users") or []:
+			self.db.execute("INSERT INTO users VALUES (?, ?, ?, ?)",
+				(name, user.get("user"), user.get("domain"), user.get("login-time")))
+
+	def low_space(self, mountpoint, percent):
+		return self.db.execute("SELECT vm, mountpoint, device, total_bytes, used_bytes, free_percent "
+			"FROM filesystems WHERE mountpoint = ? AND free_percent < ? ORDER BY free_percent",
+			(mountpoint, percent)).fetchall()
+
+	def by_address(self, address):
+		return self.db.execute("SELECT vm, interface, mac, address, prefix FROM addresses "
+			"WHERE address = ? OR mac = ? ORDER BY vm", (address, address.lower())).fetchall()
+
+	def by_user(self, user):
+		return self.db.execute("SELECT vm, user, domain, login_time FROM users "
+			"WHERE user = ? ORDER BY vm", (user,)).fetchall()
+
+	def vms(self):
+		return self.db.execute("SELECT name, os_name, kernel, vcpus_online, vcpus, polled_at, error "
+			"FROM vms ORDER BY name").fetchall()
+
+	def query(self, sql, params=()):
+		return self.db.execute(sql, params).fetchall()
+
+def print_rows(rows):
+	for row in rows:
+		print("\t".join("" if value is None else str(value) for value in row))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Index guest agent facts of many VMs in SQLite.")
+	parser.add_argument("--db", default=default_db, help="SQLite file of the index.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p = sub.add_parser("refresh", help="Poll the VMs whose entry is stale or changed.")
+	p.add_argument("-d", "--vm", action="append", required=True,
+		help="VM directory, or a directory holding VM directories. Can be repeated.")
+	p.add_argument("-a", "--max-age", type=float, default=default_max_age,
+		help="Seconds before an entry is polled again.")
+	p.add_argument("-f", "--force", action="store_true", help="Poll every VM.")
+	p.add_argument("-j", "--concurrency", type=int, default=default_concurrency)
+	p.add_argument("-t", "--timeout", type=float, default=default_timeout, help="Per VM timeout in seconds.")
+	sub.add_parser("list", help="Show the indexed VMs.")
+	p = sub.add_parser("free", help="VMs with less than some free space on a filesystem.")
+	p.add_argument("-m", "--mountpoint", default="/")
+	p.add_argument("-p", "--percent", type=float, default=10)
+	p = sub.add_parser("ip", help="VMs with an IP or MAC address.")
+	p.add_argument("address")
+	p = sub.add_parser("user", help="VMs a user is logged in to.")
+	p.add_argument("user")
+	p = sub.add_parser("sql", help="Run a query on the index.")
+	p.add_argument("sql")
+	args = parser.parse_args(argv[1:])
+	if os.getenv('AGENT_DEBUG') == '1':
+		log.setLevel('DEBUG')
+
+	if args.command == "refresh":
+		with Inventory(args.db, args.max_age, args.concurrency, args.timeout) as inventory:
+			start = time.monotonic()
+			sockets = fleet.discover(args.vm, prefer_mux=True)
+			polled, failed = inventory.refresh(sockets, args.force)
+			print(f"{len(sockets)} VM(s), polled {len(polled)} in {time.monotonic() - start:.2f}s, {len(failed)} failed")
+			for row in inventory.query("SELECT name, error FROM vms WHERE error IS NOT NULL ORDER BY name"):
+				print(f"  {row['name']}: {row['error']}")
+		return 1 if len(failed) > 0 else 0
+
+	with Inventory(args.db) as inventory:
+		if args.command == "list":
+			rows = inventory.vms()
+		elif args.command == "free":
+			rows = inventory.low_space(args.mountpoint, args.percent)
+		elif args.command == "ip":
+			rows = inventory.by_address(args.address)
+		elif args.command == "user":
+			rows = inventory.by_user(args.user)
+		else:
+			rows = inventory.query(args.sql)
+	print_rows(rows)
+	return 0 if len(rows) > 0 else 1
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
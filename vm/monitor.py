@@ -1,8 +1,36 @@
 import asyncio
-from qemu.qmp import QMPClient
+from qemu.qmp import QMPClient, Runstate
+import argparse
+import fleet
+import fnmatch
+import json
+import logging
 import os
 import sys
 
+log = logging.getLogger("monitor")
+logging.basicConfig(stream=sys.stderr)
+
+default_events = [
+	"SHUTDOWN",
+	"POWERDOWN",
+	"RESET",
+	"STOP",
+	"RESUME",
+	"SUSPEND",
+	"WAKEUP",
+	"GUEST_PANICKED",
+	"BLOCK_JOB_*",
+	"BLOCK_IO_ERROR",
+]
+rescan_seconds=10
+# The QMP socket qemu keeps for this service, see vm_start_macos.py.
+events_suffix=".qmp-events"
+reconnect_min=0.1
+reconnect_max=10
+# A socket client that falls this far behind is disconnected.
+client_buffer_max=1024*1024
+
 async def main(vmname, *args):
 	qmp = QMPClient(vmname)
 	sockfile = os.path.join(vmname, f"{vmname}.monitor")
@@ -22,7 +50,196 @@ async def query_status(qmp):
 
 	await qmp.disconnect()
 
+class JsonLinesSink:
+	def __init__(self, stream):
+		self.stream = stream
+
+	async def start(self):
+		pass
+
+	async def stop(self):
+		pass
+
+	def publish(self, record):
+		self.stream.write(json.dumps(record) + "\n")
+		self.stream.flush()
+
+class SocketSink:
+	# Every client connected to the UNIX socket gets all records as JSON lines.
+	def __init__(self, path):
+		self.path = path
+		self.server = None
+		self.clients = set()
+
+	async def start(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+
+	async def stop(self):
+		if self.server is not None:
+			self.server.close()
+			for writer in list(self.clients):
+				writer.close()
+			await self.server.wait_closed()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	async def handle_client(self, reader, writer):
+		self.clients.add(writer)
+		try:
+			await reader.read()
+		except ConnectionError:
+			pass
+		finally:
+			self.clients.discard(writer)
+			writer.close()
+
+	def publish(self, record):
+		line = (json.dumps(record) + "\n").encode('utf-8')
+		for writer in list(self.clients):
+			if writer.is_closing():
+				self.clients.discard(writer)
+				continue
+			if writer.transport.get_write_buffer_size() > client_buffer_max:
+				log.warning("Disconnecting a client that stopped reading events")
+				self.clients.discard(writer)
+				writer.transport.abort()
+				continue
+			writer.write(line)
+
+def event_filter(patterns):
+	def accept(event):
+		return any(fnmatch.fnmatchcase(event['event'], p) for p in patterns)
+	return accept
+
+class VMMonitor:
+	def __init__(self, name, sockpath, sinks, patterns=default_events):
+		self.name = name
+		self.sockpath = sockpath
+		self.sinks = sinks
+		self.patterns = patterns
+
+	def publish(self, event, data=None, timestamp=None):
+		record = {
+			"vm": self.name,
+			"event": event,
+			"data": data or {},
+			"timestamp": timestamp,
+		}
+		for sink in self.sinks:
+			sink.publish(record)
+
+	async def run(self):
+		delay = reconnect_min
+		while True:
+			qmp = QMPClient(self.name)
+			try:
+				await qmp.connect(self.sockpath)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				log.debug("%s: connect failed: %s", self.name, e)
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, reconnect_max)
+				continue
+			delay = reconnect_min
+			try:
+				await self.follow(qmp)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				log.warning("%s: %s", self.name, e)
+			finally:
+				try:
+					# Re-raises whatever tore the connection down.
+					await qmp.disconnect()
+				except Exception as e:
+					log.debug("%s: disconnected: %s", self.name, e)
+			self.publish("MONITOR_DISCONNECTED")
+
+	async def follow(self, qmp):
+		with qmp.listener(event_filter=event_filter(self.patterns)) as listener:
+			status = await qmp.execute('query-status')
+			self.publish("MONITOR_CONNECTED", {"status": status.get('status')})
+			events = asyncio.create_task(self.pump(listener))
+			closed = asyncio.create_task(self.wait_disconnect(qmp))
+			try:
+				await asyncio.wait([events, closed], return_when=asyncio.FIRST_COMPLETED)
+			finally:
+				events.cancel()
+				closed.cancel()
+			if events.done() and not events.cancelled() and events.exception() is not None:
+				raise events.exception()
+
+	async def pump(self, listener):
+		async for event in listener:
+			ts = event.get('timestamp', {})
+			self.publish(event['event'], event.get('data'),
+				ts.get('seconds', 0) + ts.get('microseconds', 0) / 1000000)
+
+	async def wait_disconnect(self, qmp):
+		while qmp.runstate == Runstate.RUNNING:
+			await qmp.runstate_changed()
+
+class EventService:
+	def __init__(self, vm_dirs, sinks, patterns=default_events):
+		self.vm_dirs = vm_dirs
+		self.sinks = sinks
+		self.patterns = patterns
+		self.tasks = {}
+
+	def rescan(self):
+		sockets = fleet.discover(self.vm_dirs, suffix=events_suffix)
+		for name, sockpath in sockets.items():
+			if name in self.tasks and not self.tasks[name].done():
+				continue
+			log.info("%s: watching %s", name, sockpath)
+			self.tasks[name] = asyncio.create_task(
+				VMMonitor(name, sockpath, self.sinks, self.patterns).run())
+
+	async def run(self):
+		for sink in self.sinks:
+			await sink.start()
+		try:
+			while True:
+				self.rescan()
+				await asyncio.sleep(rescan_seconds)
+		finally:
+			for task in self.tasks.values():
+				task.cancel()
+			for sink in self.sinks:
+				await sink.stop()
+
+def events_main(argv):
+	parser = argparse.ArgumentParser(prog="monitor.py events",
+		description="Stream QMP events of all running VMs as JSON lines.")
+	parser.add_argument("-s", "--socket", help="Also publish events on this UNIX socket.")
+	parser.add_argument("-q", "--quiet", action="store_true", help="Don't print events to stdout.")
+	parser.add_argument("-e", "--event", action="append",
+		help="Event name or glob to forward, can be repeated. Defaults to lifecycle and block job events.")
+	parser.add_argument("vm", nargs="+", help="VM directory, or a directory holding VM directories.")
+	args = parser.parse_args(argv)
+	sinks = []
+	if not args.quiet:
+		sinks.append(JsonLinesSink(sys.stdout))
+	if args.socket is not None:
+		sinks.append(SocketSink(args.socket))
+	if os.getenv('MONITOR_DEBUG') == '1':
+		log.setLevel('DEBUG')
+	else:
+		log.setLevel('INFO')
+		# qemu.qmp logs every failed reconnect attempt as an error.
+		logging.getLogger("qemu.qmp").setLevel('CRITICAL')
+	try:
+		asyncio.run(EventService(args.vm, sinks, args.event or default_events).run())
+	except KeyboardInterrupt:
+		pass
+
 if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "events":
+		events_main(sys.argv[2:])
+		sys.exit(0)
 	if len(sys.argv) < 2 or not os.path.isdir(sys.argv[1]):
 		raise TypeError("Invalid VM.")
 	print(sys.argv)
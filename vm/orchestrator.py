@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# Boots many VMs at once. Drives and seed images of all VMs are prepared in
+# parallel, then every VM is launched as soon as the VMs it depends on
+# answer guest-ping. Dependencies come from a "depends" list in specs.json
+# and/or a JSON graph file of the form {"client": ["gateway"]}.
+import asyncio
+import agent
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from subprocess import DEVNULL, STDOUT
+from vm_start_macos import VirtualMachine
+
+log = logging.getLogger("orchestrator")
+logging.basicConfig(stream=sys.stderr)
+
+default_ready_timeout=300
+default_concurrency=8
+ping_interval=0.5
+
+def load_graph(vm_dirs, graph_file=None):
+	names = {}
+	for vm_dir in vm_dirs:
+		name = os.path.basename(os.path.abspath(vm_dir))
+		if name in names:
+			raise TypeError(f"Duplicate VM name {name}")
+		names[name] = vm_dir
+	depends = { name: set() for name in names }
+	for name, vm_dir in names.items():
+		specs_file = os.path.join(vm_dir, "specs.json")
+		if os.path.isfile(specs_file):
+			with open(specs_file, "r") as f:
+				depends[name].update(json.load(f).get("depends", []))
+	if graph_file is not None:
+		with open(graph_file, "r") as f:
+			for name, deps in json.load(f).items():
+				if name in depends:
+					depends[name].update(deps)
+	for name, deps in depends.items():
+		missing = deps - set(names)
+		if len(missing) > 0:
+			raise TypeError(f"{name} depends on unknown VM(s): {', '.join(sorted(missing))}")
+	check_cycles(depends)
+	return names, depends
+
+def check_cycles(depends):
+	done = set()
+	for start in depends:
+		stack = [ (start, iter(sorted(depends[start]))) ]
+		visiting = { start }
+		while len(stack) > 0:
+			name, deps = stack[-1]
+			dep = next(deps, None)
+			if dep is None:
+				stack.pop()
+				visiting.discard(name)
+				done.add(name)
+				continue
+			if dep in visiting:
+				cycle = [ n for n, _ in stack ] + [ dep ]
+				raise TypeError("Dependency cycle: %s" % " -> ".join(cycle))
+			if dep not in done:
+				visiting.add(dep)
+				stack.append((dep, iter(sorted(depends[dep]))))
+
+async def wait_agent(vm, proc, timeout):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if proc.poll() is not None:
+			raise Exception(f"qemu exited with {proc.returncode}")
+		if os.path.exists(vm.agent_path):
+			try:
+				async with agent.AsyncQemuAgent(vm.agent_path, timeout=ping_interval * 4) as q:
+					if await q.guest_ping():
+						return
+			except Exception as e:
+				log.debug("%s: not ready: %s", vm.name, e)
+		await asyncio.sleep(ping_interval)
+	raise TimeoutError(f"guest agent not ready after {timeout}s")
+
+class Orchestrator:
+	def __init__(self, names, depends, ready_timeout=default_ready_timeout, concurrency=default_concurrency):
+		self.names = names
+		self.depends = depends
+		self.ready_timeout = ready_timeout
+		self.semaphore = None
+		self.concurrency = concurrency
+		self.vms = {}
+		self.procs = {}
+		self.ready = {}
+		self.timings = {}
+
+	def prepare(self, name):
+		# Creates missing drives and the cloud-init seed image.
+		vm = VirtualMachine(self.names[name])
+		vm.metadata.do()
+		return vm
+
+	async def prepare_async(self, name):
+		async with self.semaphore:
+			start = time.monotonic()
+			vm = await asyncio.to_thread(self.prepare, name)
+			log.info("%s: prepared in %.2fs", name, time.monotonic() - start)
+			return vm
+
+	async def launch(self, name, prepared):
+		for dep in sorted(self.depends[name]):
+			try:
+				await self.ready[dep]
+			except Exception:
+				# Not started if it is still waiting for its turn, and its
+				# outcome is collected either way.
+				prepared.cancel()
+				await asyncio.gather(prepared, return_exceptions=True)
+				raise Exception(f"dependency {dep} failed")
+		vm = await prepared
+		start = time.monotonic()
+		console = open(os.path.join(vm.dir, f"{name}.log"), "ab")
+		try:
+			proc = vm.start(stdin=DEVNULL, stdout=console, stderr=STDOUT)
+		finally:
+			console.close()
+		self.vms[name] = vm
+		self.procs[name] = proc
+		log.info("%s: launched, pid %d", name, proc.pid)
+		await wait_agent(vm, proc, self.ready_timeout)
+		self.timings[name] = time.monotonic() - start
+		log.info("%s: ready in %.2fs", name, self.timings[name])
+
+	async def boot(self):
+		self.semaphore = asyncio.Semaphore(self.concurrency)
+		prepared = { name: asyncio.create_task(self.prepare_async(name)) for name in self.names }
+		tasks = {}
+		for name in self.names:
+			tasks[name] = asyncio.create_task(self.launch(name, prepared[name]))
+			self.ready[name] = tasks[name]
+		results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+		failed = {}
+		for name, result in zip(tasks, results):
+			if isinstance(result, BaseException):
+				failed[name] = str(result) or result.__class__.__name__
+				log.error("%s: %s", name, failed[name])
+				self.procs.pop(name, None)
+				vm = self.vms.pop(name, None)
+				if vm is not None:
+					await asyncio.to_thread(vm.stop)
+		return failed
+
+	async def wait(self):
+		codes = {}
+		for name, proc in self.procs.items():
+			codes[name] = await asyncio.to_thread(proc.wait)
+			await asyncio.to_thread(self.vms[name].stop)
+		return codes
+
+	def terminate(self):
+		for proc in self.procs.values():
+			if proc.poll() is None:
+				proc.terminate()
+		for vm in self.vms.values():
+			vm.stop()
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Boot many VMs in parallel, honoring dependencies.")
+	parser.add_argument("-g", "--graph", help="JSON file mapping a VM name to the VMs it depends on.")
+	parser.add_argument("-t", "--ready-timeout", type=float, default=default_ready_timeout,
+		help="Seconds to wait for each guest agent to answer.")
+	parser.add_argument("-j", "--concurrency", type=int, default=default_concurrency,
+		help="How many VMs to prepare at the same time.")
+	parser.add_argument("vm", nargs="+", help="VM directories.")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+
+	names, depends = load_graph(args.vm, args.graph)
+	orchestrator = Orchestrator(names, depends, args.ready_timeout, args.concurrency)
+	start = time.monotonic()
+	try:
+		failed = asyncio.run(orchestrator.boot())
+		log.info("%d of %d VMs ready in %.2fs", len(names) - len(failed), len(names), time.monotonic() - start)
+		codes = asyncio.run(orchestrator.wait())
+	except KeyboardInterrupt:
+		orchestrator.terminate()
+		return 1
+	if len(failed) > 0 or any(code != 0 for code in codes.values()):
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
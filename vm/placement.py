@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+# CPU and memory placement on Linux hosts. The host topology is read from
+# sysfs, and a VM with a "placement" section in specs.json gets dedicated
+# physical cores on one NUMA node and guest RAM bound to that node,
+# optionally on hugepages:
+#   "placement": {
+#     "node": "auto" | 0,    NUMA node, "auto" picks the one with most room
+#     "pin": true,           a dedicated core per vCPU, pinned after launch
+#     "smt": false,          place vCPUs on both threads of a core
+#     "hugepages": "2M",     back RAM with hugepages of this size
+#     "exclude": "0-1"       host CPUs never handed to VMs
+#   }
+# Assignments are kept in a ledger file, so VMs started separately don't
+# share cores. Entries of qemu processes that are gone are dropped.
+import asyncio
+from qemu.qmp import QMPClient
+import argparse
+import fcntl
+import glob
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+
+log = logging.getLogger("placement")
+logging.basicConfig(stream=sys.stderr)
+
+default_hugepage_mount="/dev/hugepages"
+# A planned VM that hasn't reported a qemu pid by then is forgotten.
+pending_seconds=300
+pin_timeout=30
+pin_retry=0.2
+
+def parse_cpulist(text):
+	cpus = []
+	for part in text.strip().split(","):
+		if len(part) == 0:
+			continue
+		if "-" in part:
+			first, last = part.split("-")
+			cpus += list(range(int(first), int(last) + 1))
+		else:
+			cpus.append(int(part))
+	return cpus
+
+def format_cpulist(cpus):
+	ranges = []
+	for cpu in sorted(set(cpus)):
+		if len(ranges) > 0 and ranges[-1][1] == cpu - 1:
+			ranges[-1][1] = cpu
+		else:
+			ranges.append([cpu, cpu])
+	return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def parse_size(text, default_unit="M"):
+	# qemu sizes: "2G", "512m", "1.5G", plain numbers are in default_unit.
+	m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", str(text), re.IGNORECASE)
+	if m is None:
+		raise TypeError(f"Invalid size {text}")
+	unit = m.group(2).upper() or default_unit.upper()
+	return int(float(m.group(1)) * 1024 ** ("BKMGT".index(unit)))
+
+class HostTopology:
+	def __init__(self, root="/"):
+		self.root = root
+		self.nodes = {}
+		self.cores = {}
+		self.hugepages = {}
+		self.mounts = {}
+		self.load()
+
+	def path(self, *parts):
+		return os.path.join(self.root, *parts)
+
+	def read(self, *parts):
+		with open(self.path(*parts), "r") as f:
+			return f.read().strip()
+
+	def load(self):
+		cpu_dir = self.path("sys/devices/system/cpu")
+		if not os.path.isdir(cpu_dir):
+			raise Exception(f"No CPU topology in {cpu_dir}, placement needs a Linux host")
+		online = set(parse_cpulist(self.read("sys/devices/system/cpu/online")))
+		node_dirs = sorted(glob.glob(self.path("sys/devices/system/node/node[0-9]*")))
+		for node_dir in node_dirs:
+			node = int(os.path.basename(node_dir)[4:])
+			with open(os.path.join(node_dir, "cpulist"), "r") as f:
+				self.nodes[node] = [ c for c in parse_cpulist(f.read()) if c in online ]
+			self.hugepages[node] = self.read_hugepages(os.path.join(node_dir, "hugepages"))
+		if len(node_dirs) == 0:
+			self.nodes[0] = sorted(online)
+			self.hugepages[0] = self.read_hugepages(self.path("sys/kernel/mm/hugepages"))
+		for node, cpus in self.nodes.items():
+			cores = []
+			for cpu in cpus:
+				try:
+					siblings = parse_cpulist(self.read(f"sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"))
+				except FileNotFoundError:
+					siblings = [ cpu ]
+				core = tuple(c for c in siblings if c in online)
+				if core not in cores:
+					cores.append(core)
+			self.cores[node] = cores
+		self.mounts = self.read_mounts()
+
+	def read_hugepages(self, path):
+		pages = {}
+		for size_dir in glob.glob(os.path.join(path, "hugepages-*kB")):
+			size = int(os.path.basename(size_dir)[len("hugepages-"):-len("kB")]) * 1024
+			with open(os.path.join(size_dir, "free_hugepages"), "r") as f:
+				pages[size] = int(f.read())
+		return pages
+
+	def read_mounts(self):
+		mounts = {}
+		try:
+			text = self.read("proc/mounts")
+		except FileNotFoundError:
+			return mounts
+		for line in text.splitlines():
+			fields = line.split()
+			if len(fields) < 4 or fields[2] != "hugetlbfs":
+				continue
+			size = None
+			for option in fields[3].split(","):
+				if option.startswith("pagesize="):
+					size = parse_size(option[len("pagesize="):])
+			if size is None:
+				size = self.default_hugepage_size()
+			mounts.setdefault(size, fields[1])
+		return mounts
+
+	def default_hugepage_size(self):
+		try:
+			for line in self.read("proc/meminfo").splitlines():
+				if line.startswith("Hugepagesize:"):
+					return int(line.split()[1]) * 1024
+		except FileNotFoundError:
+			pass
+		return 2 * 1024 * 1024
+
+def pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+class Ledger:
+	# CPU assignments of all planned VMs, shared by every process placing
+	# VMs on this host through a locked JSON file.
+	def __init__(self, path):
+		self.path = path
+		self.lock = None
+		self.entries = {}
+
+	def __enter__(self):
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		self.lock = open(self.path + ".lock", "w")
+		fcntl.flock(self.lock, fcntl.LOCK_EX)
+		if os.path.isfile(self.path):
+			with open(self.path, "r") as f:
+				self.entries = json.load(f)
+		now = time.time()
+		for name, entry in list(self.entries.items()):
+			pid = entry.get("pid")
+			if (pid is not None and not pid_alive(pid)) or (pid is None and now - entry["time"] > pending_seconds):
+				del self.entries[name]
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is None:
+			tmp = self.path + ".tmp"
+			with open(tmp, "w") as f:
+				json.dump(self.entries, f, indent=2, sort_keys=True)
+			os.replace(tmp, self.path)
+		fcntl.flock(self.lock, fcntl.LOCK_UN)
+		self.lock.close()
+
+	def used_cpus(self, exclude_name=None):
+		used = set()
+		for name, entry in self.entries.items():
+			if name != exclude_name:
+				used.update(entry.get("dedicated", []))
+		return used
+
+class Placement:
+	def __init__(self, name, node, vcpu_cpus, node_cpus, ram, hugepage_size=None, mem_path=None, ledger_path=None):
+		self.name = name
+		self.node = node
+		self.vcpu_cpus = vcpu_cpus
+		self.node_cpus = node_cpus
+		self.ram = ram
+		self.hugepage_size = hugepage_size
+		self.mem_path = mem_path
+		self.ledger_path = ledger_path
+
+	def data(self, share=False):
+		# share makes guest RAM mappable by vhost-user daemons like virtiofsd.
+		size = f"{self.ram // (1024 * 1024)}M"
+		if self.hugepage_size is not None:
+			backend = f"memory-backend-file,id=mem0,size={size},mem-path={self.mem_path},prealloc=on,share={'on' if share else 'off'}"
+		elif share:
+			backend = f"memory-backend-memfd,id=mem0,size={size},share=on"
+		else:
+			backend = f"memory-backend-ram,id=mem0,size={size}"
+		backend += f",host-nodes={self.node},policy=bind"
+		return [
+			"-object", backend,
+			"-numa", "node,nodeid=0,memdev=mem0",
+		]
+
+	def report(self):
+		lines = [ f"{self.name}: NUMA node {self.node}, {self.ram // (1024 * 1024)}M of " +
+			(f"{self.hugepage_size // 1024}kB hugepages from {self.mem_path}" if self.hugepage_size else "RAM") ]
+		for vcpu, cpus in enumerate(self.vcpu_cpus):
+			lines.append(f"{self.name}: vCPU {vcpu} -> host CPU {format_cpulist(cpus)}")
+		return lines
+
+	async def apply(self, monitor_path, pid, timeout=pin_timeout):
+		# The monitor socket shows up shortly after qemu starts.
+		deadline = time.monotonic() + timeout
+		while True:
+			if not os.path.exists(monitor_path):
+				if time.monotonic() > deadline:
+					raise Exception(f"No monitor socket {monitor_path}")
+				await asyncio.sleep(pin_retry)
+				continue
+			qmp = QMPClient(self.name)
+			try:
+				await qmp.connect(monitor_path)
+				cpus = await qmp.execute('query-cpus-fast')
+				break
+			except Exception as e:
+				if time.monotonic() > deadline:
+					raise Exception(f"Unable to query vCPU threads: {e}")
+				await asyncio.sleep(pin_retry)
+			finally:
+				try:
+					await qmp.disconnect()
+				except Exception:
+					pass
+		for cpu in cpus:
+			index = cpu.get("cpu-index")
+			if index is None or index >= len(self.vcpu_cpus):
+				continue
+			os.sched_setaffinity(cpu["thread-id"], self.vcpu_cpus[index])
+			log.debug("%s: vCPU %d thread %d pinned to %s", self.name, index, cpu["thread-id"],
+				format_cpulist(self.vcpu_cpus[index]))
+		if self.ledger_path is not None:
+			with Ledger(self.ledger_path) as ledger:
+				if self.name in ledger.entries:
+					ledger.entries[self.name]["pid"] = pid
+		log.info("%s: %d vCPUs pinned on node %d", self.name, len(cpus), self.node)
+
+	def apply_sync(self, monitor_path, pid, timeout=pin_timeout):
+		try:
+			asyncio.run(self.apply(monitor_path, pid, timeout))
+		except Exception as e:
+			log.error("%s: %s", self.name, e)
+
+def plan(name, specs, ledger_path, topology=None, record=True):
+	spec = specs.get("placement")
+	if not isinstance(spec, dict):
+		raise TypeError("placement must be a dictionary")
+	if topology is None:
+		topology = HostTopology()
+	vcpus = int(specs.get("cpus", "1"))
+	ram = parse_size(specs.get("ram", "1G"))
+	pin = spec.get("pin", True)
+	smt = spec.get("smt", False)
+	node_spec = spec.get("node", "auto")
+	exclude = set(parse_cpulist(spec.get("exclude", "")))
+	hugepage_size = parse_size(spec["hugepages"]) if spec.get("hugepages") else None
+	if node_spec == "auto":
+		candidates = sorted(topology.nodes)
+	elif isinstance(node_spec, int) and node_spec in topology.nodes:
+		candidates = [ node_spec ]
+	else:
+		raise TypeError(f"Unknown NUMA node {node_spec}")
+	mem_path = None
+	if hugepage_size is not None:
+		mem_path = topology.mounts.get(hugepage_size)
+		if mem_path is None:
+			if hugepage_size != topology.default_hugepage_size():
+				raise Exception(f"No hugetlbfs mounted for {spec['hugepages']} pages")
+			mem_path = default_hugepage_mount
+		if ram % hugepage_size != 0:
+			raise Exception(f"RAM isn't a multiple of {spec['hugepages']}")
+
+	with Ledger(ledger_path) as ledger:
+		used = ledger.used_cpus(exclude_name=name) | exclude
+		best = None
+		problems = []
+		for node in candidates:
+			free = [ core for core in topology.cores[node] if not any(c in used for c in core) ]
+			per_core = max(len(core) for core in free) if smt and len(free) > 0 else 1
+			needed = math.ceil(vcpus / per_core) if pin else 0
+			if len(free) < needed:
+				problems.append(f"node {node} has {len(free)} free cores, {needed} needed")
+				continue
+			if hugepage_size is not None:
+				pages = topology.hugepages.get(node, {}).get(hugepage_size, 0)
+				if pages < ram // hugepage_size:
+					problems.append(f"node {node} has {pages} free hugepages, {ram // hugepage_size} needed")
+					continue
+			if best is None or len(free) > len(best[1]):
+				best = (node, free, per_core, needed)
+		if best is None:
+			raise Exception(f"{name}: no room on any NUMA node: " + "; ".join(problems))
+		node, free, per_core, needed = best
+		node_cpus = [ c for c in topology.nodes[node] if c not in used ]
+		dedicated = []
+		if pin:
+			vcpu_cpus = []
+			for vcpu in range(vcpus):
+				core = free[vcpu // per_core]
+				vcpu_cpus.append([ core[vcpu % per_core] ] if smt else list(core))
+			# Without smt, the sibling threads of a core stay idle.
+			for core in free[:needed]:
+				dedicated += list(core)
+		else:
+			vcpu_cpus = [ node_cpus ] * vcpus
+		if record:
+			ledger.entries[name] = {
+				"node": node,
+				"dedicated": dedicated,
+				"pid": None,
+				"time": time.time(),
+			}
+	placement = Placement(name, node, vcpu_cpus, node_cpus, ram, hugepage_size, mem_path, ledger_path)
+	if record:
+		for line in placement.report():
+			log.info("%s", line)
+	return placement
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Show the host topology and plan VM placement.")
+	parser.add_argument("-r", "--root", default="/", help="Root of the sysfs and procfs trees to read.")
+	parser.add_argument("-l", "--ledger", default=os.path.abspath(os.path.join("images", "placement.json")))
+	sub = parser.add_subparsers(dest="command", required=True)
+	sub.add_parser("topology")
+	p = sub.add_parser("plan", help="Report where the VMs would be placed, without recording it.")
+	p.add_argument("vm", nargs="+", help="VM directories.")
+	sub.add_parser("ledger", help="Show the recorded assignments.")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+
+	if args.command == "topology":
+		topology = HostTopology(args.root)
+		for node in sorted(topology.nodes):
+			cores = " ".join(format_cpulist(core) for core in topology.cores[node])
+			pages = ", ".join(f"{size // 1024}kB: {count} free" for size, count in sorted(topology.hugepages[node].items()))
+			print(f"node {node}: cores {cores}")
+			if len(pages) > 0:
+				print(f"node {node}: hugepages {pages}")
+		for size, path in sorted(topology.mounts.items()):
+			print(f"hugetlbfs {size // 1024}kB at {path}")
+	elif args.command == "plan":
+		topology = HostTopology(args.root)
+		for vm_dir in args.vm:
+			with open(os.path.join(vm_dir, "specs.json"), "r") as f:
+				specs = json.load(f)
+			name = os.path.basename(os.path.abspath(vm_dir))
+			if "placement" not in specs:
+				print(f"{name}: no placement")
+				continue
+			for line in plan(name, specs, args.ledger, topology, record=False).report():
+				print(line)
+	elif args.command == "ledger":
+		with Ledger(args.ledger) as ledger:
+			for name, entry in sorted(ledger.entries.items()):
+				print(f"{name}: node {entry['node']}, CPUs {format_cpulist(entry['dedicated'])}, pid {entry['pid']}")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# Launch plans. A VM's specs.json is validated and compiled once into an
+# immutable plan: the qemu argv, the drives and seed image to create before
+# starting and the sockets qemu will listen on. The plan is cached in the
+# VM directory, keyed by the specs and the mtimes of every file they refer
+# to, so restarts don't build the command line again. Compiling never
+# writes anything, which makes it safe for --dry-run.
+# CPU placement is host state that changes between starts, so it isn't part
+# of the plan and gets added by argv() at launch time.
+import argparse
+import backends
+import collections
+import hashlib
+import images
+import json
+import logging
+import os
+import placement
+import schema
+import seed
+import shares
+import sys
+import vm_start_macos
+from vm_start_macos import VirtualMachine, HardDrive
+
+log = logging.getLogger("plan")
+logging.basicConfig(stream=sys.stderr)
+
+# Bump when the plan layout or the argv builders change.
+plan_version=3
+cache_name="plan.json"
+
+LaunchPlan = collections.namedtuple("LaunchPlan", [
+	"name",
+	"dir",
+	"key",
+	"argv",
+	# (file, baseimage, size) of every drive.
+	"drives",
+	# (floppy path, ((name, source), ...)) or None.
+	"seed",
+	"agent_path",
+	"monitor_path",
+	# (argv, socket, log) of every virtiofsd to start before qemu.
+	"daemons",
+	# specs.json as loaded, for placement at launch time.
+	"specs",
+])
+
+def read_specs(vm_dir):
+	specs_file = os.path.join(vm_dir, "specs.json")
+	if not os.path.isfile(specs_file):
+		raise TypeError(f"{specs_file} doesn't exist")
+	with open(specs_file, "rb") as f:
+		raw = f.read()
+	specs = json.loads(raw)
+	errors = schema.validate(specs)
+	if len(errors) > 0:
+		raise TypeError(f"{specs_file}: " + "; ".join(errors))
+	return raw, specs
+
+def referenced_files(vm_dir, specs):
+	backend = backends.get(specs.get("backend"))
+	paths = [ os.path.join(vm_start_macos.qemu_path or backend.qemu_path, specs.get("arch", "qemu-system-aarch64")) ]
+	registry = os.path.join(vm_start_macos.images_path, images.registry_file)
+	paths.append(registry)
+	baseimages = [ d["baseimage"] for d in specs.get("drives", []) if "baseimage" in d ]
+	if len(baseimages) > 0:
+		r = images.Registry(vm_start_macos.images_path)
+		paths += [ r.resolve(b) for b in baseimages ]
+	for key in ("meta-data", "user-data", "network-config"):
+		if key in specs.get("metadata", {}):
+			paths.append(os.path.join(vm_dir, specs["metadata"][key]))
+	if "cdrom" in specs:
+		paths.append(os.path.join(vm_start_macos.images_path, specs["cdrom"]["iso"]))
+	return paths
+
+def plan_key(vm_dir, raw, specs):
+	h = hashlib.sha256(f"plan:{plan_version}".encode('ascii'))
+	h.update(raw)
+	h.update(f"{vm_start_macos.images_path}\0{vm_start_macos.qemu_path}\0{sys.platform}\0{os.geteuid()}".encode('utf-8'))
+	for path in referenced_files(vm_dir, specs):
+		try:
+			st = os.stat(path)
+			h.update(f"\0{path}:{st.st_size}:{st.st_mtime_ns}".encode('utf-8'))
+		except FileNotFoundError:
+			h.update(f"\0{path}:-".encode('utf-8'))
+	return h.hexdigest()
+
+def compile_plan(vm_dir, key=None):
+	vm = VirtualMachine(vm_dir, create=False)
+	if key is None:
+		with open(vm.specs_file, "rb") as f:
+			key = plan_key(vm.dir, f.read(), vm.specs)
+	seed_files = None
+	if vm.metadata.floppy_path is not None:
+		seed_files = (vm.metadata.floppy_path, tuple(
+			(name, path) for name, path in [
+				("meta-data", vm.metadata.metadata_file),
+				("user-data", vm.metadata.userdata_file),
+				("network-config", vm.metadata.network_file) ]
+			if path is not None))
+	return LaunchPlan(
+		name=vm.name,
+		dir=vm.dir,
+		key=key,
+		argv=tuple(vm.data(dry_run=True)),
+		drives=tuple((d.file, d.baseimage, d.size) for d in vm.drives),
+		seed=seed_files,
+		agent_path=vm.agent_path,
+		monitor_path=vm.monitor_path,
+		daemons=tuple(vm.daemons()),
+		specs=json.dumps(vm.specs, sort_keys=True),
+	)
+
+def from_json(data):
+	data["argv"] = tuple(data["argv"])
+	data["drives"] = tuple(tuple(d) for d in data["drives"])
+	if data["seed"] is not None:
+		data["seed"] = (data["seed"][0], tuple(tuple(s) for s in data["seed"][1]))
+	data["daemons"] = tuple((tuple(d[0]), d[1], d[2]) for d in data["daemons"])
+	return LaunchPlan(**data)
+
+def load(vm_dir, use_cache=True, dry_run=False):
+	# The cached plan if it is still current, otherwise a fresh one which is
+	# stored for next time unless this is a dry run.
+	vm_dir = os.path.abspath(vm_dir)
+	raw, specs = read_specs(vm_dir)
+	key = plan_key(vm_dir, raw, specs)
+	cache_file = os.path.join(vm_dir, cache_name)
+	if use_cache and os.path.isfile(cache_file):
+		try:
+			with open(cache_file, "r") as f:
+				cached = json.load(f)
+			if cached.get("key") == key:
+				return from_json(cached["plan"])
+			log.debug("%s: plan is stale", vm_dir)
+		except Exception as e:
+			log.warning("%s: ignoring cached plan: %s", vm_dir, e)
+	p = compile_plan(vm_dir, key)
+	if not dry_run:
+		tmp = cache_file + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump({ "key": key, "plan": p._asdict() }, f, indent=2)
+		os.replace(tmp, cache_file)
+	return p
+
+def missing(p):
+	# Files prepare() would create.
+	files = [ d[0] for d in p.drives if not os.path.isfile(d[0]) ]
+	if p.seed is not None:
+		files.append(p.seed[0])
+	return files
+
+def prepare(p):
+	for i, (file, baseimage, size) in enumerate(p.drives):
+		if not os.path.isfile(file):
+			HardDrive({ "file": file, "baseimage": baseimage, "size": size }, i, p.dir).create()
+	if p.seed is not None:
+		files = []
+		for name, path in p.seed[1]:
+			with open(path, "rb") as f:
+				files.append((name, f.read()))
+		specs = json.loads(p.specs)
+		files = shares.seed_files(files, shares.from_specs(specs, p.dir, backends.get(specs.get("backend"))))
+		seed.SeedCache(vm_start_macos.seeds_path).install(files, p.seed[0])
+
+def argv(p, incoming=None):
+	# Returns the argv to run and the Placement to apply once qemu runs.
+	cmd = list(p.argv)
+	placed = None
+	specs = json.loads(p.specs)
+	if "placement" in specs:
+		placed = placement.plan(p.name, specs, vm_start_macos.placement_path)
+		i = cmd.index("-nodefaults") + 1
+		# virtiofsd needs guest RAM it can map.
+		cmd[i:i] = placed.data(share=len(p.daemons) > 0)
+	if incoming is not None:
+		cmd += [ "-incoming", incoming ]
+	return cmd, placed
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Validate specs and show launch plans.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p = sub.add_parser("check", help="Validate specs.json.")
+	p.add_argument("vm", nargs="+")
+	p = sub.add_parser("show", help="Print the launch plan.")
+	p.add_argument("vm", nargs="+")
+	p.add_argument("-n", "--dry-run", action="store_true", help="Don't store the plan.")
+	p.add_argument("--no-cache", action="store_true", help="Compile the plan again.")
+	p.add_argument("--json", action="store_true")
+	p = sub.add_parser("clear", help="Remove cached plans.")
+	p.add_argument("vm", nargs="+")
+	args = parser.parse_args(argv[1:])
+
+	ret = 0
+	for vm_dir in args.vm:
+		if args.command == "clear":
+			cache_file = os.path.join(vm_dir, cache_name)
+			if os.path.isfile(cache_file):
+				os.remove(cache_file)
+			continue
+		try:
+			if args.command == "check":
+				read_specs(vm_dir)
+				print(f"{vm_dir}: ok")
+				continue
+			p = load(vm_dir, not args.no_cache, args.dry_run)
+		except Exception as e:
+			print(f"{vm_dir}: {e}", file=sys.stderr)
+			ret = 1
+			continue
+		if args.json:
+			print(json.dumps(p._asdict(), indent=2))
+			continue
+		print(f"{p.name} {p.key[:16]}")
+		print("  argv: " + " ".join(p.argv))
+		for file in missing(p):
+			print(f"  create: {file}")
+		print(f"  agent: {p.agent_path}")
+		print(f"  monitor: {p.monitor_path}")
+	return ret
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
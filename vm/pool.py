@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+# Keeps a pool of VMs rendered from a template booted and past cloud-init,
+# so handing one out takes no time. Clients talk to the pool over a UNIX
+# socket with guest agent style JSON lines:
+#   {"execute": "acquire", "arguments": {"lease": 600}} -> {"return": {"name": ..., "dir": ..., ...}}
+#   {"execute": "renew", "arguments": {"name": ..., "lease": 600}}
+#   {"execute": "release", "arguments": {"name": ...}}
+#   {"execute": "status"}
+# A lease ends after its seconds unless renewed, so a VM whose client went
+# away comes back. Released and expired VMs are stopped, their drives are
+# thrown away and they are booted again from scratch to refill the pool.
+import asyncio
+import agent
+import argparse
+import json
+import logging
+import orchestrator
+import os
+import render
+import socket
+import sys
+import time
+from subprocess import DEVNULL, STDOUT
+from vm_start_macos import VirtualMachine
+
+log = logging.getLogger("pool")
+logging.basicConfig(stream=sys.stderr)
+
+default_size=2
+default_ready_timeout=900
+default_prefix="warm"
+socket_name="pool.sock"
+retry_delay=10
+default_lease=3600
+reap_interval=5
+stop_timeout=30
+cloud_init_command=[ "cloud-init", "status", "--wait" ]
+
+async def wait_cloud_init(vm, timeout):
+	async with agent.AsyncQemuAgent(vm.agent_path) as q:
+		try:
+			proc = await q.exec_stream(cloud_init_command[0], cloud_init_command[1:], timeout=timeout)
+		except Exception as e:
+			# No cloud-init in the guest, so nothing to wait for.
+			log.debug("%s: %s", vm.name, e)
+			return
+		output = b""
+		async for _, data in proc:
+			output += data
+	# 2 means done with recoverable errors.
+	if proc.exitcode not in (0, 2):
+		raise Exception("cloud-init failed: %s" % output.decode('utf-8', errors='replace').strip())
+
+class Slot:
+	def __init__(self, name, vm_dir):
+		self.name = name
+		self.dir = vm_dir
+		self.state = "free"
+		self.dirty = os.path.isfile(os.path.join(vm_dir, "specs.json"))
+		self.vm = None
+		self.proc = None
+		self.since = time.monotonic()
+		self.expires = None
+
+	def set_state(self, state):
+		self.state = state
+		self.since = time.monotonic()
+
+	def info(self):
+		return {
+			"name": self.name,
+			"dir": self.dir,
+			"agent": self.vm.agent_path,
+			"monitor": self.vm.monitor_path,
+			"lease": None if self.expires is None else round(self.expires - time.monotonic(), 1),
+		}
+
+class WarmPool:
+	def __init__(self, template_dir, pool_dir, size=default_size, max_vms=None, prefix=default_prefix,
+			values={}, ready_timeout=default_ready_timeout, wait_cloud_init=True, per_vm={}, lease=default_lease):
+		self.template = render.load_template(template_dir)
+		self.pool_dir = os.path.abspath(pool_dir)
+		self.size = size
+		self.max_vms = max_vms
+		self.prefix = prefix
+		self.values = values
+		self.per_vm = per_vm
+		self.lease = lease
+		self.ready_timeout = ready_timeout
+		self.wait_cloud_init = wait_cloud_init
+		self.slots = {}
+		self.ready = None
+		self.tasks = set()
+		os.makedirs(self.pool_dir, exist_ok=True)
+		# Leftovers of an earlier run are reused, but booted from fresh drives.
+		for name in sorted(os.listdir(self.pool_dir)):
+			path = os.path.join(self.pool_dir, name)
+			if name.startswith(prefix) and os.path.isfile(os.path.join(path, "specs.json")):
+				self.slots[name] = Slot(name, path)
+
+	def count(self, *states):
+		return len([ s for s in self.slots.values() if s.state in states ])
+
+	def new_slot(self):
+		if self.max_vms is not None and len(self.slots) >= self.max_vms:
+			return None
+		n = len(self.slots) + 1
+		while f"{self.prefix}{n}" in self.slots:
+			n += 1
+		name = f"{self.prefix}{n}"
+		self.slots[name] = Slot(name, os.path.join(self.pool_dir, name))
+		return self.slots[name]
+
+	def spawn(self, coro):
+		task = asyncio.create_task(coro)
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	def refill(self):
+		while self.count("booting", "ready") < self.size:
+			free = [ s for s in self.slots.values() if s.state == "free" ]
+			slot = free[0] if len(free) > 0 else self.new_slot()
+			if slot is None:
+				return
+			slot.set_state("booting")
+			self.spawn(self.boot(slot))
+
+	def prepare(self, slot):
+		if not os.path.isfile(os.path.join(slot.dir, "specs.json")):
+			render.render(self.template, self.pool_dir, [ slot.name ], self.values, self.per_vm, force=True)
+		elif slot.dirty:
+			VirtualMachine(slot.dir).cleanup()
+		slot.dirty = True
+		# Creates the overlay drives again.
+		vm = VirtualMachine(slot.dir)
+		vm.metadata.do()
+		return vm
+
+	async def boot(self, slot):
+		start = time.monotonic()
+		try:
+			slot.vm = await asyncio.to_thread(self.prepare, slot)
+			console = open(os.path.join(slot.dir, f"{slot.name}.log"), "ab")
+			try:
+				slot.proc = slot.vm.start(stdin=DEVNULL, stdout=console, stderr=STDOUT)
+			finally:
+				console.close()
+			await orchestrator.wait_agent(slot.vm, slot.proc, self.ready_timeout)
+			if self.wait_cloud_init:
+				await asyncio.wait_for(wait_cloud_init(slot.vm, self.ready_timeout), self.ready_timeout)
+		except Exception as e:
+			log.error("%s: boot failed: %s", slot.name, str(e) or e.__class__.__name__)
+			await self.stop(slot)
+			await asyncio.sleep(retry_delay)
+			slot.set_state("free")
+			self.refill()
+			return
+		slot.set_state("ready")
+		self.ready.put_nowait(slot)
+		log.info("%s: ready in %.2fs", slot.name, time.monotonic() - start)
+
+	async def stop(self, slot):
+		slot.proc = None
+		if slot.vm is not None:
+			await asyncio.to_thread(slot.vm.stop, stop_timeout)
+
+	async def recycle(self, slot):
+		slot.set_state("recycling")
+		await self.stop(slot)
+		try:
+			await asyncio.to_thread(slot.vm.cleanup)
+			slot.dirty = False
+		except Exception as e:
+			log.error("%s: cleanup failed: %s", slot.name, e)
+		slot.set_state("free")
+		self.refill()
+
+	async def acquire(self, timeout=None, lease=None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			remaining = None if deadline is None else max(0, deadline - time.monotonic())
+			try:
+				slot = await asyncio.wait_for(self.ready.get(), remaining)
+			except asyncio.TimeoutError:
+				raise TimeoutError("No VM became available")
+			if slot.state != "ready":
+				continue
+			if slot.proc is None or slot.proc.poll() is not None:
+				log.warning("%s: died while idle", slot.name)
+				self.spawn(self.recycle(slot))
+				continue
+			# handle_client refills once the client has the VM, a VM that
+			# never reaches it goes back to ready without a replacement.
+			slot.set_state("leased")
+			self.renew_lease(slot, lease)
+			log.info("%s: acquired", slot.name)
+			return slot.info()
+
+	def renew_lease(self, slot, lease=None):
+		lease = self.lease if lease is None else lease
+		slot.expires = None if lease is None else time.monotonic() + lease
+
+	def unlease(self, name):
+		# The client went away before it got the VM, which is still clean.
+		slot = self.slots.get(name)
+		if slot is None or slot.state != "leased":
+			return
+		log.info("%s: client gone before the reply, back to ready", name)
+		slot.expires = None
+		slot.set_state("ready")
+		self.ready.put_nowait(slot)
+
+	async def renew(self, name, lease=None):
+		slot = self.slots.get(name)
+		if slot is None or slot.state != "leased":
+			raise Exception(f"{name} isn't leased")
+		self.renew_lease(slot, lease)
+		return slot.info()
+
+	async def release(self, name):
+		slot = self.slots.get(name)
+		if slot is None or slot.state != "leased":
+			raise Exception(f"{name} isn't leased")
+		log.info("%s: released after %.1fs", name, time.monotonic() - slot.since)
+		slot.expires = None
+		self.spawn(self.recycle(slot))
+		return {}
+
+	async def reap(self):
+		while True:
+			await asyncio.sleep(reap_interval)
+			now = time.monotonic()
+			for slot in list(self.slots.values()):
+				if slot.state == "leased" and slot.expires is not None and slot.expires < now:
+					log.warning("%s: lease expired after %.1fs", slot.name, now - slot.since)
+					slot.expires = None
+					self.spawn(self.recycle(slot))
+
+	async def status(self):
+		now = time.monotonic()
+		return {
+			"size": self.size,
+			"vms": { name: {"state": s.state, "seconds": round(now - s.since, 1),
+				"lease": None if s.expires is None else round(s.expires - now, 1)}
+				for name, s in self.slots.items() },
+		}
+
+	async def handle(self, message):
+		command = message.get("execute")
+		arguments = message.get("arguments", {})
+		if command == "acquire":
+			return await self.acquire(arguments.get("timeout"), arguments.get("lease"))
+		if command == "renew":
+			return await self.renew(arguments.get("name"), arguments.get("lease"))
+		if command == "release":
+			return await self.release(arguments.get("name"))
+		if command == "status":
+			return await self.status()
+		raise Exception(f"Unknown command {command}")
+
+	async def handle_client(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if len(line) == 0:
+					break
+				message = None
+				try:
+					message = json.loads(line)
+					reply = {"return": await self.handle(message)}
+				except Exception as e:
+					reply = {"error": {"class": "GenericError", "desc": str(e) or e.__class__.__name__}}
+				if isinstance(message, dict) and "id" in message:
+					reply["id"] = message["id"]
+				acquired = None
+				if isinstance(message, dict) and message.get("execute") == "acquire" and "return" in reply:
+					acquired = reply["return"]["name"]
+				# A client that timed out or quit while waiting never sees
+				# the reply, so it doesn't get the VM either.
+				if acquired is not None and reader.at_eof():
+					self.unlease(acquired)
+					break
+				try:
+					writer.write(json.dumps(reply).encode('utf-8') + b"\n")
+					await writer.drain()
+				except ConnectionError:
+					if acquired is not None:
+						self.unlease(acquired)
+					raise
+				if acquired is not None:
+					self.refill()
+		except (ConnectionError, json.JSONDecodeError):
+			pass
+		finally:
+			writer.close()
+
+	async def run(self):
+		self.ready = asyncio.Queue()
+		path = os.path.join(self.pool_dir, socket_name)
+		if os.path.exists(path):
+			os.remove(path)
+		server = await asyncio.start_unix_server(self.handle_client, path)
+		log.info("Keeping %d VMs warm in %s", self.size, self.pool_dir)
+		self.refill()
+		self.spawn(self.reap())
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			for task in list(self.tasks):
+				task.cancel()
+			await asyncio.gather(*[ self.stop(s) for s in self.slots.values() ], return_exceptions=True)
+			if os.path.exists(path):
+				os.remove(path)
+
+def request(pool_dir, command, arguments=None, timeout=None):
+	message = {"execute": command}
+	if arguments is not None:
+		message["arguments"] = arguments
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+		s.settimeout(timeout)
+		s.connect(os.path.join(pool_dir, socket_name))
+		s.sendall(json.dumps(message).encode('utf-8') + b"\n")
+		buf = b""
+		while not buf.endswith(b"\n"):
+			data = s.recv(65536)
+			if len(data) == 0:
+				raise Exception("Pool closed the connection")
+			buf += data
+	return agent.parse_reply(json.loads(buf))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Keep VMs booted and hand them out.")
+	parser.add_argument("-d", "--pool", default=os.path.abspath("pool"), help="Directory of the pool VMs.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p = sub.add_parser("run", help="Run the pool.")
+	p.add_argument("template", help="Template directory, e.g. vm.template.")
+	p.add_argument("-n", "--size", type=int, default=default_size, help="How many VMs to keep ready.")
+	p.add_argument("-m", "--max-vms", type=int, help="Limit on ready and leased VMs together.")
+	p.add_argument("-p", "--prefix", default=default_prefix)
+	p.add_argument("-v", "--values",
+		help='JSON file of template values, {"defaults": {"VAR": ...}, "vms": {"name": {"VAR": ...}}} as for render.py.')
+	p.add_argument("-l", "--lease", type=float, default=default_lease,
+		help="Seconds a VM stays leased unless renewed.")
+	p.add_argument("-t", "--ready-timeout", type=float, default=default_ready_timeout)
+	p.add_argument("--no-cloud-init", action="store_true", help="Only wait for guest-ping.")
+	p = sub.add_parser("acquire", help="Print the VM handed out as JSON.")
+	p.add_argument("-t", "--timeout", type=float)
+	p.add_argument("-l", "--lease", type=float, help="Seconds to lease the VM for.")
+	p = sub.add_parser("renew", help="Extend a lease.")
+	p.add_argument("name")
+	p.add_argument("-l", "--lease", type=float)
+	p = sub.add_parser("release")
+	p.add_argument("name")
+	sub.add_parser("status")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+
+	if args.command == "run":
+		defaults, per_vm = render.load_values(args.values)
+		pool = WarmPool(args.template, args.pool, args.size, args.max_vms, args.prefix, defaults,
+			args.ready_timeout, not args.no_cloud_init, per_vm, args.lease)
+		try:
+			asyncio.run(pool.run())
+		except KeyboardInterrupt:
+			pass
+		return 0
+	arguments = None
+	if args.command == "acquire":
+		arguments = { k: v for k, v in (("timeout", args.timeout), ("lease", args.lease)) if v is not None }
+	elif args.command == "renew":
+		arguments = {"name": args.name, "lease": args.lease}
+	elif args.command == "release":
+		arguments = {"name": args.name}
+	print(json.dumps(request(args.pool, args.command, arguments), indent=2))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# Stamps out VM directories from a template directory such as vm.template.
+# Every %VAR% in the template files is replaced with per VM values, taken
+# from a values file or generated: VMNAME, HOSTNAME, INSTANCEID, MAC (MAC0,
+# MAC1, ... for more NICs) and SSHKEY. The seed image of each rendered VM
+# is built right away.
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import uuid
+import vm_start_macos
+
+log = logging.getLogger("render")
+logging.basicConfig(stream=sys.stderr)
+
+placeholder = re.compile(r"%([A-Z][A-Z0-9_]*)%")
+mac_prefix="52:54:00"
+max_nics=4
+ssh_keys = [ "~/.ssh/id_ed25519.pub", "~/.ssh/id_rsa.pub" ]
+
+def load_values(values_file):
+	if values_file is None:
+		return {}, {}
+	with open(values_file, "r") as f:
+		values = json.load(f)
+	return values.get("defaults", {}), values.get("vms", {})
+
+def default_sshkey():
+	# The whole "type body" of the key, the template has "- %SSHKEY%".
+	for path in ssh_keys:
+		path = os.path.expanduser(path)
+		if os.path.isfile(path):
+			with open(path, "r") as f:
+				fields = f.read().split()
+			if len(fields) > 1:
+				return f"{fields[0]} {fields[1]}"
+	return None
+
+def full_sshkey(key):
+	# Values files written for the old "ssh-rsa %SSHKEY%" template hold
+	# only the body of an RSA key.
+	if key is not None and " " not in key.strip():
+		return f"ssh-rsa {key.strip()}"
+	return key
+
+def generate_mac(name, index, used):
+	n = 0
+	while True:
+		digest = hashlib.sha256(f"{name}/{index}/{n}".encode('utf-8')).digest()
+		mac = mac_prefix + "".join(f":{b:02x}" for b in digest[:3])
+		if mac not in used:
+			used.add(mac)
+			return mac
+		n += 1
+
+def generated_values(name, used_macs):
+	values = {
+		"VMNAME": name,
+		"HOSTNAME": name,
+		"INSTANCEID": str(uuid.uuid5(uuid.NAMESPACE_DNS, name)),
+	}
+	for i in range(max_nics):
+		values[f"MAC{i}"] = generate_mac(name, i, used_macs)
+	values["MAC"] = values["MAC0"]
+	return values
+
+def render_text(text, values, source):
+	missing = set()
+	def replace(match):
+		key = match.group(1)
+		if key not in values or values[key] is None:
+			missing.add(key)
+			return match.group(0)
+		return str(values[key])
+	out = placeholder.sub(replace, text)
+	if len(missing) > 0:
+		raise Exception("%s: no value for %s" % (source, ", ".join(sorted(missing))))
+	return out
+
+def load_template(template_dir):
+	files = {}
+	for name in sorted(os.listdir(template_dir)):
+		path = os.path.join(template_dir, name)
+		if os.path.isfile(path):
+			with open(path, "r") as f:
+				files[name] = f.read()
+	if "specs.json" not in files:
+		raise TypeError(f"{template_dir} has no specs.json")
+	return files
+
+def render(template, out_dir, names, defaults={}, per_vm={}, force=False, seed=True):
+	used_macs = set()
+	sshkey = default_sshkey()
+	# Everything is rendered before anything is written, so a missing value
+	# doesn't leave half of the VMs behind.
+	outputs = {}
+	for name in names:
+		vm_dir = os.path.join(out_dir, name)
+		if os.path.exists(os.path.join(vm_dir, "specs.json")) and not force:
+			raise Exception(f"{vm_dir} already exists")
+		values = generated_values(name, used_macs)
+		values["SSHKEY"] = sshkey
+		values.update(defaults)
+		values.update(per_vm.get(name, {}))
+		values["SSHKEY"] = full_sshkey(values["SSHKEY"])
+		outputs[vm_dir] = { filename: render_text(text, values, f"{name}/{filename}")
+			for filename, text in template.items() }
+	for vm_dir, files in outputs.items():
+		os.makedirs(vm_dir, exist_ok=True)
+		for filename, text in files.items():
+			with open(os.path.join(vm_dir, filename), "w") as f:
+				f.write(text)
+		if seed:
+			specs = json.loads(files["specs.json"])
+			vm_start_macos.Metadata(specs.get("metadata"), vm_dir).do()
+		log.debug("Rendered %s", vm_dir)
+	return list(outputs)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Render VM directories from a template.")
+	parser.add_argument("template", help="Template directory, e.g. vm.template.")
+	parser.add_argument("out", help="Directory to create the VM directories in.")
+	parser.add_argument("names", nargs="*", help="VM names. Defaults to the VMs in the values file.")
+	parser.add_argument("-v", "--values",
+		help='JSON file of the form {"defaults": {"VAR": ...}, "vms": {"name": {"VAR": ...}}}.')
+	parser.add_argument("-n", "--count", type=int, help="Render COUNT clones named PREFIX1..PREFIXCOUNT.")
+	parser.add_argument("-p", "--prefix", default="vm")
+	parser.add_argument("-f", "--force", action="store_true", help="Overwrite the files of existing VMs.")
+	parser.add_argument("--no-seed", action="store_true", help="Don't build seed images.")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+
+	defaults, per_vm = load_values(args.values)
+	names = list(args.names)
+	if args.count is not None:
+		names += [ f"{args.prefix}{i}" for i in range(1, args.count + 1) ]
+	if len(names) == 0:
+		names = sorted(per_vm)
+	if len(names) == 0:
+		parser.error("No VM names given")
+	if len(set(names)) != len(names):
+		parser.error("Duplicate VM names")
+	template = load_template(args.template)
+	rendered = render(template, args.out, names, defaults, per_vm, args.force, not args.no_seed)
+	log.info("Rendered %d VMs into %s", len(rendered), args.out)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,165 @@
+# Validation of specs.json. All problems are collected, so a broken spec is
+# reported in one go instead of failing on the first missing key.
+import re
+
+# Sizes as qemu takes them, a plain number is in megabytes for -m.
+size_re = re.compile(r"^\d+(\.\d+)?[KMGTkmgt]?$")
+mac_re = re.compile(r"^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$")
+
+def string(value, path):
+	if not isinstance(value, str) or len(value) == 0:
+		return [ f"{path} must be a non-empty string" ]
+	return []
+
+def boolean(value, path):
+	if not isinstance(value, bool):
+		return [ f"{path} must be true or false" ]
+	return []
+
+def integer(value, path):
+	# cpus has always been a string in specs.json.
+	if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())):
+		return [ f"{path} must be a number" ]
+	if int(value) < 1:
+		return [ f"{path} must be positive" ]
+	return []
+
+def index(value, path):
+	if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())):
+		return [ f"{path} must be a number" ]
+	if int(value) < 0:
+		return [ f"{path} must not be negative" ]
+	return []
+
+def size(value, path):
+	if not isinstance(value, str) or size_re.match(value) is None:
+		return [ f"{path} must be a size such as 512M, 1.5G or 2g" ]
+	return []
+
+def mac(value, path):
+	if not isinstance(value, str) or mac_re.match(value) is None:
+		return [ f"{path} must be a MAC address" ]
+	return []
+
+def one_of(*values):
+	def check(value, path):
+		if value not in values:
+			return [ f"{path} must be one of {', '.join(str(v) for v in values)}" ]
+		return []
+	return check
+
+def node(value, path):
+	if value == "auto" or (isinstance(value, int) and not isinstance(value, bool) and value >= 0):
+		return []
+	return [ f"{path} must be \"auto\" or a NUMA node number" ]
+
+def list_of(check):
+	def check_list(value, path):
+		if not isinstance(value, list):
+			return [ f"{path} must be a list" ]
+		errors = []
+		for i, item in enumerate(value):
+			errors += check(item, f"{path}[{i}]")
+		return errors
+	return check_list
+
+def obj(fields, required=()):
+	def check_obj(value, path):
+		if not isinstance(value, dict):
+			return [ f"{path} must be an object" ]
+		errors = []
+		for key in required:
+			if key not in value:
+				errors.append(f"{path}.{key} is required")
+		for key, item in value.items():
+			if key not in fields:
+				errors.append(f"{path}.{key} is unknown")
+				continue
+			errors += fields[key](item, f"{path}.{key}")
+		return errors
+	return check_obj
+
+drive = obj({
+	"file": string,
+	"baseimage": string,
+	"size": size,
+	"bustype": string,
+	"cache": one_of("none", "writeback", "writethrough", "directsync", "unsafe"),
+	"aio": one_of("native", "io_uring", "threads"),
+	"queues": integer,
+	# Older specs carry it, the boot order follows the drive list.
+	"bootindex": index,
+}, required=("file",))
+
+nic = obj({
+	"type": string,
+	"mac": mac,
+	"devtype": string,
+	"ifname": string,
+	"bridge": string,
+	"sock": string,
+	"queues": integer,
+})
+
+metadata = obj({
+	"file": string,
+	"user-data": string,
+	"meta-data": string,
+	"network-config": string,
+})
+
+placement = obj({
+	"node": node,
+	"pin": boolean,
+	"smt": boolean,
+	"hugepages": size,
+	"exclude": string,
+})
+
+channel = obj({
+	"type": one_of("virtserial", "vsock"),
+	"cid": integer,
+	"port": integer,
+})
+
+share = obj({
+	"source": string,
+	"tag": string,
+	"type": one_of("virtiofs", "9p"),
+	"readonly": boolean,
+	"mount": string,
+	"options": string,
+	"cache": one_of("auto", "always", "never"),
+}, required=("source",))
+
+spec = obj({
+	"arch": one_of("qemu-system-aarch64", "qemu-system-x86_64"),
+	"backend": one_of("hvf", "kvm"),
+	"cpus": integer,
+	"ram": size,
+	"drives": list_of(drive),
+	"netdev": list_of(nic),
+	"metadata": metadata,
+	"bios": one_of("uefi"),
+	"firmware": string,
+	"video": string,
+	"display": string,
+	"cdrom": obj({"iso": string}, required=("iso",)),
+	"depends": list_of(string),
+	"restart": one_of("no", "on-failure", "always"),
+	"placement": placement,
+	"channel": channel,
+	"shares": list_of(share),
+})
+
+def validate(specs):
+	errors = spec(specs, "specs")
+	if isinstance(specs, dict):
+		for key, field, default in [ ("drives", "file", None), ("shares", "tag", "share") ]:
+			if not isinstance(specs.get(key, []), list):
+				continue
+			values = [ d.get(field, default and f"{default}{i}") for i, d in enumerate(specs.get(key, [])) if isinstance(d, dict) ]
+			for v in sorted(set(v for v in values if v is not None)):
+				if values.count(v) > 1:
+					errors.append(f"specs.{key}: {field} {v} is used more than once")
+	return errors
@@ -0,0 +1,214 @@
+# Builds cloud-init NoCloud seed images without mounting anything. The image
+# is a 1.44MB FAT12 floppy labelled CIDATA holding meta-data, user-data and
+# network-config, with VFAT long file names so the guest sees those names.
+import os
+import struct
+import tempfile
+import hashlib
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+sector_size=512
+floppy_sectors=2880
+reserved_sectors=1
+fat_count=2
+fat_sectors=9
+root_entries=224
+sectors_per_track=18
+heads=2
+media_descriptor=0xF0
+# 1980-01-01 00:00:00, the FAT epoch. A fixed stamp keeps images reproducible.
+fat_date=(0 << 9) | (1 << 5) | 1
+fat_time=0
+# Bump when the image layout changes so cached images get rebuilt.
+image_version=1
+default_cache_bytes=256*1024*1024
+
+def short_name(name, index):
+	# NAME~N.EXT built from the characters that are valid in 8.3 names.
+	base, _, ext = name.upper().rpartition(".") if "." in name else (name.upper(), "", "")
+	valid = lambda s: "".join(c for c in s if c.isalnum() or c in "-_!#$%&'()@^`{}~")
+	base = valid(base)
+	ext = valid(ext)[:3]
+	tail = f"~{index}"
+	return (base[:8 - len(tail)] + tail).ljust(8).encode('ascii') + ext.ljust(3).encode('ascii')
+
+def lfn_checksum(name83):
+	total = 0
+	for b in name83:
+		total = (((total & 1) << 7) + (total >> 1) + b) & 0xFF
+	return total
+
+def lfn_entries(name, name83):
+	chars = name.encode('utf-16-le')
+	units = [ chars[i:i + 2] for i in range(0, len(chars), 2) ]
+	if len(units) % 13 != 0:
+		units.append(b"\x00\x00")
+	while len(units) % 13 != 0:
+		units.append(b"\xff\xff")
+	checksum = lfn_checksum(name83)
+	entries = []
+	count = len(units) // 13
+	for seq in range(1, count + 1):
+		part = units[(seq - 1) * 13:seq * 13]
+		order = seq | (0x40 if seq == count else 0)
+		entries.append(struct.pack("<B10sBBB12sH4s",
+			order, b"".join(part[0:5]), 0x0F, 0, checksum, b"".join(part[5:11]), 0, b"".join(part[11:13])))
+	# Stored last part first, right before the short entry.
+	return list(reversed(entries))
+
+def dir_entry(name83, attr, cluster=0, size=0):
+	return struct.pack("<11sBBBHHHHHHHI",
+		name83, attr, 0, 0, fat_time, fat_date, fat_date, 0, fat_time, fat_date, cluster, size)
+
+def pack_fat12(fat):
+	out = bytearray()
+	for i in range(0, len(fat), 2):
+		a = fat[i]
+		b = fat[i + 1] if i + 1 < len(fat) else 0
+		out += bytes([ a & 0xFF, ((a >> 8) & 0x0F) | ((b & 0x0F) << 4), (b >> 4) & 0xFF ])
+	return bytes(out)
+
+def build_image(files, label="CIDATA"):
+	if isinstance(files, dict):
+		files = list(files.items())
+	root_sectors = root_entries * 32 // sector_size
+	data_start = reserved_sectors + fat_count * fat_sectors + root_sectors
+	clusters = floppy_sectors - data_start
+	image = bytearray(floppy_sectors * sector_size)
+
+	content = b"".join(data for _, data in files)
+	volume_id = struct.unpack("<I", hashlib.sha256(content).digest()[:4])[0]
+	boot = struct.pack("<3s8sHBHBHHBHHHII",
+		b"\xeb\x3c\x90", b"MSWIN4.1", sector_size, 1, reserved_sectors, fat_count,
+		root_entries, floppy_sectors, media_descriptor, fat_sectors,
+		sectors_per_track, heads, 0, 0)
+	boot += struct.pack("<BBBI11s8s", 0, 0, 0x29, volume_id,
+		label.upper().ljust(11).encode('ascii'), b"FAT12   ")
+	image[0:len(boot)] = boot
+	image[510:512] = b"\x55\xaa"
+
+	fat = [ 0xF00 | media_descriptor, 0xFFF ] + [ 0 ] * clusters
+	root = [ dir_entry(label.upper().ljust(11).encode('ascii'), 0x08) ]
+	next_cluster = 2
+	for index, (name, data) in enumerate(files, 1):
+		needed = (len(data) + sector_size - 1) // sector_size
+		if next_cluster + needed > clusters + 2:
+			raise Exception("Seed files don't fit in the floppy image")
+		first = next_cluster if needed > 0 else 0
+		for i in range(needed):
+			cluster = next_cluster + i
+			fat[cluster] = cluster + 1 if i < needed - 1 else 0xFFF
+			offset = (data_start + cluster - 2) * sector_size
+			chunk = data[i * sector_size:(i + 1) * sector_size]
+			image[offset:offset + len(chunk)] = chunk
+		next_cluster += needed
+		name83 = short_name(name, index)
+		root += lfn_entries(name, name83)
+		root.append(dir_entry(name83, 0x20, first, len(data)))
+	if len(root) > root_entries:
+		raise Exception("Too many files for the floppy root directory")
+
+	fat_bytes = pack_fat12(fat)
+	for n in range(fat_count):
+		offset = (reserved_sectors + n * fat_sectors) * sector_size
+		image[offset:offset + len(fat_bytes)] = fat_bytes
+	offset = (reserved_sectors + fat_count * fat_sectors) * sector_size
+	root_bytes = b"".join(root)
+	image[offset:offset + len(root_bytes)] = root_bytes
+	return bytes(image)
+
+def write_image(path, files, label="CIDATA"):
+	# Written next to the target and renamed, so readers never see a
+	# partial image and concurrent builders don't step on each other.
+	image = build_image(files, label)
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".seed-")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(image)
+		os.replace(tmp, path)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+class SeedCache:
+	# Seed images keyed by a hash of the files that go in them. VMs get a
+	# hard link to the cached image, so identical seeds share one file.
+	# Least recently used entries are evicted past max_bytes.
+	def __init__(self, path, max_bytes=default_cache_bytes):
+		self.path = path
+		self.max_bytes = max_bytes
+
+	def key(self, files, label="CIDATA"):
+		h = hashlib.sha256(f"fat12:{image_version}:{label}".encode('ascii'))
+		for name, data in files:
+			h.update(struct.pack("<I", len(name)) + name.encode('utf-8'))
+			h.update(struct.pack("<Q", len(data)) + data)
+		return h.hexdigest()
+
+	def get(self, files, label="CIDATA"):
+		os.makedirs(self.path, exist_ok=True)
+		image = os.path.join(self.path, self.key(files, label) + ".img")
+		if os.path.isfile(image):
+			os.utime(image)
+			log.debug("Seed cache hit %s", image)
+			return image
+		write_image(image, files, label)
+		log.debug("Seed cache miss, built %s", image)
+		self.evict(keep=image)
+		return image
+
+	def evict(self, keep=None):
+		entries = []
+		total = 0
+		for name in os.listdir(self.path):
+			if not name.endswith(".img"):
+				continue
+			path = os.path.join(self.path, name)
+			try:
+				st = os.stat(path)
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime, st.st_size, path))
+			total += st.st_size
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			if path == keep:
+				continue
+			try:
+				os.remove(path)
+				log.debug("Evicted %s", path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+	def install(self, files, dest, label="CIDATA"):
+		for _ in range(2):
+			image = self.get(files, label)
+			if os.path.exists(dest) and same_image(image, dest):
+				return dest
+			tmp = os.path.join(os.path.dirname(os.path.abspath(dest)), f".seed-{os.getpid()}-{os.path.basename(dest)}")
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			try:
+				os.link(image, tmp)
+			except FileNotFoundError:
+				# Evicted by another process in the meantime.
+				continue
+			except OSError:
+				shutil.copyfile(image, tmp)
+			os.replace(tmp, dest)
+			return dest
+		raise Exception("Unable to install seed image %s" % dest)
+
+def same_image(a, b):
+	if os.path.samefile(a, b):
+		return True
+	if os.path.getsize(a) != os.path.getsize(b):
+		return False
+	with open(a, "rb") as fa, open(b, "rb") as fb:
+		return fa.read() == fb.read()
@@ -0,0 +1,151 @@
+# Host directories shared with the guest, from "shares" in specs.json:
+#   "shares": [ {"source": "/srv/build", "tag": "build", "mount": "/mnt/build",
+#                "type": "virtiofs", "readonly": true} ]
+# 9p goes through qemu itself. virtiofs needs a virtiofsd per share, started
+# before qemu and gone once qemu disconnects, and guest RAM qemu can share
+# with it. Shares with a "mount" get a cloud-init mounts entry, appended to
+# user-data as a second cloud-config part so the template stays untouched.
+import email
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+log = logging.getLogger(__name__)
+
+virtiofsd_paths=[ "/usr/libexec/virtiofsd", "/usr/lib/qemu/virtiofsd" ]
+daemon_timeout=10
+daemon_poll=0.05
+stop_timeout=5
+mount_options={
+	"virtiofs": "defaults,nofail",
+	"9p": "trans=virtio,version=9p2000.L,msize=524288,nofail",
+}
+# Appends the generated mounts instead of replacing those of user-data.
+merge_how="list(append)+dict(no_replace,recurse_list)+str()"
+
+def virtiofsd_path():
+	found = shutil.which("virtiofsd")
+	if found is not None:
+		return found
+	for path in virtiofsd_paths:
+		if os.path.isfile(path):
+			return path
+	return "virtiofsd"
+
+class Share:
+	def __init__(self, spec, index, vm_dir, backend):
+		if not isinstance(spec, dict):
+			raise TypeError("share must be dictionary")
+		name = os.path.basename(vm_dir)
+		self.source = os.path.abspath(os.path.join(vm_dir, spec["source"]))
+		self.tag = spec.get("tag", f"share{index}")
+		self.type = spec.get("type", backend.default_share)
+		self.readonly = spec.get("readonly", False)
+		self.mount = spec.get("mount")
+		self.options = spec.get("options", mount_options[self.type])
+		self.cache = spec.get("cache", "auto")
+		self.id = f"fs{index}"
+		self.socket_path = os.path.join(vm_dir, f"{name}.{self.tag}.fs")
+		self.log_path = os.path.join(vm_dir, f"{name}.{self.tag}.virtiofsd.log")
+		self.backend = backend
+
+	def data(self):
+		return self.backend.share(self)
+
+	def daemon(self):
+		# virtiofsd argv, the socket it will listen on and its log file.
+		if self.type != "virtiofs":
+			return None
+		argv = [ virtiofsd_path(), f"--socket-path={self.socket_path}",
+			f"--shared-dir={self.source}", f"--cache={self.cache}" ]
+		if self.readonly:
+			argv.append("--readonly")
+		if os.geteuid() != 0:
+			# The namespace sandbox needs root.
+			argv.append("--sandbox=none")
+		return (tuple(argv), self.socket_path, self.log_path)
+
+	def mount_entry(self):
+		options = self.options + (",ro" if self.readonly else "")
+		return [ self.tag, self.mount, self.type, options, "0", "0" ]
+
+def from_specs(specs, vm_dir, backend):
+	return [ Share(spec, i, vm_dir, backend) for i, spec in enumerate(specs.get("shares", [])) ]
+
+def shared_memory(shares):
+	return any(share.type == "virtiofs" for share in shares)
+
+def cloud_config(shares):
+	entries = [ share.mount_entry() for share in shares if share.mount is not None ]
+	if len(entries) == 0:
+		return None
+	lines = [ "#cloud-config", f"merge_how: '{merge_how}'", "mounts:" ]
+	for entry in entries:
+		lines.append("  - [ " + ", ".join(f"\"{field}\"" for field in entry) + " ]")
+	return "\n".join(lines) + "\n"
+
+def seed_files(files, shares):
+	# files are the (name, data) pairs of the seed image.
+	config = cloud_config(shares)
+	if config is None:
+		return files
+	files = dict(files)
+	if "user-data" not in files:
+		files["user-data"] = config.encode('utf-8')
+	else:
+		message = email.message_from_bytes(files["user-data"])
+		if not message.is_multipart():
+			text = files["user-data"].decode('utf-8')
+			# A fixed boundary keeps the seed image, and its cache entry,
+			# the same from one start to the next.
+			boundary = hashlib.sha256((text + config).encode('utf-8')).hexdigest()[:32]
+			message = MIMEMultipart(boundary=f"=={boundary}==")
+			message.attach(MIMEText(text, "x-shellscript" if text.startswith("#!") else "cloud-config", "utf-8"))
+		message.attach(MIMEText(config, "cloud-config", "utf-8"))
+		files["user-data"] = message.as_bytes()
+	return list(files.items())
+
+def start_daemon(argv, socket_path, log_path, timeout=daemon_timeout):
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	with open(log_path, "ab") as f:
+		proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT,
+			start_new_session=True)
+	deadline = time.monotonic() + timeout
+	while not os.path.exists(socket_path):
+		if proc.poll() is not None:
+			raise Exception(f"virtiofsd exited with {proc.returncode}, see {log_path}")
+		if time.monotonic() > deadline:
+			proc.kill()
+			proc.wait()
+			raise Exception(f"virtiofsd didn't create {socket_path}")
+		time.sleep(daemon_poll)
+	log.debug("virtiofsd %d serving %s", proc.pid, socket_path)
+	return proc
+
+def start_daemons(daemons):
+	procs = []
+	try:
+		for argv, socket_path, log_path in daemons:
+			procs.append(start_daemon(list(argv), socket_path, log_path))
+	except BaseException:
+		stop_daemons(procs)
+		raise
+	return procs
+
+def stop_daemons(procs):
+	# They exit by themselves once qemu goes away, this covers the rest.
+	for proc in procs:
+		if proc.poll() is None:
+			proc.terminate()
+	for proc in procs:
+		try:
+			proc.wait(stop_timeout)
+		except subprocess.TimeoutExpired:
+			proc.kill()
+			proc.wait()
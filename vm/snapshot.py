@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# Fast start from a memory snapshot. A VM is booted once from fresh drives,
+# and when the guest is up its RAM and device state is migrated to a file
+# and its overlay drives are copied next to it. Later starts put a fresh
+# qcow2 overlay on top of each saved drive and resume from the file with
+# -incoming instead of booting.
+# Snapshots live in images/snapshots/<vm>/<key>, where the key covers the
+# specs, the cloud-init seed, the base images and the qemu binary, so any
+# change to those makes the old snapshot unusable and it gets replaced.
+import asyncio
+from qemu.qmp import QMPClient
+import agent
+import argparse
+import hashlib
+import images
+import json
+import logging
+import orchestrator
+import os
+import pool
+import shlex
+import shutil
+import stat
+import sys
+import threading
+import time
+import vm_start_macos
+from datetime import datetime
+from subprocess import DEVNULL, STDOUT
+from vm_start_macos import VirtualMachine
+
+log = logging.getLogger("snapshot")
+logging.basicConfig(stream=sys.stderr)
+
+# Bump when the snapshot layout changes so old snapshots get replaced.
+snapshot_version=2
+default_ready_timeout=900
+migrate_poll=0.1
+stop_timeout=30
+state_name="state"
+manifest_name="manifest.json"
+
+def snapshot_key(vm):
+	h = hashlib.sha256(f"snapshot:{snapshot_version}".encode('ascii'))
+	h.update(json.dumps(vm.specs, sort_keys=True).encode('utf-8'))
+	if vm.metadata.floppy_path is not None:
+		for name, data in vm.metadata.files():
+			h.update(name.encode('utf-8') + b"\0" + hashlib.sha256(data).digest())
+	registry = images.Registry(vm_start_macos.images_path)
+	for drive in vm.drives:
+		if drive.baseimage is None:
+			h.update(b"-")
+			continue
+		name = registry.name_of(drive.baseimage)
+		if name is not None:
+			h.update(registry.checksum(name).encode('ascii'))
+		else:
+			st = os.stat(drive.baseimage)
+			h.update(f"{drive.baseimage}:{st.st_size}:{st.st_mtime}".encode('utf-8'))
+	st = os.stat(vm.qemu_bin)
+	h.update(f"{vm.qemu_bin}:{st.st_size}:{st.st_mtime}".encode('utf-8'))
+	return h.hexdigest()
+
+async def wait_migration(qmp):
+	while True:
+		status = (await qmp.execute('query-migrate')).get("status")
+		if status == "completed":
+			return
+		if status in ("failed", "cancelled"):
+			raise Exception(f"Migration {status}")
+		await asyncio.sleep(migrate_poll)
+
+def set_guest_clock(vm, timeout):
+	# The guest clock stops while the snapshot sits on disk.
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			with agent.QemuAgent(vm.agent_path, timeout=1) as q:
+				q.guest_set_time(datetime.now())
+				log.debug("%s: guest clock set", vm.name)
+				return
+		except Exception as e:
+			log.debug("%s: %s", vm.name, e)
+			time.sleep(orchestrator.ping_interval)
+	log.warning("%s: unable to set the guest clock", vm.name)
+
+class Snapshot:
+	def __init__(self, vm):
+		self.vm = vm
+		self.key = snapshot_key(vm)
+		self.base = os.path.join(vm_start_macos.images_path, "snapshots", vm.name)
+		self.dir = os.path.join(self.base, self.key[:16])
+		self.state_file = os.path.join(self.dir, state_name)
+		self.manifest_file = os.path.join(self.dir, manifest_name)
+
+	def exists(self):
+		return os.path.isfile(self.manifest_file)
+
+	def incoming(self):
+		return "exec:cat " + shlex.quote(self.state_file)
+
+	def restore_drives(self):
+		# The saved drives stay read-only, each start writes to its own overlay.
+		for drive in self.vm.drives:
+			src = os.path.join(self.dir, drive.id)
+			if os.path.exists(drive.file):
+				os.remove(drive.file)
+			images.qemu_img([ "create", "-f", "qcow2", "-b", src, "-F", "qcow2", drive.file ])
+
+	def start(self, stdin=None, stdout=None, stderr=None):
+		self.restore_drives()
+		return self.vm.start(stdin=stdin, stdout=stdout, stderr=stderr, incoming=self.incoming())
+
+	async def save(self, tmp_dir):
+		qmp = QMPClient(self.vm.name)
+		await qmp.connect(self.vm.monitor_path)
+		try:
+			# No 'stop' first: the destination resumes in the runstate the
+			# source had, and migrate stops the VM when it completes anyway.
+			state = os.path.join(tmp_dir, state_name)
+			await qmp.execute('migrate', {"uri": "exec:cat > " + shlex.quote(state)})
+			await wait_migration(qmp)
+			await qmp.execute('quit')
+		finally:
+			try:
+				await qmp.disconnect()
+			except Exception:
+				pass
+
+	async def capture(self, ready_timeout=default_ready_timeout, wait_cloud_init=True):
+		# Starts over from fresh drives, so the snapshot is a clean first boot.
+		await asyncio.to_thread(self.vm.cleanup)
+		self.vm = VirtualMachine(self.vm.dir)
+		vm = self.vm
+		tmp_dir = self.dir + ".tmp"
+		if os.path.isdir(tmp_dir):
+			shutil.rmtree(tmp_dir)
+		os.makedirs(tmp_dir)
+		start = time.monotonic()
+		console = open(os.path.join(vm.dir, f"{vm.name}.log"), "ab")
+		try:
+			proc = vm.start(stdin=DEVNULL, stdout=console, stderr=STDOUT)
+		finally:
+			console.close()
+		try:
+			await orchestrator.wait_agent(vm, proc, ready_timeout)
+			if wait_cloud_init:
+				await asyncio.wait_for(pool.wait_cloud_init(vm, ready_timeout), ready_timeout)
+			log.info("%s: booted in %.2fs, saving state", vm.name, time.monotonic() - start)
+			await self.save(tmp_dir)
+			await asyncio.to_thread(proc.wait, stop_timeout)
+		except BaseException:
+			if proc.poll() is None:
+				proc.kill()
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+			raise
+		finally:
+			await asyncio.to_thread(vm.stop)
+		for drive in vm.drives:
+			dest = os.path.join(tmp_dir, drive.id)
+			shutil.copyfile(drive.file, dest)
+			os.chmod(dest, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+		with open(os.path.join(tmp_dir, manifest_name), "w") as f:
+			json.dump({
+				"vm": vm.name,
+				"key": self.key,
+				"version": snapshot_version,
+				"created": time.time(),
+				"drives": [ drive.id for drive in vm.drives ],
+				"boot_seconds": time.monotonic() - start,
+			}, f, indent=2)
+		if os.path.isdir(self.dir):
+			shutil.rmtree(self.dir)
+		os.replace(tmp_dir, self.dir)
+		self.prune()
+		log.info("%s: snapshot %s saved", vm.name, self.key[:16])
+
+	def in_use(self):
+		# Snapshot directories backing the current drives of the VM.
+		used = set()
+		for drive in self.vm.drives:
+			if not drive.exists():
+				continue
+			try:
+				chain = images.backing_chain(drive.file)
+			except Exception as e:
+				log.debug("%s: %s", drive.file, e)
+				continue
+			for path in chain[1:]:
+				if os.path.dirname(path).startswith(self.base + os.sep):
+					used.add(os.path.dirname(path))
+		return used
+
+	def prune(self):
+		# Snapshots with another key belong to old specs or base images.
+		if not os.path.isdir(self.base):
+			return []
+		removed = []
+		used = self.in_use()
+		for name in os.listdir(self.base):
+			path = os.path.join(self.base, name)
+			if path in used:
+				log.info("%s: keeping snapshot %s, its drives are still in use", self.vm.name, name)
+				continue
+			if path != self.dir and os.path.isdir(path):
+				shutil.rmtree(path)
+				removed.append(name)
+				log.info("%s: removed stale snapshot %s", self.vm.name, name)
+		return removed
+
+def run(vm_dir, ephemeral=False, ready_timeout=default_ready_timeout):
+	vm = VirtualMachine(vm_dir)
+	snapshot = Snapshot(vm)
+	if snapshot.exists():
+		log.info("%s: resuming from snapshot %s", vm.name, snapshot.key[:16])
+		snapshot.restore_drives()
+		threading.Thread(target=set_guest_clock, args=(vm, ready_timeout), daemon=True).start()
+		ret = vm.run(incoming=snapshot.incoming())
+	else:
+		log.warning("%s: no snapshot for the current specs, booting", vm.name)
+		ret = vm.run()
+	if ephemeral:
+		vm.cleanup()
+	return ret
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Capture and resume VM memory snapshots.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p = sub.add_parser("capture", help="Boot the VM from fresh drives and save its state.")
+	p.add_argument("vm")
+	p.add_argument("-t", "--ready-timeout", type=float, default=default_ready_timeout)
+	p.add_argument("--no-cloud-init", action="store_true", help="Only wait for guest-ping.")
+	p = sub.add_parser("run", help="Resume the VM from its snapshot, or boot it if there is none.")
+	p.add_argument("vm")
+	p.add_argument("-e", "--ephemeral", action="store_true", help="Throw the drives away on exit.")
+	p = sub.add_parser("status", help="Show whether the snapshot matches the current specs.")
+	p.add_argument("vm", nargs="+")
+	p = sub.add_parser("prune", help="Remove snapshots that no longer match.")
+	p.add_argument("vm", nargs="+")
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+	if os.getenv('MONITOR_DEBUG') != '1':
+		logging.getLogger("qemu.qmp").setLevel('CRITICAL')
+
+	if args.command == "capture":
+		snapshot = Snapshot(VirtualMachine(args.vm))
+		asyncio.run(snapshot.capture(args.ready_timeout, not args.no_cloud_init))
+		return 0
+	if args.command == "run":
+		return run(args.vm, args.ephemeral)
+	for vm_dir in args.vm:
+		snapshot = Snapshot(VirtualMachine(vm_dir))
+		if args.command == "status":
+			print("%s: %s %s" % (snapshot.vm.name, snapshot.key[:16], "current" if snapshot.exists() else "missing"))
+		else:
+			snapshot.prune()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
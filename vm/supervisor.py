@@ -0,0 +1,430 @@
+#!/usr/bin/python3
+# Runs the VMs of a host from one process. Every VM is a qemu child of the
+# supervisor with its console captured, restarted with backoff according to
+# its restart policy ("no", "on-failure" or "always", from --restart or a
+# "restart" key in specs.json) and shut down gracefully on stop. Clients
+# talk to it over a UNIX socket with guest agent style JSON lines:
+#   {"execute": "status"}
+#   {"execute": "start", "arguments": {"name": ...}}
+#   {"execute": "stop", "arguments": {"name": ...}}
+#   {"execute": "restart", "arguments": {"name": ...}}
+#   {"execute": "add", "arguments": {"dir": ..., "restart": ..., "start": true}}
+#   {"execute": "tail", "arguments": {"name": ..., "bytes": ...}}
+#   {"execute": "shutdown"}
+import asyncio
+from qemu.qmp import QMPClient
+import agent
+import argparse
+import console
+import json
+import logging
+import os
+import plan
+import shares
+import signal
+import socket
+import sys
+import time
+from subprocess import DEVNULL, PIPE, STDOUT
+
+log = logging.getLogger("supervisor")
+logging.basicConfig(stream=sys.stderr)
+
+default_socket="supervisor.sock"
+default_restart="on-failure"
+restart_policies=[ "no", "on-failure", "always" ]
+backoff_min=1
+backoff_max=60
+# A VM that stayed up this long starts over with the shortest backoff.
+stable_seconds=60
+shutdown_timeout=60
+terminate_timeout=10
+request_timeout=2
+tail_bytes=4096
+daemon_check=1
+
+class ManagedVM:
+	def __init__(self, vm_dir, restart=None):
+		# restart only applies to VMs without their own in specs.json.
+		self.dir = os.path.abspath(vm_dir)
+		self.name = os.path.basename(self.dir)
+		with open(os.path.join(self.dir, "specs.json"), "r") as f:
+			restart = json.load(f).get("restart", restart or default_restart)
+		if restart not in restart_policies:
+			raise TypeError(f"Unknown restart policy {restart}")
+		self.restart = restart
+		self.console = console.Console(self.name, os.path.join(self.dir, f"{self.name}.log"))
+		self.plan = None
+		self.proc = None
+		self.pinning = None
+		self.virtiofsd = []
+		self.lost_share = False
+		self.task = None
+		self.wanted = False
+		self.wake = asyncio.Event()
+		self.state = "stopped"
+		self.since = time.monotonic()
+		self.backoff = backoff_min
+		self.restarts = 0
+		self.last_exit = None
+
+	def set_state(self, state):
+		log.info("%s: %s", self.name, state)
+		self.state = state
+		self.since = time.monotonic()
+
+	def status(self):
+		return {
+			"state": self.state,
+			"seconds": round(time.monotonic() - self.since, 1),
+			"pid": self.proc.pid if self.proc is not None and self.proc.returncode is None else None,
+			"restart": self.restart,
+			"restarts": self.restarts,
+			"last_exit": self.last_exit,
+		}
+
+	async def pump(self):
+		while True:
+			data = await self.proc.stdout.read(console.read_size)
+			if len(data) == 0:
+				break
+			self.console.feed(data)
+		self.console.flush()
+
+	async def launch(self):
+		# Restarts reuse the cached plan while specs.json and the files it
+		# refers to are unchanged.
+		self.plan = await asyncio.to_thread(plan.load, self.dir)
+		await asyncio.to_thread(plan.prepare, self.plan)
+		argv, placed = await asyncio.to_thread(plan.argv, self.plan)
+		self.virtiofsd = await asyncio.to_thread(shares.start_daemons, self.plan.daemons)
+		try:
+			# Own session, so a ^C meant for the supervisor doesn't reach qemu.
+			self.proc = await asyncio.create_subprocess_exec(*argv,
+				stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+		except BaseException:
+			await asyncio.to_thread(shares.stop_daemons, self.virtiofsd)
+			raise
+		log.info("%s: started, pid %d", self.name, self.proc.pid)
+		self.lost_share = False
+		if len(self.virtiofsd) > 0:
+			asyncio.create_task(self.watch_daemons(self.proc, self.virtiofsd))
+		if placed is not None:
+			self.pinning = asyncio.create_task(placed.apply(self.plan.monitor_path, self.proc.pid))
+
+	async def watch_daemons(self, proc, daemons):
+		# A share is gone for good once its virtiofsd dies, so qemu is
+		# stopped too and the restart policy brings both back.
+		while proc.returncode is None:
+			for daemon in daemons:
+				if daemon.poll() is not None and proc.returncode is None:
+					log.error("%s: virtiofsd exited with %s, stopping qemu", self.name, daemon.returncode)
+					self.lost_share = True
+					try:
+						proc.terminate()
+					except ProcessLookupError:
+						pass
+					return
+			await asyncio.sleep(daemon_check)
+
+	async def request_shutdown(self):
+		q = agent.AsyncQemuAgent(self.plan.agent_path, timeout=request_timeout)
+		try:
+			await q.connect()
+		except Exception as e:
+			log.debug("%s: no guest agent: %s", self.name, e)
+			q = None
+		if q is not None:
+			try:
+				reply = await q.request("guest-shutdown", {"mode": "powerdown"}, timeout=request_timeout)
+			except Exception:
+				# qemu-ga doesn't reply when the shutdown goes ahead, and the
+				# guest may be gone before anything comes back.
+				reply = {}
+			finally:
+				await q.close()
+			if "error" not in reply:
+				return "guest-shutdown"
+			log.debug("%s: guest-shutdown failed: %s", self.name, reply["error"])
+		qmp = QMPClient(self.name)
+		try:
+			await asyncio.wait_for(qmp.connect(self.plan.monitor_path), request_timeout)
+			await qmp.execute('system_powerdown')
+			return "system_powerdown"
+		except Exception as e:
+			log.debug("%s: system_powerdown failed: %s", self.name, e)
+		finally:
+			try:
+				await qmp.disconnect()
+			except Exception:
+				pass
+		return None
+
+	async def shutdown(self, timeout=shutdown_timeout):
+		proc = self.proc
+		if proc is None or proc.returncode is not None:
+			return
+		self.set_state("stopping")
+		how = await self.request_shutdown()
+		if how is not None:
+			log.info("%s: sent %s", self.name, how)
+			try:
+				await asyncio.wait_for(proc.wait(), timeout)
+				return
+			except asyncio.TimeoutError:
+				log.warning("%s: still running %ss after %s", self.name, timeout, how)
+		try:
+			proc.terminate()
+			await asyncio.wait_for(proc.wait(), terminate_timeout)
+		except ProcessLookupError:
+			pass
+		except asyncio.TimeoutError:
+			log.warning("%s: killing", self.name)
+			try:
+				proc.kill()
+			except ProcessLookupError:
+				pass
+		await proc.wait()
+
+	async def supervise(self):
+		while self.wanted:
+			self.set_state("starting")
+			started = time.monotonic()
+			try:
+				await self.launch()
+			except Exception as e:
+				log.error("%s: unable to start: %s", self.name, e)
+				code = None
+			else:
+				if self.wanted:
+					self.set_state("running")
+				else:
+					# Stopped while qemu was being launched.
+					await self.shutdown()
+				await self.pump()
+				code = await self.proc.wait()
+				await asyncio.to_thread(shares.stop_daemons, self.virtiofsd)
+			self.last_exit = code
+			if not self.wanted:
+				break
+			log.warning("%s: exited with %s", self.name, code)
+			if self.restart == "no" or (self.restart == "on-failure" and code == 0 and not self.lost_share):
+				self.wanted = False
+				break
+			if time.monotonic() - started > stable_seconds:
+				self.backoff = backoff_min
+			self.set_state("backoff")
+			self.wake.clear()
+			try:
+				await asyncio.wait_for(self.wake.wait(), self.backoff)
+			except asyncio.TimeoutError:
+				pass
+			self.backoff = min(self.backoff * 2, backoff_max)
+			self.restarts += 1
+		self.set_state("stopped")
+
+	def start(self):
+		if self.task is not None and not self.task.done():
+			raise Exception(f"{self.name} is already {self.state}")
+		self.wanted = True
+		self.backoff = backoff_min
+		self.task = asyncio.create_task(self.supervise())
+
+	async def stop(self, timeout=shutdown_timeout):
+		self.wanted = False
+		self.wake.set()
+		await self.shutdown(timeout)
+		if self.task is not None:
+			await self.task
+
+class Supervisor:
+	def __init__(self, sockpath=default_socket, shutdown_timeout=shutdown_timeout):
+		self.sockpath = os.path.abspath(sockpath)
+		self.shutdown_timeout = shutdown_timeout
+		self.vms = {}
+		self.done = None
+
+	def add(self, vm_dir, restart=None):
+		vm = ManagedVM(vm_dir, restart)
+		if vm.name in self.vms:
+			raise Exception(f"{vm.name} is already supervised")
+		self.vms[vm.name] = vm
+		return vm
+
+	def get(self, name):
+		if name not in self.vms:
+			raise Exception(f"Unknown VM {name}")
+		return self.vms[name]
+
+	async def handle(self, message):
+		command = message.get("execute")
+		arguments = message.get("arguments", {})
+		if command == "status":
+			return { name: vm.status() for name, vm in self.vms.items() }
+		if command == "start":
+			self.get(arguments.get("name")).start()
+			return {}
+		if command == "stop":
+			await self.get(arguments.get("name")).stop(arguments.get("timeout", self.shutdown_timeout))
+			return {}
+		if command == "restart":
+			vm = self.get(arguments.get("name"))
+			await vm.stop(arguments.get("timeout", self.shutdown_timeout))
+			vm.start()
+			return {}
+		if command == "add":
+			vm = self.add(arguments["dir"], arguments.get("restart"))
+			if arguments.get("start", True):
+				vm.start()
+			return {"name": vm.name}
+		if command == "tail":
+			data = self.get(arguments.get("name")).console.tail(arguments.get("bytes", tail_bytes))
+			return data.decode('utf-8', errors='replace')
+		if command == "shutdown":
+			self.done.set()
+			return {}
+		raise Exception(f"Unknown command {command}")
+
+	async def handle_client(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if len(line) == 0:
+					break
+				message = None
+				try:
+					message = json.loads(line)
+					reply = {"return": await self.handle(message)}
+				except Exception as e:
+					reply = {"error": {"class": "GenericError", "desc": str(e) or e.__class__.__name__}}
+				if isinstance(message, dict) and "id" in message:
+					reply["id"] = message["id"]
+				writer.write(json.dumps(reply).encode('utf-8') + b"\n")
+				await writer.drain()
+		except (ConnectionError, asyncio.CancelledError):
+			# Cancelled when the supervisor shuts down.
+			pass
+		finally:
+			writer.close()
+
+	async def flush_consoles(self):
+		while True:
+			await asyncio.sleep(console.flush_interval)
+			for vm in self.vms.values():
+				vm.console.flush()
+
+	async def run(self, autostart=True):
+		self.done = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, self.done.set)
+		if os.path.exists(self.sockpath):
+			os.remove(self.sockpath)
+		server = await asyncio.start_unix_server(self.handle_client, self.sockpath)
+		flusher = asyncio.create_task(self.flush_consoles())
+		if autostart:
+			for vm in self.vms.values():
+				vm.start()
+		log.info("Supervising %d VMs, control socket %s", len(self.vms), self.sockpath)
+		try:
+			await self.done.wait()
+		finally:
+			log.info("Shutting down")
+			server.close()
+			await asyncio.gather(*[ vm.stop(self.shutdown_timeout) for vm in self.vms.values() ],
+				return_exceptions=True)
+			flusher.cancel()
+			for vm in self.vms.values():
+				vm.console.close()
+			if os.path.exists(self.sockpath):
+				os.remove(self.sockpath)
+
+def request(sockpath, command, arguments=None, timeout=None):
+	message = {"execute": command}
+	if arguments is not None:
+		message["arguments"] = arguments
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+		s.settimeout(timeout)
+		s.connect(sockpath)
+		s.sendall(json.dumps(message).encode('utf-8') + b"\n")
+		buf = b""
+		while not buf.endswith(b"\n"):
+			data = s.recv(65536)
+			if len(data) == 0:
+				raise Exception("Supervisor closed the connection")
+			buf += data
+	return agent.parse_reply(json.loads(buf))
+
+def daemonize(log_file, pid_file=None):
+	if os.fork() > 0:
+		os._exit(0)
+	os.setsid()
+	if os.fork() > 0:
+		os._exit(0)
+	fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+	null = os.open(os.devnull, os.O_RDONLY)
+	os.dup2(null, 0)
+	os.dup2(fd, 1)
+	os.dup2(fd, 2)
+	os.close(fd)
+	os.close(null)
+	if pid_file is not None:
+		with open(pid_file, "w") as f:
+			f.write(f"{os.getpid()}\n")
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Run and supervise many VMs from one process.")
+	parser.add_argument("-s", "--socket", default=os.path.abspath(default_socket), help="Control socket.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p = sub.add_parser("run", help="Run the supervisor.")
+	p.add_argument("vm", nargs="*", help="VM directories.")
+	p.add_argument("-r", "--restart", choices=restart_policies,
+		help=f"Restart policy of VMs without a \"restart\" in specs.json (default {default_restart}).")
+	p.add_argument("-t", "--shutdown-timeout", type=float, default=shutdown_timeout)
+	p.add_argument("-n", "--no-start", action="store_true", help="Don't start the VMs right away.")
+	p.add_argument("-d", "--daemon", metavar="LOG", help="Detach and log to LOG.")
+	p.add_argument("-p", "--pid-file")
+	sub.add_parser("status")
+	sub.add_parser("shutdown")
+	for command in ("start", "stop", "restart"):
+		p = sub.add_parser(command)
+		p.add_argument("name")
+	p = sub.add_parser("add")
+	p.add_argument("dir")
+	p.add_argument("-r", "--restart", choices=restart_policies,
+		help="Restart policy if specs.json has no \"restart\".")
+	p = sub.add_parser("tail")
+	p.add_argument("name")
+	p.add_argument("-c", "--bytes", type=int, default=tail_bytes)
+	args = parser.parse_args(argv[1:])
+	log.setLevel("INFO")
+	if os.getenv('MONITOR_DEBUG') != '1':
+		logging.getLogger("qemu.qmp").setLevel('CRITICAL')
+
+	if args.command == "run":
+		supervisor = Supervisor(args.socket, args.shutdown_timeout)
+		if args.daemon is not None:
+			daemonize(os.path.abspath(args.daemon), args.pid_file)
+		async def run():
+			for vm_dir in args.vm:
+				supervisor.add(vm_dir, args.restart)
+			await supervisor.run(not args.no_start)
+		asyncio.run(run())
+		return 0
+	if args.command in ("start", "stop", "restart"):
+		arguments = {"name": args.name}
+	elif args.command == "add":
+		arguments = {"dir": os.path.abspath(args.dir), "restart": args.restart}
+	elif args.command == "tail":
+		arguments = {"name": args.name, "bytes": args.bytes}
+	else:
+		arguments = None
+	ret = request(args.socket, args.command, arguments)
+	if args.command == "tail":
+		sys.stdout.write(ret)
+	else:
+		print(json.dumps(ret, indent=2))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
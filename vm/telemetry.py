@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# Samples block, vCPU, balloon and KVM statistics of every running VM over
+# QMP and exports rates as Prometheus text or JSON lines.
+import asyncio
+from qemu.qmp import QMPClient, ExecuteError
+import argparse
+import fleet
+import json
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger("telemetry")
+logging.basicConfig(stream=sys.stderr)
+
+default_interval=10
+sample_timeout=2
+rescan_seconds=30
+# The QMP socket qemu keeps for the sampler, see vm_start_macos.py.
+telemetry_suffix=".qmp-telemetry"
+clock_ticks=os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+block_counters = [
+	("rd_bytes", "read_bytes"),
+	("wr_bytes", "write_bytes"),
+	("rd_operations", "read_ops"),
+	("wr_operations", "write_ops"),
+	("flush_operations", "flush_ops"),
+]
+block_latencies = [
+	("rd_total_time_ns", "rd_operations", "read_latency_seconds"),
+	("wr_total_time_ns", "wr_operations", "write_latency_seconds"),
+	("flush_total_time_ns", "flush_operations", "flush_latency_seconds"),
+]
+
+def thread_cpu_seconds(tid):
+	# utime and stime of a host thread, fields 14 and 15 of /proc/<tid>/stat.
+	try:
+		with open(f"/proc/{tid}/stat", "r") as f:
+			stat = f.read()
+	except OSError:
+		return None
+	fields = stat[stat.rindex(")") + 2:].split()
+	return (int(fields[11]) + int(fields[12])) / clock_ticks
+
+class VMSampler:
+	def __init__(self, name, sockpath):
+		self.name = name
+		self.sockpath = sockpath
+		self.qmp = None
+		self.has_stats = True
+		self.previous = None
+
+	async def connect(self):
+		self.qmp = QMPClient(self.name)
+		await self.qmp.connect(self.sockpath)
+
+	async def close(self):
+		if self.qmp is None:
+			return
+		try:
+			await self.qmp.disconnect()
+		except Exception:
+			pass
+		self.qmp = None
+
+	async def query_stats(self):
+		if not self.has_stats:
+			return []
+		try:
+			return await self.qmp.execute('query-stats', {"target": "vm"})
+		except ExecuteError as e:
+			# Only available with KVM on newer QEMU versions.
+			log.debug("%s: query-stats unavailable: %s", self.name, e)
+			self.has_stats = False
+			return []
+
+	async def query_balloon(self):
+		try:
+			return await self.qmp.execute('query-balloon')
+		except ExecuteError:
+			return None
+
+	async def sample(self):
+		if self.qmp is None:
+			await self.connect()
+		blockstats, cpus, balloon, stats = await asyncio.gather(
+			self.qmp.execute('query-blockstats'),
+			self.qmp.execute('query-cpus-fast'),
+			self.query_balloon(),
+			self.query_stats())
+		sample = {
+			"time": time.monotonic(),
+			"blocks": {},
+			"cpus": {},
+			"balloon": balloon,
+			"stats": stats,
+		}
+		for block in blockstats:
+			device = block.get("device") or block.get("qdev") or block.get("node-name")
+			sample["blocks"][device] = block.get("stats", {})
+		for cpu in cpus:
+			sample["cpus"][cpu.get("cpu-index")] = thread_cpu_seconds(cpu.get("thread-id"))
+		return sample
+
+	def metrics(self, sample):
+		# Rates need two samples, so the first round only reports gauges.
+		prev = self.previous
+		self.previous = sample
+		out = []
+		vm = {"vm": self.name}
+		if sample["balloon"] is not None:
+			out.append(("vm_balloon_actual_bytes", vm, sample["balloon"].get("actual")))
+		out.append(("vm_vcpus", vm, len(sample["cpus"])))
+		for entry in sample["stats"]:
+			for stat in entry.get("stats", []):
+				if isinstance(stat.get("value"), (int, float)):
+					out.append((f"vm_{entry.get('provider', 'kvm')}_{stat['name'].replace('-', '_')}", vm, stat["value"]))
+		if prev is None:
+			return out
+		elapsed = sample["time"] - prev["time"]
+		if elapsed <= 0:
+			return out
+		for device, stats in sample["blocks"].items():
+			before = prev["blocks"].get(device)
+			if before is None:
+				continue
+			labels = dict(vm, device=device)
+			for key, name in block_counters:
+				if key in stats and key in before:
+					out.append((f"vm_block_{name}_per_second", labels, (stats[key] - before[key]) / elapsed))
+			for time_key, ops_key, name in block_latencies:
+				ops = stats.get(ops_key, 0) - before.get(ops_key, 0)
+				if ops > 0 and time_key in stats:
+					out.append((f"vm_block_{name}", labels, (stats[time_key] - before[time_key]) / ops / 1000000000))
+		for index, seconds in sample["cpus"].items():
+			before = prev["cpus"].get(index)
+			if seconds is None or before is None:
+				continue
+			out.append(("vm_vcpu_utilization_ratio", dict(vm, cpu=str(index)), (seconds - before) / elapsed))
+		return out
+
+def escape_label(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_prometheus(metrics):
+	lines = []
+	seen = set()
+	for name, labels, value in sorted(metrics, key=lambda m: m[0]):
+		if value is None:
+			continue
+		if name not in seen:
+			lines.append(f"# TYPE {name} gauge")
+			seen.add(name)
+		label_text = ",".join(f'{k}="{escape_label(v)}"' for k, v in sorted(labels.items()))
+		lines.append(f"{name}{{{label_text}}} {value}")
+	return "\n".join(lines) + "\n"
+
+def format_jsonl(metrics):
+	now = time.time()
+	return "".join(json.dumps({"time": now, "name": name, "labels": labels, "value": value}) + "\n"
+		for name, labels, value in metrics if value is not None)
+
+class Telemetry:
+	def __init__(self, vm_dirs, interval=default_interval):
+		self.vm_dirs = vm_dirs
+		self.interval = interval
+		self.samplers = {}
+
+	async def rescan(self):
+		sockets = fleet.discover(self.vm_dirs, suffix=telemetry_suffix)
+		for name, sampler in list(self.samplers.items()):
+			if sockets.get(name) != sampler.sockpath:
+				log.info("%s: gone", name)
+				del self.samplers[name]
+				await sampler.close()
+		for name, sockpath in sockets.items():
+			if name not in self.samplers:
+				self.samplers[name] = VMSampler(name, sockpath)
+
+	async def sample_one(self, sampler):
+		try:
+			sample = await asyncio.wait_for(sampler.sample(), sample_timeout)
+		except Exception as e:
+			log.warning("%s: %s", sampler.name, str(e) or e.__class__.__name__)
+			await sampler.close()
+			sampler.previous = None
+			return []
+		return sampler.metrics(sample)
+
+	async def collect(self):
+		results = await asyncio.gather(*[ self.sample_one(s) for s in self.samplers.values() ])
+		return [ m for metrics in results for m in metrics ]
+
+	async def close(self):
+		for sampler in self.samplers.values():
+			await sampler.close()
+
+	async def run(self, output, fmt):
+		last_rescan = 0
+		try:
+			while True:
+				start = time.monotonic()
+				if start - last_rescan > rescan_seconds:
+					await self.rescan()
+					last_rescan = start
+				metrics = await self.collect()
+				log.debug("Sampled %d VMs in %.3fs", len(self.samplers), time.monotonic() - start)
+				write_metrics(metrics, output, fmt)
+				await asyncio.sleep(max(0, self.interval - (time.monotonic() - start)))
+		finally:
+			await self.close()
+
+def write_metrics(metrics, output, fmt):
+	if fmt == "prom":
+		text = format_prometheus(metrics)
+		if output is None:
+			sys.stdout.write(text)
+			sys.stdout.flush()
+			return
+		# Replace the file atomically, as the textfile collector expects.
+		tmp = output + ".tmp"
+		with open(tmp, "w") as f:
+			f.write(text)
+		os.replace(tmp, output)
+		return
+	text = format_jsonl(metrics)
+	if output is None:
+		sys.stdout.write(text)
+		sys.stdout.flush()
+		return
+	with open(output, "a") as f:
+		f.write(text)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Sample QMP performance counters of all running VMs.")
+	parser.add_argument("-i", "--interval", type=float, default=default_interval)
+	parser.add_argument("-f", "--format", choices=["prom", "jsonl"], default="prom")
+	parser.add_argument("-o", "--output",
+		help="Prometheus file to replace, or JSON lines file to append to. Defaults to stdout.")
+	parser.add_argument("vm", nargs="+", help="VM directory, or a directory holding VM directories.")
+	args = parser.parse_args(argv[1:])
+	if os.getenv('MONITOR_DEBUG') == '1':
+		log.setLevel('DEBUG')
+	else:
+		logging.getLogger("qemu.qmp").setLevel('CRITICAL')
+	try:
+		asyncio.run(Telemetry(args.vm, args.interval).run(args.output, args.format))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main(sys.argv)
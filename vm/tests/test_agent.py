@@ -0,0 +1,89 @@
+import agent
+import asyncio
+import pytest
+from fake_agent import FakeAgent
+
+@pytest.fixture
+def slow_agent(tmp_path):
+	with FakeAgent(str(tmp_path / "vm.agent"), latency=0.3) as fake:
+		yield fake
+
+def test_reply_after_timeout_is_dropped(slow_agent):
+	with agent.QemuAgent(slow_agent.sockpath, timeout=0.1) as q:
+		with pytest.raises(TimeoutError):
+			q.guest_get_host_name()
+		q.timeout = 5
+		# Would be the late host name without the resync.
+		assert q.guest_get_osinfo()["id"] == "ubuntu"
+		assert q.guest_get_host_name() == { "host-name": "vm" }
+
+def test_async_timeout_forgets_request(slow_agent):
+	async def run():
+		async with agent.AsyncQemuAgent(slow_agent.sockpath, timeout=5) as q:
+			with pytest.raises(asyncio.TimeoutError):
+				await q.execute("guest-get-host-name", timeout=0.1)
+			assert len(q._pending) == 0
+			assert (await q.execute("guest-get-osinfo"))["id"] == "ubuntu"
+			assert len(q._pending) == 0
+	asyncio.run(run())
+
+def test_fact_cache_hit_has_no_agent_traffic(tmp_path):
+	with FakeAgent(str(tmp_path / "vm.agent")) as fake:
+		cache = agent.FactCache()
+		with agent.QemuAgent(fake.sockpath, cache=cache) as q:
+			osinfo = q.guest_get_osinfo()
+			# The boot id is read along with the first fetch.
+			assert fake.calls == {"guest-get-osinfo": 1,
+				"guest-file-open": 1, "guest-file-read": 1, "guest-file-close": 1}
+			calls = dict(fake.calls)
+			assert q.guest_get_osinfo() == osinfo
+			assert q.guest_get_osinfo() == osinfo
+			assert fake.calls == calls
+			assert (cache.hits, cache.misses) == (2, 1)
+
+def test_fact_cache_drops_facts_on_reboot(tmp_path):
+	with FakeAgent(str(tmp_path / "vm.agent")) as fake:
+		cache = agent.FactCache(boot_check=0)
+		with agent.QemuAgent(fake.sockpath, cache=cache) as q:
+			q.guest_get_osinfo()
+			q.guest_get_osinfo()
+			assert fake.calls["guest-get-osinfo"] == 1
+			fake.reboot()
+			q.guest_get_osinfo()
+			assert fake.calls["guest-get-osinfo"] == 2
+			assert len(fake.files) == 0
+
+def test_parse_reply():
+	assert agent.parse_reply({"return": {"pid": 1}}) == {"pid": 1}
+	with pytest.raises(Exception, match="CommandNotFound: nope"):
+		agent.parse_reply({"error": {"class": "CommandNotFound", "desc": "nope"}})
+	with pytest.raises(Exception, match="Invalid output"):
+		agent.parse_reply({"id": 1})
+
+def test_async_pipelined_replies_match_requests(tmp_path):
+	async def run():
+		with FakeAgent(str(tmp_path / "vm.agent"), latency=0.01):
+			async with agent.AsyncQemuAgent(str(tmp_path / "vm.agent")) as q:
+				ids = list(range(100, 120))
+				got = await asyncio.gather(*[ q.execute("guest-sync", {"id": id}) for id in ids ])
+				assert got == ids
+				with pytest.raises(Exception, match="CommandNotFound"):
+					await q.execute("guest-nope")
+				assert await q.guest_ping()
+				assert len(q._pending) == 0
+	asyncio.run(run())
+
+def test_async_reply_without_id_goes_to_oldest(tmp_path):
+	async def run():
+		q = agent.AsyncQemuAgent(str(tmp_path / "vm.agent"))
+		loop = asyncio.get_running_loop()
+		first, second = loop.create_future(), loop.create_future()
+		q._pending = { 1: first, 2: second }
+		q._dispatch({"return": "b", "id": 2})
+		# A late reply to a forgotten request isn't handed to anyone else.
+		q._dispatch({"return": "x", "id": 7})
+		q._dispatch({"return": "a"})
+		assert first.result() == {"return": "a"}
+		assert second.result() == {"return": "b", "id": 2}
+		assert len(q._pending) == 0
+	asyncio.run(run())
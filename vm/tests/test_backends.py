@@ -0,0 +1,98 @@
+import backends
+import shares
+import pytest
+from vm_start_macos import HardDrive, Nic
+
+kvm = backends.KvmBackend()
+hvf = backends.HvfBackend()
+mac = "52:54:00:00:00:01"
+
+def test_kvm_drives():
+	assert HardDrive({"file": "d.qcow2"}, 0, "/vm", kvm).data(planned=True) == [
+		"-object", "iothread,id=io-d.qcow2",
+		"-drive", "file=/vm/d.qcow2,if=none,id=d.qcow2,cache=none,aio=native,discard=unmap,detect-zeroes=unmap",
+		"-device", "virtio-blk,drive=d.qcow2,bootindex=0,iothread=io-d.qcow2",
+	]
+	# Native AIO needs O_DIRECT, so a cached drive falls back to threads.
+	assert HardDrive({"file": "s.qcow2", "bustype": "scsi-hd", "cache": "writeback"}, 1, "/vm", kvm).data(planned=True) == [
+		"-object", "iothread,id=io-s.qcow2",
+		"-device", "virtio-scsi-pci,id=scsi-s.qcow2,iothread=io-s.qcow2",
+		"-drive", "file=/vm/s.qcow2,if=none,id=s.qcow2,cache=writeback,aio=threads,discard=unmap,detect-zeroes=unmap",
+		"-device", "scsi-hd,drive=s.qcow2,bus=scsi-s.qcow2.0,bootindex=1",
+	]
+	assert HardDrive({"file": "q.qcow2", "aio": "io_uring", "queues": 4}, 2, "/vm", kvm).data(planned=True) == [
+		"-object", "iothread,id=io-q.qcow2",
+		"-drive", "file=/vm/q.qcow2,if=none,id=q.qcow2,cache=none,aio=io_uring,discard=unmap,detect-zeroes=unmap",
+		"-device", "virtio-blk,drive=q.qcow2,bootindex=2,iothread=io-q.qcow2,num-queues=4",
+	]
+
+def test_kvm_nics():
+	assert Nic({"type": "tap", "ifname": "tap0", "queues": 2, "mac": mac}, 0, kvm).data() == [
+		"-netdev", "tap,id=mynet0,ifname=tap0,script=no,downscript=no,vhost=on,queues=2",
+		"-device", f"virtio-net-pci,netdev=mynet0,mac={mac},mq=on,vectors=6",
+	]
+	# macOS templates keep working.
+	assert Nic({"type": "vmnet-shared", "mac": mac}, 1, kvm).data() == [
+		"-netdev", "user,id=mynet1",
+		"-device", f"virtio-net-pci,netdev=mynet1,mac={mac}",
+	]
+	assert Nic({"type": "vmnet-bridged", "ifname": "en0", "mac": mac}, 2, kvm).data() == [
+		"-netdev", "bridge,id=mynet2,br=en0",
+		"-device", f"virtio-net-pci,netdev=mynet2,mac={mac}",
+	]
+	with pytest.raises(TypeError):
+		Nic({"type": "vde", "mac": mac}, 0, kvm).data()
+
+def test_kvm_machine():
+	assert kvm.machine({"arch": "qemu-system-aarch64"}) == [
+		"-machine", "virt,gic-version=host", "-accel", "kvm", "-cpu", "host",
+		"-bios", "/usr/share/qemu-efi-aarch64/QEMU_EFI.fd",
+	]
+	assert kvm.machine({"arch": "qemu-system-x86_64"}) == [ "-machine", "q35", "-accel", "kvm", "-cpu", "host" ]
+	assert kvm.uefi({}) == [ "-drive", "file=/usr/share/OVMF/OVMF_CODE.fd,if=pflash,format=raw,readonly=on" ]
+	assert kvm.shared_memory({"ram": "512"}) == [
+		"-object", "memory-backend-memfd,id=mem0,size=512M,share=on",
+		"-numa", "node,nodeid=0,memdev=mem0",
+	]
+	assert kvm.channel({"type": "vsock", "cid": 5}, "/vm/vm.bulk") == [ "-device", "vhost-vsock-pci,guest-cid=5" ]
+
+def test_shares():
+	specs = {"shares": [ {"source": "/srv", "tag": "build", "readonly": True},
+		{"source": "/srv", "tag": "nine", "type": "9p"} ]}
+	assert [ s.data() for s in shares.from_specs(specs, "/vm", kvm) ] == [
+		[ "-chardev", "socket,id=fs0,path=/vm/vm.build.fs",
+			"-device", "vhost-user-fs-pci,chardev=fs0,tag=build,queue-size=1024" ],
+		[ "-fsdev", "local,id=fs1,path=/srv,security_model=none",
+			"-device", "virtio-9p-pci,fsdev=fs1,mount_tag=nine" ],
+	]
+	assert [ s.data() for s in shares.from_specs(specs, "/vm", hvf) ] == [
+		[ "-fsdev", "local,id=fs0,path=/srv,security_model=none,readonly=on",
+			"-device", "virtio-9p-pci,fsdev=fs0,mount_tag=build" ],
+		[ "-fsdev", "local,id=fs1,path=/srv,security_model=none",
+			"-device", "virtio-9p-pci,fsdev=fs1,mount_tag=nine" ],
+	]
+	specs["shares"][0]["type"] = "virtiofs"
+	with pytest.raises(TypeError):
+		shares.from_specs(specs, "/vm", hvf)[0].data()
+
+def test_hvf():
+	assert hvf.machine({"arch": "qemu-system-aarch64"}) == [
+		"-machine", "virt,highmem=on", "-accel", "hvf", "-cpu", "host", "-bios", "QEMU_EFI.fd",
+	]
+	assert HardDrive({"file": "d.qcow2"}, 0, "/vm", hvf).data(planned=True) == [
+		"-drive", "file=/vm/d.qcow2,if=none,id=d.qcow2,cache=writeback",
+		"-device", "virtio-blk,drive=d.qcow2,bootindex=0",
+	]
+	assert Nic({"mac": mac}, 0, hvf).data() == [
+		"-netdev", "vmnet-host,id=mynet0",
+		"-device", f"e1000,netdev=mynet0,mac={mac}",
+	]
+	assert hvf.channel({}, "/vm/vm.bulk") == [
+		"-chardev", "socket,path=/vm/vm.bulk,server=on,wait=off,id=bulk0",
+		"-device", "virtserialport,chardev=bulk0,name=vm.bulk.0",
+	]
+	with pytest.raises(TypeError):
+		hvf.channel({"type": "vsock", "cid": 5}, "/vm/vm.bulk")
+	assert backends.get("hvf").name == "hvf"
+	with pytest.raises(TypeError):
+		backends.get("xen")
@@ -0,0 +1,55 @@
+import bulk
+import json
+import os
+import signal
+import time
+from fake_agent import FakeAgent
+
+def alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	return True
+
+def wait_dead(pid, timeout=5):
+	deadline = time.monotonic() + timeout
+	while alive(pid) and time.monotonic() < deadline:
+		time.sleep(0.05)
+	return not alive(pid)
+
+def read_pid(path):
+	with open(path, "r") as f:
+		return int(f.read())
+
+def test_install_starts_receiver(tmp_path, monkeypatch):
+	# fake_agent runs guest-exec on the host, so the "guest" is tmp_path.
+	vm_dir = tmp_path / "vm"
+	vm_dir.mkdir()
+	(vm_dir / "specs.json").write_text(json.dumps({ "channel": { "type": "virtserial" } }))
+	monkeypatch.setattr(bulk, "guest_path", str(tmp_path / "vm-bulk"))
+	monkeypatch.setattr(bulk, "guest_pidfile", str(tmp_path / "vm-bulk.pid"))
+	monkeypatch.setattr(bulk, "receiver_args", lambda channel: [ "--unix", str(vm_dir / "vm.bulk") ])
+	pids = []
+	try:
+		with FakeAgent(str(vm_dir / "vm.agent")):
+			bulk.install(str(vm_dir), timeout=10)
+			pids.append(read_pid(bulk.guest_pidfile))
+			assert alive(pids[0])
+
+			src = tmp_path / "src"
+			src.write_bytes(os.urandom(100000))
+			with bulk.BulkChannel(str(vm_dir)) as channel:
+				channel.put(str(src), str(tmp_path / "dest"))
+			assert (tmp_path / "dest").read_bytes() == src.read_bytes()
+
+			# Installing again replaces the running receiver.
+			bulk.install(str(vm_dir), timeout=10)
+			pids.append(read_pid(bulk.guest_pidfile))
+			assert pids[1] != pids[0]
+			assert wait_dead(pids[0])
+			assert alive(pids[1])
+	finally:
+		for pid in pids:
+			if alive(pid):
+				os.kill(pid, signal.SIGTERM)
@@ -0,0 +1,47 @@
+import asyncio
+import fleet
+import os
+import socket
+import pytest
+from fake_agent import FakeAgent
+
+@pytest.fixture
+def agents(tmp_path):
+	fakes = []
+	for name in [ "vm1", "vm2", "vm3" ]:
+		os.makedirs(tmp_path / name)
+		fakes.append(FakeAgent(str(tmp_path / name / f"{name}.agent")))
+		fakes[-1].start()
+	yield tmp_path
+	for fake in fakes:
+		fake.stop()
+
+def test_discover_skips_stale_mux(agents):
+	# A socket file nobody listens on, as a killed broker leaves behind.
+	stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	stale.bind(str(agents / "vm1" / "vm1.agent.mux"))
+	stale.close()
+	live = FakeAgent(str(agents / "vm2" / "vm2.agent.mux"))
+	with live:
+		sockets = fleet.discover([ str(agents) ], prefer_mux=True)
+	assert sorted(sockets) == [ "vm1", "vm2", "vm3" ]
+	assert sockets["vm1"].endswith("vm1.agent")
+	assert sockets["vm2"].endswith("vm2.agent.mux")
+	assert fleet.discover([ str(agents / "vm3") ]) == { "vm3": str(agents / "vm3" / "vm3.agent") }
+
+def test_fan_out(agents):
+	sockets = fleet.discover([ str(agents) ])
+	sockets["gone"] = str(agents / "gone.agent")
+	executor = fleet.FleetExecutor(sockets, concurrency=2, timeout=10)
+	results = asyncio.run(executor.run("/bin/sh", [ "-c", "echo out; echo err >&2; exit 3" ]))
+	assert [ r.name for r in results ] == [ "gone", "vm1", "vm2", "vm3" ]
+	groups = fleet.aggregate(results)
+	assert sorted(groups) == [ "error", "exit 3" ]
+	assert [ r.name for r in groups["error"] ] == [ "gone" ]
+	for r in groups["exit 3"]:
+		assert (r.stdout, r.stderr) == (b"out\n", b"err\n")
+
+def test_fan_out_timeout(agents):
+	executor = fleet.FleetExecutor(fleet.discover([ str(agents) ]), timeout=0.5)
+	results = asyncio.run(executor.run("/bin/sleep", [ "5" ]))
+	assert all(r.status() == "error" and "timed out" in r.error for r in results)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import monitor
+import os
+from fake_qmp import FakeQMP
+
+class ListSink:
+	def __init__(self):
+		self.records = []
+
+	async def start(self):
+		pass
+
+	async def stop(self):
+		pass
+
+	def publish(self, record):
+		self.records.append(record)
+
+	def events(self):
+		return [ r["event"] for r in self.records ]
+
+async def wait_until(predicate, timeout=5):
+	deadline = asyncio.get_running_loop().time() + timeout
+	while not predicate():
+		assert asyncio.get_running_loop().time() < deadline, "timed out"
+		await asyncio.sleep(0.02)
+
+def test_events_survive_qemu_restart(tmp_path, monkeypatch):
+	monkeypatch.setattr(monitor, "reconnect_min", 0.05)
+	monkeypatch.setattr(monitor, "reconnect_max", 0.2)
+	logging.getLogger("qemu.qmp").setLevel('CRITICAL')
+	os.makedirs(tmp_path / "vm1")
+	sockpath = str(tmp_path / "vm1" / f"vm1{monitor.events_suffix}")
+	sink = ListSink()
+
+	async def run():
+		service = monitor.EventService([ str(tmp_path) ], [ sink ], [ "STOP", "BLOCK_JOB_*" ])
+		qmp = FakeQMP(sockpath, exclusive=True)
+		qmp.start()
+		task = asyncio.create_task(service.run())
+		try:
+			await wait_until(lambda: "MONITOR_CONNECTED" in sink.events())
+			qmp.emit("RESUME")
+			qmp.emit("STOP")
+			qmp.emit("BLOCK_JOB_COMPLETED", {"device": "d0"})
+			await wait_until(lambda: "BLOCK_JOB_COMPLETED" in sink.events())
+			qmp.stop()
+			await wait_until(lambda: "MONITOR_DISCONNECTED" in sink.events())
+			# qemu comes back on the same socket.
+			qmp = FakeQMP(sockpath, exclusive=True)
+			qmp.start()
+			await wait_until(lambda: sink.events().count("MONITOR_CONNECTED") == 2)
+			qmp.emit("STOP")
+			await wait_until(lambda: sink.events().count("STOP") == 2)
+		finally:
+			task.cancel()
+			await asyncio.gather(task, return_exceptions=True)
+			qmp.stop()
+
+	asyncio.run(run())
+	assert sink.events() == [ "MONITOR_CONNECTED", "STOP", "BLOCK_JOB_COMPLETED",
+		"MONITOR_DISCONNECTED", "MONITOR_CONNECTED", "STOP" ]
+	assert all(r["vm"] == "vm1" for r in sink.records)
+	assert sink.records[0]["data"] == {"status": "running"}
+	assert sink.records[2]["data"] == {"device": "d0"}
+
+def test_socket_sink_drops_stalled_clients(tmp_path, monkeypatch):
+	monkeypatch.setattr(monitor, "client_buffer_max", 64 * 1024)
+	path = str(tmp_path / "events.sock")
+
+	async def run():
+		sink = monitor.SocketSink(path)
+		await sink.start()
+		try:
+			# Never reads.
+			stalled = await asyncio.open_unix_connection(path)
+			reader, writer = await asyncio.open_unix_connection(path)
+			await wait_until(lambda: len(sink.clients) == 2)
+			received = []
+			async def read():
+				while True:
+					line = await reader.readline()
+					if len(line) == 0:
+						break
+					received.append(line)
+			task = asyncio.create_task(read())
+			record = {"vm": "vm1", "event": "STOP", "data": {"pad": "x" * 8192}}
+			for i in range(500):
+				sink.publish(record)
+				await asyncio.sleep(0)
+			await wait_until(lambda: len(received) == 500)
+			assert len(sink.clients) == 1
+			assert max(w.transport.get_write_buffer_size() for w in sink.clients) <= monitor.client_buffer_max
+			writer.close()
+			stalled[1].close()
+			task.cancel()
+		finally:
+			await sink.stop()
+	asyncio.run(run())
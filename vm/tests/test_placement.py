@@ -0,0 +1,69 @@
+import os
+import placement
+import pytest
+
+def write(root, path, text):
+	path = os.path.join(root, path)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "w") as f:
+		f.write(text + "\n")
+
+@pytest.fixture
+def topology(tmp_path):
+	# Two nodes of two cores with two threads each: 0+2 and 1+3 on node 0.
+	root = str(tmp_path / "root")
+	write(root, "sys/devices/system/cpu/online", "0-7")
+	for node, cpus in [ (0, "0-3"), (1, "4-7") ]:
+		write(root, f"sys/devices/system/node/node{node}/cpulist", cpus)
+		write(root, f"sys/devices/system/node/node{node}/hugepages/hugepages-2048kB/free_hugepages",
+			"0" if node == 0 else "300")
+	for cpu in range(8):
+		write(root, f"sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list",
+			placement.format_cpulist([ cpu & ~2, cpu | 2 ]))
+	write(root, "proc/mounts", "hugetlbfs /dev/hugepages hugetlbfs rw,relatime,pagesize=2M 0 0")
+	return placement.HostTopology(root)
+
+def test_parsers():
+	assert placement.parse_cpulist("0-2,5,7-8") == [ 0, 1, 2, 5, 7, 8 ]
+	assert placement.format_cpulist([ 8, 0, 1, 2, 5, 7 ]) == "0-2,5,7-8"
+	assert placement.parse_size("1.5G") == 1536 * 1024 * 1024
+	assert placement.parse_size("512") == 512 * 1024 * 1024
+	assert placement.parse_size("2MiB") == 2 * 1024 * 1024
+
+def test_topology(topology):
+	assert topology.nodes == { 0: [ 0, 1, 2, 3 ], 1: [ 4, 5, 6, 7 ] }
+	assert topology.cores[0] == [ (0, 2), (1, 3) ]
+	assert topology.hugepages[1] == { 2 * 1024 * 1024: 300 }
+	assert topology.mounts == { 2 * 1024 * 1024: "/dev/hugepages" }
+
+def test_vms_get_their_own_cores(topology, tmp_path):
+	ledger = str(tmp_path / "placement.json")
+	specs = {"cpus": "2", "ram": "1G", "placement": {}}
+	first = placement.plan("a", specs, ledger, topology)
+	assert (first.node, first.vcpu_cpus) == (0, [ [ 0, 2 ], [ 1, 3 ] ])
+	second = placement.plan("b", specs, ledger, topology)
+	assert (second.node, second.vcpu_cpus) == (1, [ [ 4, 6 ], [ 5, 7 ] ])
+	with pytest.raises(Exception, match="no room on any NUMA node"):
+		placement.plan("c", specs, ledger, topology)
+	# Planning a VM again replaces its own entry.
+	assert placement.plan("a", specs, ledger, topology).node == 0
+
+def test_smt_and_exclude(topology, tmp_path):
+	specs = {"cpus": "3", "ram": "1G", "placement": {"node": 0, "smt": True, "exclude": "1"}}
+	with pytest.raises(Exception, match="1 free cores, 2 needed"):
+		placement.plan("a", specs, str(tmp_path / "placement.json"), topology)
+	specs["placement"]["exclude"] = ""
+	p = placement.plan("a", specs, str(tmp_path / "placement.json"), topology)
+	assert p.vcpu_cpus == [ [ 0 ], [ 2 ], [ 1 ] ]
+
+def test_hugepages_pick_the_node_that_has_them(topology, tmp_path):
+	specs = {"cpus": "1", "ram": "512M", "placement": {"hugepages": "2M"}}
+	p = placement.plan("a", specs, str(tmp_path / "placement.json"), topology)
+	assert p.node == 1
+	assert p.data(share=True) == [
+		"-object", "memory-backend-file,id=mem0,size=512M,mem-path=/dev/hugepages,prealloc=on,share=on,host-nodes=1,policy=bind",
+		"-numa", "node,nodeid=0,memdev=mem0",
+	]
+	specs["ram"] = "1G"
+	with pytest.raises(Exception, match="300 free hugepages, 512 needed"):
+		placement.plan("b", specs, str(tmp_path / "placement.json"), topology)
@@ -0,0 +1,24 @@
+import glob
+import json
+import os
+import render
+import schema
+
+repo = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def test_checked_in_specs_are_valid():
+	paths = sorted(glob.glob(os.path.join(repo, "**", "specs.json"), recursive=True))
+	assert len(paths) > 0
+	for path in paths:
+		with open(path, "r") as f:
+			text = f.read()
+		# Templates are checked the way render.py fills them in.
+		values = dict(render.generated_values("vm", set()), SSHKEY="ssh-ed25519 AAAA")
+		specs = json.loads(render.render_text(text, values, path))
+		assert schema.validate(specs) == [], path
+
+def test_drive_bootindex():
+	drive = {"file": "d0.img", "bootindex": "0"}
+	assert schema.validate({"drives": [ drive ]}) == []
+	drive["bootindex"] = -1
+	assert schema.validate({"drives": [ drive ]}) == [ "specs.drives[0].bootindex must not be negative" ]
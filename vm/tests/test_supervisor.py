@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+import supervisor
+import vm_start_macos
+import pytest
+
+@pytest.fixture
+def vm_dir(tmp_path, monkeypatch):
+	# fake_qemu.py stands in for qemu, see its header.
+	bin_dir = tmp_path / "bin"
+	os.makedirs(bin_dir)
+	os.symlink(os.path.join(os.path.dirname(supervisor.__file__), "fake_qemu.py"), bin_dir / "qemu-system-aarch64")
+	monkeypatch.setattr(vm_start_macos, "qemu_path", str(bin_dir))
+	monkeypatch.setattr(vm_start_macos, "images_path", str(tmp_path / "images"))
+	monkeypatch.setattr(vm_start_macos, "seeds_path", str(tmp_path / "images" / "seeds"))
+	monkeypatch.setattr(supervisor, "backoff_min", 0.2)
+	monkeypatch.setattr(supervisor, "backoff_max", 0.4)
+	monkeypatch.setenv("FAKE_QEMU_BOOT", "0")
+	path = tmp_path / "vm1"
+	os.makedirs(path)
+	with open(path / "specs.json", "w") as f:
+		json.dump({"arch": "qemu-system-aarch64", "cpus": "1", "ram": "512M"}, f)
+	return str(path)
+
+async def wait_until(predicate, timeout=10):
+	deadline = asyncio.get_running_loop().time() + timeout
+	while not predicate():
+		assert asyncio.get_running_loop().time() < deadline, "timed out"
+		await asyncio.sleep(0.05)
+
+def test_crashing_vm_is_restarted_with_backoff(vm_dir, monkeypatch):
+	monkeypatch.setenv("FAKE_QEMU_CRASH", "0.2")
+	async def run():
+		vm = supervisor.ManagedVM(vm_dir)
+		states = []
+		set_state = vm.set_state
+		monkeypatch.setattr(vm, "set_state", lambda state: (states.append(state), set_state(state)))
+		vm.start()
+		await wait_until(lambda: vm.restarts >= 2)
+		assert vm.last_exit == 1
+		assert vm.backoff == supervisor.backoff_max
+		await vm.stop(timeout=1)
+		assert vm.state == "stopped"
+		assert states[:4] == [ "starting", "running", "backoff", "starting" ]
+	asyncio.run(run())
+
+def test_no_restart_policy(vm_dir, monkeypatch):
+	monkeypatch.setenv("FAKE_QEMU_CRASH", "0.2")
+	async def run():
+		vm = supervisor.ManagedVM(vm_dir, restart="no")
+		vm.start()
+		await asyncio.wait_for(vm.task, 10)
+		assert (vm.state, vm.restarts, vm.last_exit) == ("stopped", 0, 1)
+	asyncio.run(run())
+
+def test_stop_shuts_the_guest_down(vm_dir):
+	async def run():
+		vm = supervisor.ManagedVM(vm_dir, restart="always")
+		vm.start()
+		await wait_until(lambda: vm.state == "running" and os.path.exists(vm.plan.agent_path))
+		await vm.stop(timeout=5)
+		# guest-shutdown through the agent, not a kill.
+		assert (vm.state, vm.restarts, vm.last_exit) == ("stopped", 0, 0)
+		assert b"Booting fake guest" in vm.console.tail(4096)
+	asyncio.run(run())
+
+def test_specs_restart_wins_over_the_default(vm_dir):
+	assert supervisor.ManagedVM(vm_dir).restart == supervisor.default_restart
+	assert supervisor.ManagedVM(vm_dir, "always").restart == "always"
+	with open(os.path.join(vm_dir, "specs.json"), "w") as f:
+		json.dump({"arch": "qemu-system-aarch64", "restart": "no"}, f)
+	assert supervisor.ManagedVM(vm_dir, "always").restart == "no"
@@ -0,0 +1,40 @@
+import asyncio
+import os
+import telemetry
+from fake_qmp import FakeQMP
+
+def test_sampling(tmp_path):
+	for name in [ "vm1", "vm2" ]:
+		os.makedirs(tmp_path / name)
+	vm1 = FakeQMP(str(tmp_path / "vm1" / f"vm1{telemetry.telemetry_suffix}"))
+	vm2 = FakeQMP(str(tmp_path / "vm2" / f"vm2{telemetry.telemetry_suffix}"))
+
+	async def run():
+		t = telemetry.Telemetry([ str(tmp_path) ])
+		try:
+			await t.rescan()
+			assert sorted(t.samplers) == [ "vm1", "vm2" ]
+			first = await t.collect()
+			# Rates need a second sample.
+			assert sorted(set(m[0] for m in first)) == [ "vm_balloon_actual_bytes",
+				"vm_kvm_max_mmu_page_hash_collisions", "vm_kvm_remote_tlb_flush", "vm_vcpus" ]
+			await asyncio.sleep(0.5)
+			vm2.stop()
+			await t.rescan()
+			assert list(t.samplers) == [ "vm1" ]
+			metrics = { (name, labels.get("device")): value for name, labels, value in await t.collect() }
+		finally:
+			await t.close()
+		# fake_qmp reads 400k and writes 200k a second.
+		assert abs(metrics[("vm_block_read_bytes_per_second", "d0")] - 409600) < 409600 * 0.2
+		assert abs(metrics[("vm_block_write_bytes_per_second", "d0")] - 204800) < 204800 * 0.2
+		assert metrics[("vm_block_read_latency_seconds", "d0")] > 0
+		assert metrics[("vm_vcpus", None)] == 1
+
+	with vm1:
+		vm2.start()
+		asyncio.run(run())
+
+def test_prometheus_format():
+	text = telemetry.format_prometheus([ ("vm_vcpus", {"vm": 'a"b\\c'}, 2), ("vm_vcpus", {"vm": "d"}, None) ])
+	assert text == '# TYPE vm_vcpus gauge\nvm_vcpus{vm="a\\"b\\\\c"} 2\n'
@@ -0,0 +1,41 @@
+import asyncio
+import os
+import timesync
+from fake_agent import FakeAgent
+
+async def wait_until(predicate, timeout=5):
+	deadline = asyncio.get_running_loop().time() + timeout
+	while not predicate():
+		assert asyncio.get_running_loop().time() < deadline, "timed out"
+		await asyncio.sleep(0.02)
+
+def test_rescan_follows_discovery(tmp_path):
+	for name in [ "vm1", "vm2" ]:
+		os.makedirs(tmp_path / name)
+	vm1 = FakeAgent(str(tmp_path / "vm1" / "vm1.agent"))
+	vm2 = FakeAgent(str(tmp_path / "vm2" / "vm2.agent"))
+	vm1.time_offset = 5
+
+	async def run():
+		sync = timesync.TimeSync([ str(tmp_path) ], interval=60, max_delta=1)
+		try:
+			await sync.rescan()
+			assert sorted(sync.clocks) == [ "vm1", "vm2" ]
+			await wait_until(lambda: sync.clocks["vm1"].corrections == 1 and sync.clocks["vm2"].samples == 1)
+			assert abs(vm1.time_offset) < 1
+			vm2.stop()
+			# agent_broker comes up in front of vm1.
+			with FakeAgent(vm1.sockpath + ".mux") as mux:
+				await sync.rescan()
+				assert sorted(sync.clocks) == [ "vm1" ]
+				assert sync.clocks["vm1"].sockpath == mux.sockpath
+				await wait_until(lambda: mux.calls.get("guest-get-time", 0) == 1)
+				assert sync.clocks["vm1"].samples == 2
+		finally:
+			for task in sync.tasks.values():
+				task.cancel()
+			await asyncio.gather(*sync.tasks.values(), return_exceptions=True)
+
+	with vm1:
+		vm2.start()
+		asyncio.run(run())
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Keeps the clock of every guest in sync with the host from one process.
+# New VMs are picked up as their agent sockets appear.
+import asyncio
+import agent
+import argparse
+import fleet
+import json
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger("timesync")
+logging.basicConfig(stream=sys.stderr)
+
+default_interval=60
+default_max_delta=agent.max_delta_seconds
+rescan_seconds=10
+reconnect_max=60
+
+class GuestClock:
+	def __init__(self, name, sockpath):
+		self.name = name
+		self.sockpath = sockpath
+		self.drift = None
+		self.rtt = None
+		self.samples = 0
+		self.corrections = 0
+		self.errors = 0
+		self.last_error = None
+		self.last_sync = None
+
+	def stats(self):
+		return {
+			"drift_seconds": self.drift,
+			"rtt_seconds": self.rtt,
+			"samples": self.samples,
+			"corrections": self.corrections,
+			"errors": self.errors,
+			"last_error": self.last_error,
+			"last_sync": self.last_sync,
+		}
+
+	async def measure(self, q):
+		# The guest read happens somewhere within the round trip, assume the
+		# middle of it. Positive drift means the guest clock is ahead.
+		t0 = time.time()
+		ns = await q.execute("guest-get-time")
+		t1 = time.time()
+		if not isinstance(ns, int):
+			raise Exception("Invalid message from guest: %s" % ns)
+		self.rtt = t1 - t0
+		self.drift = ns / 1000000000 - (t0 + t1) / 2
+		self.samples += 1
+		return self.drift
+
+	async def correct(self, q):
+		# Aim for the host time at which the guest will apply the value.
+		target = time.time() + (self.rtt or 0) / 2
+		await q.execute("guest-set-time", {"time": int(target * 1000000000)})
+		self.corrections += 1
+
+	async def sync(self, q, max_delta):
+		drift = await self.measure(q)
+		log.debug("%s: drift %.6fs rtt %.6fs", self.name, drift, self.rtt)
+		if abs(drift) > max_delta:
+			log.info("%s: correcting drift of %.3fs", self.name, drift)
+			await self.correct(q)
+		self.last_sync = time.time()
+		self.last_error = None
+
+	async def run(self, interval, max_delta):
+		delay = 1
+		while True:
+			try:
+				async with agent.AsyncQemuAgent(self.sockpath) as q:
+					delay = 1
+					while True:
+						await self.sync(q, max_delta)
+						await asyncio.sleep(interval)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				self.errors += 1
+				self.last_error = str(e) or e.__class__.__name__
+				log.warning("%s: %s, retrying in %ss", self.name, self.last_error, delay)
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, reconnect_max)
+
+class TimeSync:
+	def __init__(self, vm_dirs, interval=default_interval, max_delta=default_max_delta, stats_file=None):
+		self.vm_dirs = vm_dirs
+		self.interval = interval
+		self.max_delta = max_delta
+		self.stats_file = stats_file
+		self.clocks = {}
+		self.tasks = {}
+
+	async def rescan(self):
+		# discover() probes the .mux sockets, which blocks.
+		sockets = await asyncio.to_thread(fleet.discover, self.vm_dirs, True)
+		for name, clock in list(self.clocks.items()):
+			if sockets.get(name) == clock.sockpath:
+				continue
+			# Gone, or agent_broker started or stopped in front of it.
+			self.tasks.pop(name).cancel()
+			if name not in sockets:
+				log.info("%s: gone", name)
+				del self.clocks[name]
+		for name, sockpath in sockets.items():
+			if name in self.tasks and not self.tasks[name].done():
+				continue
+			log.info("%s: watching %s", name, sockpath)
+			clock = self.clocks.setdefault(name, GuestClock(name, sockpath))
+			clock.sockpath = sockpath
+			self.tasks[name] = asyncio.create_task(clock.run(self.interval, self.max_delta))
+
+	def stats(self):
+		return { name: clock.stats() for name, clock in sorted(self.clocks.items()) }
+
+	def write_stats(self):
+		if self.stats_file is None:
+			return
+		tmp = self.stats_file + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(self.stats(), f, indent=2)
+		os.replace(tmp, self.stats_file)
+
+	async def run(self):
+		try:
+			while True:
+				await self.rescan()
+				self.write_stats()
+				await asyncio.sleep(min(rescan_seconds, self.interval))
+		finally:
+			for task in self.tasks.values():
+				task.cancel()
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Sync the clock of every VM with the host.")
+	parser.add_argument("-i", "--interval", type=float, default=default_interval,
+		help="Seconds between checks of each guest.")
+	parser.add_argument("-m", "--max-delta", type=float, default=default_max_delta,
+		help="Correct guests whose clock is off by more than this many seconds.")
+	parser.add_argument("-s", "--stats", help="Write per VM drift and latency stats to this JSON file.")
+	parser.add_argument("vm", nargs="+", help="VM directory, or a directory holding VM directories.")
+	args = parser.parse_args(argv[1:])
+	if os.getenv('AGENT_DEBUG') == '1':
+		log.setLevel('DEBUG')
+	else:
+		log.setLevel('INFO')
+	try:
+		asyncio.run(TimeSync(args.vm, args.interval, args.max_delta, args.stats).run())
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -3,24 +3,40 @@ import sys
 import os
 import logging
 from subprocess import Popen, PIPE, TimeoutExpired
-import shutil
-import pathlib
-import time
-import select
+import backends
+import seed
+import console
+import images
+import placement
+import schema
+import shares
+import threading
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stderr)
 images_path=os.path.abspath("images")
-qemu_path="/opt/homebrew/bin"
+seeds_path=os.path.join(images_path, "seeds")
+placement_path=os.path.join(images_path, "placement.json")
+# Directory of the qemu binaries, defaults to the one of the backend.
+qemu_path=None
+stop_timeout=30
 
 class VirtualMachine:
-	def __init__(self, name):
+	# With create=False nothing is written, drives are only described.
+	def __init__(self, name, create=True):
 		if not isinstance(name, str):
 			raise TypeError("name must be str")
 
 
-		self.name = name
 		self.dir = os.path.abspath(name)
+		self.name = os.path.basename(self.dir)
+		self.agent_path = os.path.join(self.dir, f"{self.name}.agent")
+		self.monitor_path = os.path.join(self.dir, f"{self.name}.monitor")
+		# A QMP chardev serves one client at a time, so the long-lived ones
+		# get their own and .monitor is left to short requests.
+		self.events_path = os.path.join(self.dir, f"{self.name}.qmp-events")
+		self.telemetry_path = os.path.join(self.dir, f"{self.name}.qmp-telemetry")
+		self.bulk_path = os.path.join(self.dir, f"{self.name}.bulk")
 
 		if not os.path.isdir(self.dir):
 			raise Exception("VM doesn't exist")
@@ -30,79 +46,74 @@ class VirtualMachine:
 			raise TypeError("specs_file doesn't exist")
 		with open(self.specs_file, "r") as f:
 			self.specs = json.load(f)
+		errors = schema.validate(self.specs)
+		if len(errors) > 0:
+			raise TypeError(f"{self.specs_file}: " + "; ".join(errors))
 
+		self.backend = backends.get(self.specs.get("backend"))
 		self.arch = self.specs.get('arch', "qemu-system-aarch64")
-		self.qemu_bin = os.path.join(qemu_path, self.arch)
+		self.qemu_bin = os.path.join(qemu_path or self.backend.qemu_path, self.arch)
 		if not os.path.isfile(self.qemu_bin):
 			raise Exception("Invalid arch")
 
 		self.drives = []
 		i=0
-		for drive in self.specs.get("drives"):
-			hd = HardDrive(drive, i, self.name)
-			if not hd.exists():
+		for drive in self.specs.get("drives", []):
+			hd = HardDrive(drive, i, self.dir, self.backend)
+			if create and not hd.exists():
 				hd.create()
 			self.drives += [ hd ]
 			i += 1
 
 		self.nics = []
 		i=0
-		for nic_spec in self.specs.get("netdev"):
-			self.nics += [ Nic(nic_spec, i) ]
+		for nic_spec in self.specs.get("netdev", []):
+			self.nics += [ Nic(nic_spec, i, self.backend) ]
 			i += 1
 
-		self.metadata = Metadata(self.specs.get("metadata"), self.dir)
+		self.shares = shares.from_specs(self.specs, self.dir, self.backend)
+		self.metadata = Metadata(self.specs.get("metadata"), self.dir, self.shares)
+		self.placement = None
+		self.virtiofsd = []
+		self.proc = None
 
 	def cleanup(self):
 		self.metadata.delete()
 		for drive in self.drives:
 			drive.delete()
 
-	def data(self):
+	def data(self, incoming=None, dry_run=False):
+		# A dry run has no side effects: drives that don't exist yet are
+		# included, the seed isn't built and no CPUs are reserved.
 		qemu_cmd = [self.qemu_bin]
-		if self.specs.get('arch') == "qemu-system-aarch64":
-			qemu_cmd += [ 
-				"-machine", "virt,highmem=on",
-				"-accel", "hvf",
-				"-cpu", "host",
-				"-bios", "QEMU_EFI.fd",
-				#"-drive", "file=/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-aarch64-code.fd,if=pflash,format=raw"
-				#"-serial", "chardev:console1"
-			]
-		elif self.specs.get('arch') == "qemu-system-x86_64":
-			qemu_cmd += [ 
-				"-machine", "q35",
-				#"-device", "isa-serial,chardev=console1",
-			]
+		qemu_cmd += self.backend.machine(self.specs)
 		qemu_cmd += [
-			"-smp", self.specs.get("cpus", "1"),
+			"-smp", str(self.specs.get("cpus", "1")),
 			"-m", self.specs.get("ram", "1G"),
 			"-nodefaults",
 		]
+		shared_memory = shares.shared_memory(self.shares)
+		if "placement" in self.specs and not dry_run:
+			if self.placement is None:
+				self.placement = placement.plan(self.name, self.specs, placement_path)
+			qemu_cmd += self.placement.data(share=shared_memory)
+		elif shared_memory and "placement" not in self.specs:
+			qemu_cmd += self.backend.shared_memory(self.specs)
 		for drive in self.drives:
-			qemu_cmd += drive.data()
+			qemu_cmd += drive.data(planned=dry_run)
 
 		for nic in self.nics:
 			qemu_cmd += nic.data()
 
-		qemu_cmd += self.metadata.data()
+		qemu_cmd += self.metadata.data(create=not dry_run)
+
+		for share in self.shares:
+			qemu_cmd += share.data()
 
 		if "bios" in self.specs and self.specs['bios'] == 'uefi':
-			qemu_cmd += [
-				#"-pflash", "/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-x86_64-code.fd",
-				"-drive", "file=/opt/homebrew/Cellar/qemu/8.0.3/share/qemu/edk2-x86_64-code.fd,if=pflash,format=raw"
-			]
+			qemu_cmd += self.backend.uefi(self.specs)
 
-		if "video" not in self.specs:
-			qemu_cmd += [
-				"-nographic",
-				"-vga", "none",
-			]
-		else:
-			qemu_cmd += [
-				"-display", "cocoa",
-				"-device", self.specs["video"]
-			]
+		qemu_cmd += self.backend.display(self.specs)
 
 		if "cdrom" in self.specs:
 			isofile = os.path.abspath(os.path.join(images_path, self.specs['cdrom'].get('iso')))
@@ -122,55 +133,84 @@ class VirtualMachine:
 			"-chardev", "stdio,id=console1",
 			"-serial", "chardev:console1",
 
-			"-chardev", f"socket,path={os.path.join(self.dir, self.name)}.agent,server=on,wait=off,id=agent0",
+			"-chardev", f"socket,path={self.agent_path},server=on,wait=off,id=agent0",
 			"-device", "virtserialport,chardev=agent0,name=org.qemu.guest_agent.0",
 
 			"-mon", "chardev=mon0,mode=control,pretty=off",
-			"-chardev", f"socket,path={os.path.join(self.dir, self.name)}.monitor,server=on,wait=off,id=mon0",
+			"-chardev", f"socket,path={self.monitor_path},server=on,wait=off,id=mon0",
+			"-mon", "chardev=mon1,mode=control,pretty=off",
+			"-chardev", f"socket,path={self.events_path},server=on,wait=off,id=mon1",
+			"-mon", "chardev=mon2,mode=control,pretty=off",
+			"-chardev", f"socket,path={self.telemetry_path},server=on,wait=off,id=mon2",
 
 			"-device", "pcie-root-port,id=pcie.1",
 		]
+		if "channel" in self.specs:
+			qemu_cmd += self.backend.channel(self.specs["channel"], self.bulk_path)
+		if incoming is not None:
+			qemu_cmd += [ "-incoming", incoming ]
 		return qemu_cmd
 
-	def run(self):
-		qemu_cmd = self.data()
+	def start(self, stdin=None, stdout=PIPE, stderr=PIPE, incoming=None):
+		qemu_cmd = self.data(incoming)
 		log.debug(" ".join(qemu_cmd))
 		log.debug(os.getcwd())
-		res = Popen(qemu_cmd, stdout=PIPE, stderr=PIPE)
-		polling = select.poll()
-		polling.register(res.stdout, select.POLLIN)
-		polling.register(res.stderr, select.POLLIN)
-		registered_pipes = 2
-		while registered_pipes > 0:
-			outs = polling.poll(1)
-			for out, event in outs:
-				if out == res.stdout.fileno():
-					lines = res.stdout.readlines(1)
-				elif out == res.stderr.fileno():
-					lines = res.stderr.readlines(1)
-				else:
-					continue
-				for line in lines:
-					try:
-						print(line.decode('ascii', errors='ignore').rstrip())
-					except:
-						pass
-				if (event & select.POLLHUP) == select.POLLHUP:
-					polling.unregister(out)
-					registered_pipes -= 1
-			if res.poll() is not None:
-				break
-		res.wait()
-		return res.returncode
+		self.virtiofsd = shares.start_daemons(self.daemons())
+		try:
+			proc = Popen(qemu_cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+		except BaseException:
+			shares.stop_daemons(self.virtiofsd)
+			raise
+		self.proc = proc
+		if self.placement is not None:
+			threading.Thread(target=self.placement.apply_sync, args=(self.monitor_path, proc.pid), daemon=True).start()
+		return proc
+
+	def stop(self, timeout=stop_timeout):
+		# Ends qemu if it still runs, then the virtiofsd of its shares. Safe
+		# to call again, and needed even after qemu exited by itself.
+		proc = self.proc
+		self.proc = None
+		try:
+			if proc is not None and proc.poll() is None:
+				proc.terminate()
+				try:
+					proc.wait(timeout)
+				except TimeoutExpired:
+					proc.kill()
+					proc.wait()
+		finally:
+			shares.stop_daemons(self.virtiofsd)
+			self.virtiofsd = []
+
+	def run(self, incoming=None, echo=True):
+		res = self.start(incoming=incoming)
+		self.console = console.Console(self.name, os.path.join(self.dir, f"{self.name}.log"))
+		if echo:
+			self.console.subscribe(write_stdout)
+		try:
+			return self.console.capture(res)
+		finally:
+			self.console.close()
+			self.stop()
+
+	def daemons(self):
+		return [ share.daemon() for share in self.shares if share.daemon() is not None ]
+
+def write_stdout(data):
+	sys.stdout.buffer.write(data)
+	sys.stdout.buffer.flush()
 
 class HardDrive:
-	def __init__(self, spec, index, vm_dir):
+	def __init__(self, spec, index, vm_dir, backend=None):
 		if not isinstance(spec, dict):
 			raise TypeError("Parameter spec must be dictionary.")
+		self.spec = spec
+		self.backend = backend or backends.get()
 		baseimage = spec.get("baseimage")
 		self.baseimage = None
 		if baseimage is not None:
-			baseimage = os.path.abspath(os.path.join(images_path, baseimage))
+			baseimage = images.Registry(images_path).resolve(baseimage)
 			if os.path.isfile(baseimage):
 				self.baseimage = baseimage
 
@@ -185,25 +225,10 @@ class HardDrive:
 	def exists(self):
 		return os.path.isfile(self.file)
 
-	def data(self):
-		if not self.exists():
+	def data(self, planned=False):
+		if not planned and not self.exists():
 			return []
-		drivedata = []
-		if self.bustype == 'scsi-hd':
-			drivedata += ["-device", "virtio-scsi-pci"]
-		if self.bustype == 'ide-hd':
-			drivedata += [
-				#"-device", "piix3-ide",
-				"-drive",  f"file={self.file},if=ide,id={self.id},cache=writeback",
-				#"-device", f"{self.bustype},drive={self.id},bootindex={self.index},bus=ide.0"
-			]
-			return drivedata
-
-		drivedata += [ 
-			"-drive",  f"file={self.file},if=none,id={self.id},cache=writeback",
-			"-device", f"{self.bustype},drive={self.id},bootindex={self.index}"
-		]
-		return drivedata
+		return self.backend.drive(self)
 
 	def create(self):
 		cmd = [ "qemu-img", "create", "-f", "qcow2" ]
@@ -214,11 +239,11 @@ class HardDrive:
 			cmd += [ self.size ]
 		log.debug("Command: %s", str(cmd))
 		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		res.wait()
-		log.debug("Image creation: %s", res.communicate()[0].decode('ascii').rstrip())
-		if res.returncode is not None and res.returncode != 0:
-			log.error("Error(%s) creating image: %s", 
-				res.returncode, res.communicate()[1].decode('ascii').rstrip())
+		stdout, stderr = res.communicate()
+		log.debug("Image creation: %s", stdout.decode('ascii').rstrip())
+		if res.returncode != 0:
+			log.error("Error(%s) creating image: %s",
+				res.returncode, stderr.decode('ascii').rstrip())
 			raise Exception("Unable to create HardDrive")
 
 	def delete(self):
@@ -227,17 +252,20 @@ class HardDrive:
 			log.debug("Deleted %s", self.file)
 
 class Nic:
-	def __init__(self, specs, index):
+	def __init__(self, specs, index, backend=None):
 		if not isinstance(specs, dict):
 			raise TypeError("specs must be dictionary")
+		self.backend = backend or backends.get()
 		self.mac = specs.get("mac")
-		self.type = specs.get("type", "vmnet-host")
+		self.type = specs.get("type", self.backend.default_netdev)
 		self.index = index
 		self.sock = specs.get("sock")
 		self.id = f"mynet{self.index}"
 		self.netdev = self.id
-		self.devtype = specs.get("devtype", "e1000")
+		self.devtype = specs.get("devtype", self.backend.default_devtype)
 		self.ifname = specs.get("ifname")
+		self.bridge = specs.get("bridge")
+		self.queues = specs.get("queues")
 
 	def get(self, key):
 		value = getattr(self, key)
@@ -265,18 +293,17 @@ class Nic:
 	def data(self):
 		if self.mac is None:
 			return []
-		return [
-			"-netdev", self.param_netdev(),
-			"-device", self.param_device()
-		]
+		return self.backend.nic(self)
 
 class Metadata:
-	def __init__(self, specs, vm_dir):
+	def __init__(self, specs, vm_dir, share_list=[]):
+		# Mounts of the shares are added to user-data.
+		self.shares = share_list
+		self.done = False
 		if specs is None:
 			self.floppy_path = None
 			return
 		floppy_file = specs.get("file", "floppy.img")
-		self.floppy_dev = None
 		self.floppy_path = os.path.join(vm_dir, floppy_file)
 		mf = specs.get("meta-data")
 		self.metadata_file = None
@@ -297,110 +324,46 @@ class Metadata:
 			if os.path.isfile(nc):
 				self.network_file = nc
 
-	def create(self):
-		cmd = ["dd", "if=/dev/zero", f"of={self.floppy_path}", "bs=512", "count=2880" ]
-		log.debug(f"Command: %s", str(cmd))
-		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		stdout, stderr = res.communicate(timeout=10)
-		log.debug("Creating floppy: %s", stdout.decode('ascii').rstrip())
-		if res.returncode is not None and res.returncode != 0:
-			raise Exception("Error(%s) creating floppy %s" % 
-				(res.returncode, stderr.decode('ascii').rstrip()))
-
-	def attach(self):
-		cmd = [ "hdiutil", "attach", "-nomount", self.floppy_path ]
-		log.debug("Command: %s", str(cmd))
-		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		stdout, stderr = res.communicate(timeout=10)
-		if res.returncode != 0:
-			raise Exception(stderr.decode('ascii').rstrip())
-		self.floppy_dev = stdout.decode('ascii').rstrip()
-		log.debug("Attaching floppy: '%s'", self.floppy_dev)
-		if res.returncode is not None and res.returncode != 0:
-			raise Exception("Error(%s) attaching floppy '%s'" %
-				(res.returncode, stderr.decode('ascii').rstrip()))
-		retry=0
-		while True:
-			if retry == 10:
-				raise TimeoutError("Error attaching floppy '%s'." % self.floppy_dev)
-			if pathlib.Path(self.floppy_dev).is_block_device():
-				break
-			retry += 1
-			time.sleep(1)
-
-	def format(self):
-		cmd = [ "diskutil", "eraseVolume", "MS-DOS", "CIDATA", self.floppy_dev ]
-		log.debug("Command: %s", str(cmd))
-		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		stdout, stderr = res.communicate(timeout=10)
-		log.debug("Formatting floppy: %s", self.floppy_dev)
-		if res.returncode is not None and res.returncode != 0:
-			raise Exception("Error(%s) formatting floppy %s" %
-				(res.returncode, res.communicate()[1].decode('ascii').rstrip()))
-
+	def files(self):
+		files = []
+		for name, path in [
+			("meta-data", self.metadata_file),
+			("user-data", self.userdata_file),
+			("network-config", self.network_file) ]:
+			if path is not None and os.path.isfile(path):
+				with open(path, "rb") as f:
+					files.append((name, f.read()))
+		return shares.seed_files(files, self.shares)
 
-	def mount(self):
-		cmd = [ "diskutil", "mount", self.floppy_dev ]
-		log.debug("Command: %s", str(cmd))
-		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		stdout, stderr = res.communicate(timeout=10)
-		log.debug("Mounting floppy: %s", self.floppy_dev)
-		if res.returncode is not None and res.returncode != 0:
-			raise Exception("Error(%s) mounting floppy %s" %
-				(res.returncode, res.communicate()[1].decode('ascii').rstrip()))
-
-	def copy_files(self):
-		if self.metadata_file is not None and os.path.isfile(self.metadata_file):
-			shutil.copyfile(self.metadata_file, "/Volumes/CIDATA/meta-data")
-			log.debug("Copied %s", self.metadata_file)
-		if self.userdata_file is not None and os.path.isfile(self.userdata_file):
-			shutil.copyfile(self.userdata_file, "/Volumes/CIDATA/user-data")
-			log.debug("Copied %s", self.userdata_file)
-		if self.network_file is not None and os.path.isfile(self.network_file):
-			shutil.copyfile(self.network_file, "Volumes/CIDATA/network-config")
-			log.debug("Copied %s", self.network_file)
-
-	def unmount(self):
-		cmd = [ "hdiutil", "detach", self.floppy_dev ]
-		log.debug("Command: %s", str(cmd))
-		res = Popen(cmd, stdout=PIPE, stderr=PIPE)
-		stdout, stderr = res.communicate(timeout=10)
-		log.debug("Unounting floppy: %s", self.floppy_dev)
-		if res.returncode is not None and res.returncode != 0:
-			raise Exception("Error(%s) unmounting floppy %s" %
-				(res.returncode, stderr.decode('ascii').rstrip()))
-		self.floppy_dev = None
+	def create(self):
+		seed.SeedCache(seeds_path).install(self.files(), self.floppy_path)
+		log.debug("Installed seed image %s", self.floppy_path)
 
 	def delete(self):
-		if self.floppy_dev is not None:
-			self.unmount()
-		if os.path.isfile(self.floppy_path):
+		if self.floppy_path is not None and os.path.isfile(self.floppy_path):
 			log.debug("Deleting file %s", self.floppy_path)
 			os.remove(self.floppy_path)
+		self.done = False
 
 	def do(self):
+		# Cheap enough to run on every start, and picks up edited user-data.
 		if self.floppy_path is None:
 			return
-		if os.path.isfile(self.floppy_path):
-			return
-		try:
-			self.create()
-			self.attach()
-			self.format()
-			self.mount()
-			self.copy_files()
-			self.unmount()
-		except:
-			self.delete()
-			raise
+		self.create()
+		self.done = True
 
-	def data(self):
+	def data(self, create=True):
 		if self.floppy_path is None:
 			return []
-		self.do()
+		# Callers that prepare VMs ahead of the start already built it.
+		if create and not self.done:
+			self.do()
 		return [ "-drive", f"file={self.floppy_path},if=virtio,format=raw,media=cdrom" ]
 
 def main(argv):
+	# --dry-run and --print-plan only show what would be run and created.
+	dry_run = "--dry-run" in argv or "--print-plan" in argv
+	argv = [ a for a in argv if a not in ("--dry-run", "--print-plan") ]
 	if len(argv) < 2:
 		log.error("Invalid number of parameters.")
 		exit(1)
@@ -412,6 +375,20 @@ def main(argv):
 	else:
 		ephemeral = False
 
+	if dry_run:
+		vm = VirtualMachine(vm_name, create=False)
+		print(" ".join(vm.data(dry_run=True)))
+		for drive in vm.drives:
+			if not drive.exists():
+				print(f"create: {drive.file}")
+		if vm.metadata.floppy_path is not None:
+			print(f"create: {vm.metadata.floppy_path}")
+		print(f"agent: {vm.agent_path}")
+		print(f"monitor: {vm.monitor_path}")
+		print(f"events: {vm.events_path}")
+		print(f"telemetry: {vm.telemetry_path}")
+		sys.exit(0)
+
 	vm = VirtualMachine(vm_name)
 	ret = vm.run()
 	if ephemeral: